@@ -0,0 +1,77 @@
+"""Active announcement feed for tutors, with per-user read tracking.
+
+The feed is filtered on is_active and expiry_date in SQL and cached per process
+until the announcement table changes or the earliest expiry date in the feed
+passes. Read state lives in announcement_read, so the unread count is one
+indexed count against the cached feed's ids rather than a refetch of the content.
+"""
+import threading
+from datetime import datetime, timedelta, date
+from app import db
+from models import Announcement, AnnouncementRead, insert_ignore
+from versioning import get_versions
+from db_routing import current_branch
+
+# ((branch, announcement table version), date computed, first date it is stale, feed)
+_feed = None
+_lock = threading.Lock()
+
+
+def active_announcements(today=None):
+    """Active, unexpired announcements as dicts, newest first, shared by every caller"""
+    global _feed
+    today = today or datetime.utcnow().date()
+    version = (current_branch(), get_versions([Announcement])['announcement'][0])
+    with _lock:
+        if _feed is not None and _feed[0] == version and _feed[1] <= today < _feed[2]:
+            return _feed[3]
+
+    announcements = Announcement.query.filter(
+        Announcement.is_active.is_(True),
+        db.or_(Announcement.expiry_date.is_(None), Announcement.expiry_date >= today)
+    ).order_by(Announcement.created_at.desc()).all()
+    feed = [{
+        'id': announcement.id,
+        'title': announcement.title,
+        'content': announcement.content,
+        'created_at': announcement.created_at.isoformat(),
+        'expiry_date': announcement.expiry_date.isoformat() if announcement.expiry_date else None
+    } for announcement in announcements]
+    # An announcement is shown through its expiry date, so the feed changes the day after
+    expiries = [announcement.expiry_date for announcement in announcements if announcement.expiry_date]
+    stale_on = min(expiries) + timedelta(days=1) if expiries else date.max
+    with _lock:
+        _feed = (version, today, stale_on, feed)
+    return feed
+
+
+def read_ids(user_id, announcement_ids):
+    """Which of the given announcements the user has read"""
+    if not announcement_ids:
+        return set()
+    return set(db.session.execute(
+        db.select(AnnouncementRead.announcement_id).where(
+            AnnouncementRead.user_id == user_id, AnnouncementRead.announcement_id.in_(announcement_ids))
+    ).scalars())
+
+
+def unread_count(user_id):
+    ids = [announcement['id'] for announcement in active_announcements()]
+    if not ids:
+        return 0
+    read = db.session.execute(
+        db.select(db.func.count()).select_from(AnnouncementRead).where(
+            AnnouncementRead.user_id == user_id, AnnouncementRead.announcement_id.in_(ids))
+    ).scalar()
+    return len(ids) - read
+
+
+def mark_read(user_id, announcement_ids):
+    """Record that the user has seen these announcements; repeats are ignored"""
+    active = {announcement['id'] for announcement in active_announcements()}
+    ids = sorted(active & set(announcement_ids))
+    if ids:
+        now = datetime.utcnow()
+        db.session.execute(insert_ignore(AnnouncementRead),
+                           [{'user_id': user_id, 'announcement_id': i, 'read_at': now} for i in ids])
+    return ids
@@ -5,6 +5,16 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlite_profile import is_sqlite_url, sqlite_engine_options, apply_sqlite_profile
+from db_routing import RoutingSession, replica_binds_from_env, branch_binds_from_env, init_db_routing
+from versioning import track_table_versions
+from partitions import init_attendance_partitions
+from loaders import init_loader_profiles
+from query_cache import init_query_cache
+from fragment_cache import init_fragment_cache
+from assets import init_assets
+from profiler import init_profiler
+from slow_queries import init_slow_query_log
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -20,14 +30,45 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 # Database configuration
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///mentorscue.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+
+def engine_options(url):
+    if is_sqlite_url(url):
+        # SQLite profile: WAL, tuned pragmas, busy timeout and serialized writers
+        return sqlite_engine_options()
+    return {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+
+# Read replicas (REPLICA_DATABASE_URLS); read-only views and roles are routed there
+app.config["SQLALCHEMY_BINDS"] = replica_binds_from_env()
+
+# Branch databases (BRANCH_DATABASE_URLS); the default database keeps the shared user directory
+app.config["SQLALCHEMY_BINDS"].update(
+    {key: {"url": url, **engine_options(url)} for key, url in branch_binds_from_env().items()}
+)
+
+# Raise on lazy loads a view's loader profile did not plan for (use in tests and development)
+app.config["STRICT_LOADING"] = os.environ.get("SQLALCHEMY_STRICT_LOADING", "").lower() in ("1", "true", "yes")
 
 # Initialize extensions
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 db.init_app(app)
+init_db_routing(app)
+init_loader_profiles(app, RoutingSession)
+# After the loader profiles, so cached results include the eager loads views plan for
+init_query_cache(app, RoutingSession)
+init_fragment_cache(app)
+
+with app.app_context():
+    for engine in db.engines.values():
+        apply_sqlite_profile(engine)
+        init_attendance_partitions(engine)
+        track_table_versions(engine)
+        # Last, so its timer leaves out the write lock wait and version bumps
+        init_slow_query_log(app, engine)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -36,6 +77,12 @@ login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
+# Fingerprinted, precompressed static assets (built by `python assets.py`)
+init_assets(app)
+
+# Request profiling rules set at /admin/profiler
+init_profiler(app)
+
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
@@ -44,6 +91,18 @@ def load_user(user_id):
 # Import models but don't initialize data yet
 import models  # noqa: F401
 
+# Keep the reporting cube's changed months marked as ledger entries and attendance are written
+from reports import init_report_cube
+init_report_cube(RoutingSession)
+
+# Capture inserts, updates and deletes for the audit log, written behind in batches
+from audit import init_audit
+init_audit(RoutingSession)
+
+# Resolve each request's branch from its host or /b/<branch>/ path prefix
+from tenancy import init_tenancy
+init_tenancy(app)
+
 # Function to initialize database
 def init_database():
     """Initialize database tables and default data"""
@@ -51,9 +110,14 @@ def init_database():
         db.create_all()
         logging.info("Database tables created")
         
+        from migrations import run_migrations
+        run_migrations()
+        
         # Create default roles, settings and admin user
         try:
-            from models import create_default_roles, create_admin_user, create_default_settings
+            from models import (create_default_roles, create_admin_user, create_default_settings,
+                                create_table_versions)
+            create_table_versions()
             create_default_roles()
             create_default_settings()
             create_admin_user()
@@ -61,5 +125,8 @@ def init_database():
         except Exception as e:
             logging.error(f"Error initializing default data: {e}")
 
+        from tenancy import init_branch_databases
+        init_branch_databases()
+
 # Initialize database on import
 init_database()
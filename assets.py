@@ -0,0 +1,246 @@
+"""Static asset pipeline: minify, fingerprint and precompress CSS/JS.
+
+Run `python assets.py` as a build step; the app then serves the fingerprinted
+files from static/dist with immutable cache headers.
+"""
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+from flask import url_for, request, send_from_directory, abort
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are written without it
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# Sources that get a fingerprinted bundle, relative to static/
+ASSET_DIRS = ('css', 'js')
+
+# One year; fingerprinted names change whenever the content does
+IMMUTABLE_MAX_AGE = 31536000
+
+_manifest = None
+_manifest_mtime = None
+
+
+def minify_css(source):
+    """Strip comments and insignificant whitespace from CSS"""
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,])\s*', r'\1', source)
+    source = source.replace(';}', '}')
+    return source.strip()
+
+
+# After these (or the keywords below) a / starts a regex literal; anywhere else it divides
+_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void', 'throw',
+                   'yield', 'await'}
+
+
+def minify_js(source):
+    """Conservative JS minification: drop comments, indentation and blank lines.
+
+    Newlines are kept so automatic semicolon insertion behaves exactly as before.
+    Strings, template literals and regex literals are copied untouched, so comment
+    markers or indentation inside them survive.
+    """
+    lines = []
+    line = []
+    starts_in_literal = False
+    template_depths = []  # open ${ ... } braces per template literal the code is nested in
+    prev, word = None, ''
+    i, n = 0, len(source)
+
+    def end_line(in_literal):
+        text = ''.join(line)
+        if not starts_in_literal:
+            text = text.lstrip()
+        if not in_literal:
+            text = text.rstrip()
+        if text or starts_in_literal or in_literal:
+            lines.append(text)
+        line.clear()
+
+    def copy_literal(start, closing):
+        # Copies a string, template or regex body up to its closing mark; returns the index after it
+        nonlocal starts_in_literal
+        j, in_class = start, False
+        while j < n:
+            ch = source[j]
+            if ch == '\\':
+                line.append(source[j:j + 2])
+                j += 2
+                continue
+            if ch == '\n':
+                end_line(True)
+                starts_in_literal = True
+                j += 1
+                continue
+            line.append(ch)
+            j += 1
+            if closing == '/' and ch in '[]':
+                in_class = ch == '['
+            elif ch == closing and not in_class:
+                return j
+            elif closing == '`' and ch == '$' and source[j:j + 1] == '{':
+                line.append('{')
+                template_depths.append(0)
+                return j + 1
+        return j
+
+    while i < n:
+        ch = source[i]
+        if ch == '\n':
+            end_line(False)
+            starts_in_literal = False
+            i += 1
+        elif ch == '/' and source[i + 1:i + 2] == '/':
+            while i < n and source[i] != '\n':
+                i += 1
+        elif ch == '/' and source[i + 1:i + 2] == '*':
+            end = source.find('*/', i + 2)
+            end = n if end == -1 else end + 2
+            if '\n' in source[i:end]:
+                end_line(False)
+                starts_in_literal = False
+            else:
+                line.append(' ')
+            i = end
+        elif ch in '\'"`' or (ch == '/' and (prev is None or prev in _REGEX_AFTER or word in _REGEX_KEYWORDS)):
+            line.append(ch)
+            i = copy_literal(i + 1, ch)
+            prev, word = ch, ''
+        elif ch == '}' and template_depths and template_depths[-1] == 0:
+            # The end of a ${ ... } expression: back into its template literal
+            template_depths.pop()
+            line.append(ch)
+            i = copy_literal(i + 1, '`')
+            prev, word = '`', ''
+        else:
+            if template_depths and ch in '{}':
+                template_depths[-1] += 1 if ch == '{' else -1
+            if ch.isalnum() or ch in '_$':
+                # The identifier right before a /, to tell `return /re/` from `total / count`
+                word = word + ch if i and (source[i - 1].isalnum() or source[i - 1] in '_$') else ch
+            elif not ch.isspace():
+                word = ''
+            if not ch.isspace():
+                prev = ch
+            line.append(ch)
+            i += 1
+    end_line(False)
+    return '\n'.join(lines) + '\n'
+
+
+def build_assets():
+    """Write minified, fingerprinted and precompressed copies of every asset"""
+    manifest = {}
+    for folder in ASSET_DIRS:
+        source_dir = os.path.join(STATIC_DIR, folder)
+        if not os.path.isdir(source_dir):
+            continue
+        for name in sorted(os.listdir(source_dir)):
+            base, ext = os.path.splitext(name)
+            if ext not in ('.css', '.js'):
+                continue
+            with open(os.path.join(source_dir, name), encoding='utf-8') as f:
+                source = f.read()
+            minified = (minify_css if ext == '.css' else minify_js)(source).encode('utf-8')
+            digest = hashlib.sha256(minified).hexdigest()[:12]
+
+            target_name = f"{folder}/{base}.{digest}{ext}"
+            target = os.path.join(DIST_DIR, target_name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(minified)
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(minified, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(minified, quality=11))
+
+            manifest[f"{folder}/{name}"] = f"dist/{target_name}"
+            logging.info(f"{folder}/{name}: {len(source)} -> {len(minified)} bytes ({target_name})")
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    _remove_stale(manifest)
+    return manifest
+
+
+def _remove_stale(manifest):
+    current = {path[len('dist/'):] for path in manifest.values()}
+    for root, _, files in os.walk(DIST_DIR):
+        for name in files:
+            relative = os.path.relpath(os.path.join(root, name), DIST_DIR).replace(os.sep, '/')
+            if relative == 'manifest.json':
+                continue
+            if re.sub(r'\.(gz|br)$', '', relative) not in current:
+                os.remove(os.path.join(root, name))
+
+
+def load_manifest(check_mtime=False):
+    """Load the build manifest once; re-read it on change when check_mtime is set"""
+    global _manifest, _manifest_mtime
+    if _manifest is not None and not check_mtime:
+        return _manifest
+    try:
+        mtime = os.path.getmtime(MANIFEST_PATH)
+    except OSError:
+        _manifest, _manifest_mtime = {}, None
+        return _manifest
+    if mtime != _manifest_mtime:
+        with open(MANIFEST_PATH) as f:
+            _manifest = json.load(f)
+        _manifest_mtime = mtime
+    return _manifest
+
+
+def init_assets(app):
+    """Serve built assets and point url_for('static', ...) at them"""
+
+    def asset_url_for(endpoint, **values):
+        if endpoint == 'static' and 'filename' in values:
+            built = load_manifest(check_mtime=app.debug).get(values['filename'])
+            if built:
+                values['filename'] = built
+        return url_for(endpoint, **values)
+
+    app.jinja_env.globals['url_for'] = asset_url_for
+
+    @app.route('/static/dist/<path:filename>')
+    def dist_asset(filename):
+        path = os.path.join(DIST_DIR, filename)
+        if not os.path.isfile(path):
+            abort(404)
+
+        served, encoding = filename, None
+        for ext, name in (('.br', 'br'), ('.gz', 'gzip')):
+            # Parsed tokens, so "br;q=0" refuses brotli rather than matching as a substring
+            if request.accept_encodings.quality(name) > 0 and os.path.isfile(path + ext):
+                served, encoding = filename + ext, name
+                break
+
+        mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+        response = send_from_directory(DIST_DIR, served, mimetype=mimetype,
+                                       max_age=IMMUTABLE_MAX_AGE, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        return response
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    built = build_assets()
+    print(f"Built {len(built)} assets into {DIST_DIR}" + ("" if brotli else " (install brotli for .br variants)"))
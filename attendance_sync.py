@@ -0,0 +1,158 @@
+"""Idempotent batch sync for attendance queued offline on tutors' phones.
+
+Every queued class carries a client_key generated in the browser when it was
+recorded, and with it the class date. uq_attendance_client_key_date makes
+(client_key, date_recorded) unique, which a table partitioned by month can
+enforce, so a batch resent after a lost response, or a form posted twice, never
+records the same class again; existing keys are looked up before writing. A batch
+is validated as a whole, checked for double-booking against the database and
+itself (overlaps.BatchChecker), and written in one transaction. Each record
+comes back as created, duplicate (already stored, with its id) or rejected with
+the reason, so the client can drop everything but network failures from its
+queue. Only a batch that is not a list of at most MAX_BATCH records is refused
+as a whole (ValueError); a malformed element is rejected on its own.
+"""
+import os
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Attendance, Student, Tutor, Subject
+from overlaps import BatchChecker, lock_schedules, validate_class_times
+
+CREATED, DUPLICATE, REJECTED = 'created', 'duplicate', 'rejected'
+
+MAX_BATCH = int(os.environ.get('ATTENDANCE_SYNC_MAX_BATCH', 200))
+CLIENT_KEY_LENGTH = 64
+
+
+def parse_record(data):
+    """A queued record ({client_key, student_id, tutor_id, subject, date, start_time, end_time, rating,
+    remarks}, as the attendance form posts them) as Attendance column values"""
+    if not isinstance(data, dict):
+        raise ValueError('Each record must be an object')
+    client_key = str(data.get('client_key') or '').strip()
+    if not client_key or len(client_key) > CLIENT_KEY_LENGTH:
+        raise ValueError('A client key of at most 64 characters is required')
+    try:
+        start_time = datetime.strptime(f"{data['date']} {data['start_time']}", '%Y-%m-%d %H:%M')
+        end_time = datetime.strptime(f"{data['date']} {data['end_time']}", '%Y-%m-%d %H:%M')
+        student_id, tutor_id, rating = int(data['student_id']), int(data['tutor_id']), int(data['rating'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Student, tutor, date, start and end time and rating are required')
+    validate_class_times(start_time, end_time)
+    if not 1 <= rating <= 10:
+        raise ValueError('Rating must be between 1 and 10')
+    subject = ' '.join(str(data.get('subject') or '').split())
+    if not subject:
+        raise ValueError('Subject is required')
+    return {'client_key': client_key, 'student_id': student_id, 'tutor_id': tutor_id, 'subject': subject,
+            'start_time': start_time, 'end_time': end_time, 'rating': rating,
+            'remarks': str(data.get('remarks') or '')}
+
+
+def find_recorded(client_keys):
+    """{client_key: attendance id} for keys that are already stored"""
+    if not client_keys:
+        return {}
+    return dict(db.session.execute(
+        db.select(Attendance.client_key, Attendance.id).where(Attendance.client_key.in_(client_keys))
+    ).all())
+
+
+def sync_attendance(records, tutor_id=None, student_ids=None):
+    """Store a batch of queued records; returns one result dict per record, in order.
+
+    tutor_id and student_ids restrict the batch to one tutor's assigned students.
+    Commits, retrying once if a concurrent sync stored some of the same keys first.
+    """
+    if len(records) > MAX_BATCH:
+        raise ValueError(f'At most {MAX_BATCH} records can be synced at once')
+    try:
+        return _sync(records, tutor_id, student_ids)
+    except IntegrityError:
+        db.session.rollback()
+        # The keys the other sync stored now come back as duplicates
+        return _sync(records, tutor_id, student_ids)
+
+
+def _sync(records, tutor_id, student_ids):
+    results = [None] * len(records)
+    parsed = {}  # position -> column values
+    positions = {}  # client_key -> first position
+    repeats = {}  # position -> first position with the same key
+    for i, data in enumerate(records):
+        key = str(data.get('client_key') or '') if isinstance(data, dict) else ''
+        try:
+            values = parse_record(data)
+        except ValueError as e:
+            results[i] = {'client_key': key, 'status': REJECTED, 'message': str(e)}
+            continue
+        if values['client_key'] in positions:
+            repeats[i] = positions[values['client_key']]
+            continue
+        positions[values['client_key']] = i
+        parsed[i] = values
+
+    recorded = find_recorded(list(positions))
+    known_students = set(db.session.execute(db.select(Student.id).where(
+        Student.id.in_({values['student_id'] for values in parsed.values()}))).scalars())
+    known_tutors = set(db.session.execute(db.select(Tutor.id).where(
+        Tutor.id.in_({values['tutor_id'] for values in parsed.values()}))).scalars())
+
+    accepted = []
+    for i, values in parsed.items():
+        message = None
+        if values['client_key'] in recorded:
+            results[i] = {'client_key': values['client_key'], 'status': DUPLICATE,
+                          'id': recorded[values['client_key']]}
+            continue
+        if values['student_id'] not in known_students or values['tutor_id'] not in known_tutors:
+            message = 'Unknown student or tutor'
+        elif tutor_id is not None and (values['tutor_id'] != tutor_id or values['student_id'] not in student_ids):
+            message = 'You can only record attendance for your assigned students'
+        if message:
+            results[i] = {'client_key': values['client_key'], 'status': REJECTED, 'message': message}
+        else:
+            accepted.append(i)
+
+    # Until the commit, no other submission can add a class for these tutors and students
+    lock_schedules({parsed[i]['tutor_id'] for i in accepted}, {parsed[i]['student_id'] for i in accepted})
+    checker = BatchChecker(parsed[i] for i in accepted)
+    new = []
+    for i in accepted:
+        values = parsed[i]
+        clashes = checker.check(values['tutor_id'], values['student_id'], values['start_time'], values['end_time'])
+        if clashes:
+            kinds = sorted({kind for kind, _ in clashes})
+            results[i] = {'client_key': values['client_key'], 'status': REJECTED,
+                          'message': f"This class overlaps another for the {' and '.join(kinds)}"}
+            continue
+        checker.add(values['tutor_id'], values['student_id'], values['start_time'], values['end_time'])
+        new.append(i)
+
+    if new:
+        subjects = {subject.name_key: subject for subject in Subject.intern([parsed[i]['subject'] for i in new])}
+        db.session.flush()
+        rows = {}
+        for i in new:
+            values = parsed[i]
+            subject = subjects[Subject.make_key(values['subject'])]
+            rows[i] = Attendance(
+                subject=subject.name,
+                subject_id=subject.id,
+                duration_minutes=int((values['end_time'] - values['start_time']).total_seconds() / 60),
+                date_recorded=values['start_time'].date(),
+                **{column: value for column, value in values.items() if column != 'subject'}
+            )
+        db.session.add_all(rows.values())
+        db.session.flush()
+        for i, row in rows.items():
+            results[i] = {'client_key': row.client_key, 'status': CREATED, 'id': row.id}
+    db.session.commit()
+    for i, first in repeats.items():
+        if results[first]['status'] == REJECTED:
+            results[i] = dict(results[first])
+        else:
+            results[i] = {'client_key': results[first]['client_key'], 'status': DUPLICATE,
+                          'id': results[first]['id']}
+    return results
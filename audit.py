@@ -0,0 +1,274 @@
+"""Audit log: who created, changed or deleted what, and named actions like password resets.
+
+Changes are captured in after_flush from the session's new, dirty and deleted
+objects and their attribute history, without touching the database. They are
+held on the session until it commits (a rollback drops them), then handed to an
+in-memory buffer that a background thread writes to audit_log in batches. For
+critical actions, in_transaction() writes the session's entries with the change
+itself, so neither can commit without the other.
+
+Bulk statements (Query.delete, Core inserts) are not seen by the session
+events; routes that use them call record() with the details.
+Run `python audit.py [--user NAME] [--entity TYPE [ID]]` to print recent entries.
+"""
+import os
+import json
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from sqlalchemy import event, inspect
+from flask import request, has_request_context
+from flask_login import current_user
+from app import app, db
+from models import AuditLog
+from db_routing import current_branch, branch_context
+
+CREATE, UPDATE, DELETE = 'create', 'update', 'delete'
+
+# Housekeeping tables whose rows only mirror other changes
+SKIP_TABLES = {'audit_log', 'table_version', 'report_cube', 'report_dirty_period', 'document_sequence',
+               'account_balance', 'announcement_read', 'outbound_message'}
+# Never copied into the log; a password reset is recorded as its own action
+SKIP_COLUMNS = {'password_hash'}
+
+FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_SECONDS', 2))
+BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+# Entries kept while the database is unreachable; beyond this the oldest are dropped
+MAX_BUFFER = int(os.environ.get('AUDIT_MAX_BUFFER', 100000))
+
+_PENDING_KEY = 'audit_pending'
+_CRITICAL_KEY = 'audit_in_transaction'
+
+_buffer = deque()
+_wake = threading.Event()
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def _forget_buffer():
+    # A forked child (billing workers) writes only its own entries; the parent still holds its buffer
+    global _wake, _writer, _writer_pid, _writer_lock
+    _buffer.clear()
+    _wake = threading.Event()
+    _writer, _writer_pid = None, None
+    _writer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_buffer)
+
+
+def init_audit(session_class):
+    """Capture every flush and hand committed entries to the background writer"""
+    event.listen(session_class, 'after_flush', _capture)
+    event.listen(session_class, 'after_commit', _after_commit)
+    event.listen(session_class, 'after_soft_rollback', _after_rollback)
+    atexit.register(_flush_at_exit)
+
+
+def _actor():
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id, current_user.username, request.endpoint
+    return None, None, request.endpoint if has_request_context() else None
+
+
+def _entry(action, entity_type, entity_id, changes):
+    user_id, username, endpoint = _actor()
+    return {'created_at': datetime.utcnow(), 'user_id': user_id, 'username': username, 'action': action,
+            'entity_type': entity_type, 'entity_id': None if entity_id is None else str(entity_id),
+            'changes': changes, 'endpoint': endpoint, 'branch': current_branch()}
+
+
+def _changes(state, action):
+    """{column: [old, new]} for an update, else the row's loaded values; never loads anything"""
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in SKIP_COLUMNS:
+            continue
+        if action == UPDATE:
+            history = state.attrs[attr.key].history
+            if history.added or history.deleted:
+                changes[attr.key] = [history.deleted[0] if history.deleted else None,
+                                     history.added[0] if history.added else None]
+        elif state.dict.get(attr.key) is not None:
+            changes[attr.key] = state.dict[attr.key]
+    return changes
+
+
+def _capture(session, flush_context):
+    entries = []
+    for action, objects in ((CREATE, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+        for obj in objects:
+            state = inspect(obj)
+            table = state.mapper.local_table.name
+            if table in SKIP_TABLES:
+                continue
+            changes = _changes(state, action)
+            if action == UPDATE and not changes:
+                continue  # only relationships or unchanged values were touched
+            # New rows get their identity key after this hook, but their primary key is already set
+            key = [state.dict.get(state.mapper.get_property_by_column(column).key)
+                   for column in state.mapper.primary_key]
+            entries.append(_entry(action, table, '/'.join(str(part) for part in key), changes))
+    if entries:
+        _hold(session, entries)
+
+
+def _hold(session, entries):
+    if session.info.get(_CRITICAL_KEY):
+        session.execute(AuditLog.__table__.insert(), [_row(entry) for entry in entries])
+    else:
+        session.info.setdefault(_PENDING_KEY, []).extend(entries)
+
+
+def _after_commit(session):
+    session.info.pop(_CRITICAL_KEY, None)
+    entries = session.info.pop(_PENDING_KEY, None)
+    if entries:
+        _enqueue(entries)
+
+
+def _after_rollback(session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop(_CRITICAL_KEY, None)
+    session.info.pop(_PENDING_KEY, None)
+
+
+def record(action, entity_type=None, entity_id=None, details=None, critical=False):
+    """Log a named action in the current transaction's entries.
+
+    critical=True writes it (and every change captured later in this
+    transaction) with the transaction, instead of in the next batch.
+    """
+    if critical:
+        in_transaction()
+    _hold(db.session, [_entry(action, entity_type, entity_id, details or {})])
+
+
+def in_transaction():
+    """Write this transaction's audit entries inside it, for actions that must never go unlogged"""
+    session = db.session()
+    session.info[_CRITICAL_KEY] = True
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        _hold(session, pending)
+
+
+def _row(entry):
+    row = {key: value for key, value in entry.items() if key != 'branch'}
+    row['changes'] = json.dumps(entry['changes'], default=str) if entry['changes'] else None
+    return row
+
+
+def _enqueue(entries):
+    _buffer.extend(entries)
+    while len(_buffer) > MAX_BUFFER:
+        _buffer.popleft()
+        logging.error("Audit buffer full; dropped the oldest entry")
+    _start_writer()
+    if len(_buffer) >= BATCH_SIZE:
+        _wake.set()
+
+
+def _start_writer():
+    global _writer, _writer_pid
+    if _writer is not None and _writer_pid == os.getpid() and _writer.is_alive():
+        return
+    with _writer_lock:
+        # Forked workers inherit the variable but not the thread
+        if _writer is None or _writer_pid != os.getpid() or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_loop, name='audit-writer', daemon=True)
+            _writer_pid = os.getpid()
+            _writer.start()
+
+
+def _write_loop():
+    while True:
+        _wake.wait(FLUSH_INTERVAL)
+        _wake.clear()
+        try:
+            flush_audit()
+        except Exception as e:
+            logging.error(f"Error writing audit log: {str(e)}")
+
+
+def flush_audit():
+    """Write every buffered entry now, one batch insert per branch; returns how many were written"""
+    written = 0
+    while _buffer:
+        batch = []
+        while _buffer and len(batch) < BATCH_SIZE:
+            batch.append(_buffer.popleft())
+        by_branch = {}
+        for entry in batch:
+            by_branch.setdefault(entry['branch'], []).append(entry)
+        groups = list(by_branch.items())
+        with app.app_context():
+            for i, (branch, entries) in enumerate(groups):
+                with branch_context(branch):
+                    try:
+                        db.session.execute(AuditLog.__table__.insert(), [_row(entry) for entry in entries])
+                        db.session.commit()
+                        written += len(entries)
+                    except Exception:
+                        db.session.rollback()
+                        # Keep what was not written for the next round rather than lose the trail
+                        _buffer.extendleft(reversed([entry for _, rest in groups[i:] for entry in rest]))
+                        raise
+                    finally:
+                        db.session.remove()
+    return written
+
+
+def _flush_at_exit():
+    try:
+        flush_audit()
+    except Exception as e:
+        logging.error(f"Error writing audit log at exit: {str(e)}")
+
+
+def search_audit(user=None, entity_type=None, entity_id=None, action=None, start=None, end=None,
+                 before=None, limit=100):
+    """Newest entries first, filtered by actor (id or username), entity, action and time range.
+
+    before=(created_at, id) of the last entry shown continues from there.
+    """
+    query = AuditLog.query
+    if user:
+        query = query.filter(AuditLog.user_id == int(user) if str(user).isdigit() else AuditLog.username == user)
+    if entity_type:
+        query = query.filter(AuditLog.entity_type == entity_type)
+    if entity_id:
+        query = query.filter(AuditLog.entity_id == str(entity_id))
+    if action:
+        query = query.filter(AuditLog.action == action)
+    if start:
+        query = query.filter(AuditLog.created_at >= start)
+    if end:
+        query = query.filter(AuditLog.created_at < end)
+    if before:
+        created_at, entry_id = before
+        query = query.filter(db.or_(AuditLog.created_at < created_at,
+                                    db.and_(AuditLog.created_at == created_at, AuditLog.id < entry_id)))
+    return query.order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(limit).all()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print recent audit log entries")
+    parser.add_argument('--user', help="actor's username or user id")
+    parser.add_argument('--entity', nargs='+', metavar=('TYPE', 'ID'), help="table name and optionally row id")
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+    entity = args.entity or []
+
+    with app.app_context():
+        entries = search_audit(user=args.user, entity_type=entity[0] if entity else None,
+                               entity_id=entity[1] if len(entity) > 1 else None, limit=args.limit)
+    for entry in entries:
+        print(f"{entry.created_at:%Y-%m-%d %H:%M:%S} {entry.username or 'system'} {entry.action} "
+              f"{entry.entity_type or ''} {entry.entity_id or ''} {entry.changes or ''}")
@@ -0,0 +1,89 @@
+"""Compare the PDF backends on render time, memory and output size.
+
+Each backend runs in its own process on sample invoices and receipts, so
+memory figures are not shared between them. No database is needed.
+
+Usage: python benchmark_pdf.py [--count 50] [--students 12] [--backends weasyprint direct]
+"""
+import time
+import argparse
+import resource
+import tracemalloc
+import multiprocessing
+from types import SimpleNamespace
+from datetime import date, datetime
+
+PAYMENT = {'gpay_number': '7994829844', 'upi_id': 'mentorscue@upi', 'contact_mobile': '8921378863'}
+
+
+def sample_context(kind, students):
+    period = {'start_date': date(2025, 6, 1), 'end_date': date(2025, 6, 30), 'generated_at': datetime(2025, 7, 1)}
+    if kind == 'student_invoice':
+        student = SimpleNamespace(full_name='Ananya Krishnan', class_level='Class 9', subjects='Mathematics, Physics',
+                                  parent_name='Lakshmi Krishnan', parent_whatsapp='+91 98470 12345',
+                                  per_class_fee=450.0)
+        invoice = SimpleNamespace(invoice_number='MC-INV-2025-06-0042', total_classes=12, total_amount=5400.0,
+                                  **period)
+        return {'invoice': invoice, 'student': student, 'payment': PAYMENT}
+    tutor = SimpleNamespace(full_name='Asha Menon', mobile='9000100001', upi_id='asha@oksbi')
+    summary = {i: {'name': f'Student {i + 1}', 'classes': 8, 'pay_rate': 300.0, 'total_earning': 2400.0}
+               for i in range(students)}
+    receipt = SimpleNamespace(receipt_number='MC-REC-2025-06-0007', total_classes=8 * students,
+                              total_earnings=2400.0 * students, **period)
+    return {'receipt': receipt, 'tutor': tutor, 'student_summary': summary, 'payment': PAYMENT}
+
+
+def measure(backend_name, kind, count, students, results):
+    try:
+        from pdf_generator import BACKENDS
+        backend = BACKENDS[backend_name]
+        context = sample_context(kind, students)
+        backend.render(kind, context)  # compile templates, load fonts
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        started = time.perf_counter()
+        for _ in range(count):
+            pdf = backend.render(kind, context)
+        elapsed = time.perf_counter() - started
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        tracemalloc.start()
+        backend.render(kind, context)
+        _, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # ru_maxrss is in KiB on Linux
+        results.put((backend_name, kind, elapsed / count * 1000, peak_rss / 1024, (peak_rss - baseline) / 1024,
+                     python_peak / 1024, len(pdf), None))
+    except Exception as e:
+        results.put((backend_name, kind, None, None, None, None, None, str(e).splitlines()[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=50, help="documents rendered per backend and type")
+    parser.add_argument("--students", type=int, default=12, help="rows on each tutor receipt")
+    parser.add_argument("--backends", nargs="+", default=["weasyprint", "direct"])
+    parser.add_argument("--kinds", nargs="+", default=["student_invoice", "tutor_receipt"])
+    args = parser.parse_args()
+
+    print(f"{args.count} documents each, {args.students} rows per receipt")
+    print(f"{'backend':<12}{'document':<17}{'ms/doc':>9}{'docs/s':>9}{'RSS MiB':>9}{'+MiB':>7}{'py KiB':>9}{'KiB':>8}")
+    results = multiprocessing.Queue()
+    for kind in args.kinds:
+        for name in args.backends:
+            runner = multiprocessing.Process(target=measure, args=(name, kind, args.count, args.students, results))
+            runner.start()
+            runner.join()
+            if runner.exitcode != 0 and results.empty():
+                print(f"{name:<12}{kind:<17}crashed (exit code {runner.exitcode})")
+                continue
+            name, kind, ms, rss, growth, python_peak, size, error = results.get()
+            if error:
+                print(f"{name:<12}{kind:<17}unavailable: {error}")
+                continue
+            print(f"{name:<12}{kind:<17}{ms:>9.1f}{1000 / ms:>9.0f}{rss:>9.1f}{growth:>7.1f}"
+                  f"{python_peak:>9.0f}{size / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
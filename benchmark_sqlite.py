@@ -0,0 +1,118 @@
+"""Compare SQLite read/write throughput with and without the tuned profile.
+
+Usage: python benchmark_sqlite.py [--workers 8] [--seconds 5] [--write-ratio 0.2] [--processes]
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from sqlite_profile import sqlite_engine_options, apply_sqlite_profile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attendance (
+    id INTEGER PRIMARY KEY,
+    student_id INTEGER NOT NULL,
+    tutor_id INTEGER NOT NULL,
+    subject VARCHAR(100) NOT NULL,
+    start_time DATETIME NOT NULL,
+    duration_minutes INTEGER NOT NULL
+)
+"""
+
+
+def make_engine(path, tuned):
+    url = f"sqlite:///{path}"
+    if tuned:
+        return apply_sqlite_profile(create_engine(url, **sqlite_engine_options()))
+    # The previous configuration: default journal, short driver timeout
+    return create_engine(url, pool_recycle=300, pool_pre_ping=True)
+
+
+def prepare(path, rows=5000):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text(SCHEMA))
+        conn.execute(
+            text("INSERT INTO attendance (student_id, tutor_id, subject, start_time, duration_minutes) "
+                 "VALUES (:s, :t, 'Mathematics', CURRENT_TIMESTAMP, 60)"),
+            [{"s": i % 200, "t": i % 30} for i in range(rows)]
+        )
+    engine.dispose()
+
+
+def worker(path, tuned, seconds, write_ratio, results):
+    engine = make_engine(path, tuned)
+    reads = writes = errors = 0
+    deadline = time.perf_counter() + seconds
+    rng = random.Random()
+    while time.perf_counter() < deadline:
+        try:
+            with engine.connect() as conn:
+                if rng.random() < write_ratio:
+                    # A short read-then-write transaction like an attendance submit
+                    conn.execute(text("SELECT id FROM attendance WHERE tutor_id = :t LIMIT 1"),
+                                 {"t": rng.randrange(30)}).fetchall()
+                    conn.execute(
+                        text("INSERT INTO attendance (student_id, tutor_id, subject, start_time, duration_minutes) "
+                             "VALUES (:s, :t, 'Physics', CURRENT_TIMESTAMP, 45)"),
+                        {"s": rng.randrange(200), "t": rng.randrange(30)}
+                    )
+                    conn.commit()
+                    writes += 1
+                else:
+                    conn.execute(text("SELECT COUNT(*) FROM attendance WHERE student_id = :s"),
+                                 {"s": rng.randrange(200)}).scalar()
+                    reads += 1
+        except OperationalError:
+            errors += 1
+    engine.dispose()
+    results.append((reads, writes, errors))
+
+
+def run(tuned, workers, seconds, write_ratio, use_processes):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        prepare(path)
+        if use_processes:
+            manager = multiprocessing.Manager()
+            results = manager.list()
+            runners = [multiprocessing.Process(target=worker, args=(path, tuned, seconds, write_ratio, results))
+                       for _ in range(workers)]
+        else:
+            results = []
+            runners = [threading.Thread(target=worker, args=(path, tuned, seconds, write_ratio, results))
+                       for _ in range(workers)]
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+        reads = sum(r[0] for r in results)
+        writes = sum(r[1] for r in results)
+        errors = sum(r[2] for r in results)
+    return reads / seconds, writes / seconds, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--processes", action="store_true", help="use worker processes instead of threads")
+    args = parser.parse_args()
+
+    kind = "processes" if args.processes else "threads"
+    print(f"{args.workers} {kind}, {args.seconds}s, write ratio {args.write_ratio}")
+    print(f"{'profile':<10}{'reads/s':>12}{'writes/s':>12}{'errors':>10}")
+    for label, tuned in (("default", False), ("tuned", True)):
+        reads, writes, errors = run(tuned, args.workers, args.seconds, args.write_ratio, args.processes)
+        print(f"{label:<10}{reads:>12.0f}{writes:>12.0f}{errors:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Billing runs: student invoices and tutor salary receipts for cycles that have ended.
+
+Active students and tutors are split into id-range shards that are billed in
+parallel worker processes. Each document's billing period is unique in the
+database and rows are written with INSERT ... ON CONFLICT DO NOTHING, so
+overlapping or repeated runs are idempotent: a period is only ever billed once.
+Document numbers are reserved in blocks up front (numbering.py), so each shard
+writes all of its documents in one bulk INSERT.
+
+Run `python billing.py [--processes N] [--shard-size 500]` from a scheduler.
+"""
+import os
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import inspect
+from app import app, db
+from models import Student, Tutor, StudentInvoice, TutorReceipt, Attendance, student_tutors, insert_ignore
+from ledger import record_charges
+from numbering import INVOICE, RECEIPT, next_numbers
+from reports import refresh_after_commit
+from db_routing import current_branch, branch_context
+from audit import flush_audit
+
+STUDENT, TUTOR = 'student', 'tutor'
+
+# Students/tutors per shard; each shard is billed in one transaction
+SHARD_SIZE = int(os.environ.get('BILLING_SHARD_SIZE', 500))
+
+# (database, table) pairs known to have the unique billing-period index
+_guarded_tables = set()
+
+
+def bill_students(lo, hi, today):
+    """Invoice active students with lo <= id < hi whose billing cycle has ended"""
+    students = [student for student in Student.query.filter(
+        Student.status == 'Active', Student.id >= lo, Student.id < hi
+    ) if student.get_next_billing_date() <= today]
+    if not students:
+        return 0, 0
+
+    periods = _unbilled(StudentInvoice, StudentInvoice.student_id, {
+        s.id: (s.billing_start_date, s.get_next_billing_date() - timedelta(days=1)) for s in students
+    })
+    already_billed = len(students) - len(periods)
+    students = [student for student in students if student.id in periods]
+    if not students:
+        return 0, already_billed
+    classes = defaultdict(int)
+    for student_id, day in _classes_in_periods(Attendance.student_id, periods):
+        classes[student_id] += 1
+
+    now = datetime.utcnow()
+    rows = []
+    for student, number in zip(students, next_numbers(INVOICE, len(students), now)):
+        start_date, end_date = periods[student.id]
+        rows.append({
+            'student_id': student.id, 'invoice_number': number,
+            'start_date': start_date, 'end_date': end_date,
+            'total_classes': classes[student.id], 'total_amount': classes[student.id] * student.per_class_fee,
+            'status': 'Due', 'amount_paid': 0.0, 'generated_at': now,
+        })
+    return _insert_documents(StudentInvoice, Student, rows, periods, already_billed)
+
+
+def bill_tutors(lo, hi, today):
+    """Create salary receipts for active tutors with lo <= id < hi whose payment cycle has ended"""
+    tutors = [tutor for tutor in Tutor.query.filter(
+        Tutor.status == 'Active', Tutor.id >= lo, Tutor.id < hi
+    ) if tutor.get_next_payment_date() <= today]
+    if not tutors:
+        return 0, 0
+
+    periods = _unbilled(TutorReceipt, TutorReceipt.tutor_id, {
+        t.id: (t.billing_start_date, t.get_next_payment_date() - timedelta(days=1)) for t in tutors
+    })
+    already_billed = len(tutors) - len(periods)
+    tutors = [tutor for tutor in tutors if tutor.id in periods]
+    if not tutors:
+        return 0, already_billed
+    classes, earnings = defaultdict(int), defaultdict(float)
+    pay_rate = db.func.coalesce(student_tutors.c.pay_per_class, 0.0)
+    for tutor_id, day, rate in _classes_in_periods(Attendance.tutor_id, periods, pay_rate):
+        classes[tutor_id] += 1
+        earnings[tutor_id] += rate
+
+    now = datetime.utcnow()
+    rows = []
+    for tutor, number in zip(tutors, next_numbers(RECEIPT, len(tutors), now)):
+        start_date, end_date = periods[tutor.id]
+        rows.append({
+            'tutor_id': tutor.id, 'receipt_number': number,
+            'start_date': start_date, 'end_date': end_date,
+            'total_classes': classes[tutor.id], 'total_earnings': earnings[tutor.id],
+            'status': 'Due', 'generated_at': now,
+        })
+    return _insert_documents(TutorReceipt, Tutor, rows, periods, already_billed)
+
+
+def _unbilled(model, owner_column, periods):
+    """Drop periods that already have a document, so numbers aren't reserved for them"""
+    billed = db.session.execute(
+        db.select(owner_column, model.start_date, model.end_date).where(owner_column.in_(list(periods)))
+    ).all()
+    billed = set(map(tuple, billed))
+    return {owner_id: period for owner_id, period in periods.items() if (owner_id, *period) not in billed}
+
+
+def _classes_in_periods(owner_column, periods, *columns):
+    """Yield (owner_id, date, *columns) for attendance inside each owner's billing period"""
+    query = db.select(owner_column, Attendance.date_recorded, *columns).where(
+        owner_column.in_(list(periods)),
+        Attendance.date_recorded >= min(start for start, _ in periods.values()),
+        Attendance.date_recorded <= max(end for _, end in periods.values())
+    )
+    if columns:
+        query = query.outerjoin(student_tutors, db.and_(
+            student_tutors.c.student_id == Attendance.student_id,
+            student_tutors.c.tutor_id == Attendance.tutor_id
+        ))
+    for row in db.session.execute(query):
+        start_date, end_date = periods[row[0]]
+        if start_date <= row[1] <= end_date:
+            yield tuple(row)
+
+
+def _insert_documents(model, owner, rows, periods, already_billed=0):
+    """Insert-or-skip the documents, then ledger and advance the cycle for those actually created"""
+    owner_key = 'student_id' if model is StudentInvoice else 'tutor_id'
+    if _has_period_index(model, owner_key):
+        # Only a clash on the billing period means "already billed"; anything else still raises
+        statement = insert_ignore(model, owner_key, 'start_date', 'end_date').returning(model)
+    else:
+        # ON CONFLICT needs the index as its target. Without it (duplicates left over from
+        # before it existed, see migrate_billing_periods) fall back to the periods _unbilled
+        # found free in this transaction; overlapping runs are not guarded then.
+        logging.warning(f"{model.__tablename__} has no unique billing-period index; "
+                        f"remove the double-billed periods so concurrent runs cannot bill twice")
+        statement = db.insert(model).returning(model)
+    documents = db.session.scalars(statement, rows).all()
+    if documents:
+        record_charges(documents)
+        # Compare-and-set, so a concurrent run can never move a cycle twice
+        table = owner.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == db.bindparam('b_id'), table.c.billing_start_date == db.bindparam('b_start'))
+            .values(billing_start_date=db.bindparam('b_next')),
+            [{'b_id': getattr(document, owner_key),
+              'b_start': periods[getattr(document, owner_key)][0],
+              'b_next': periods[getattr(document, owner_key)][1] + timedelta(days=1)} for document in documents]
+        )
+    db.session.commit()
+    return len(documents), already_billed + len(rows) - len(documents)
+
+
+def _has_period_index(model, owner_key):
+    """Whether the live table has the unique (owner, start_date, end_date) index ON CONFLICT targets"""
+    key = (str(db.session.get_bind().url), model.__tablename__)
+    if key in _guarded_tables:
+        return True
+    columns = [owner_key, 'start_date', 'end_date']
+    inspector = inspect(db.session.connection())
+    if any(index['unique'] and index['column_names'] == columns
+           for index in inspector.get_indexes(model.__tablename__)) or \
+            any(constraint['column_names'] == columns
+                for constraint in inspector.get_unique_constraints(model.__tablename__)):
+        _guarded_tables.add(key)
+        return True
+    return False
+
+
+def _shards(model, size):
+    lo, hi = db.session.execute(
+        db.select(db.func.min(model.id), db.func.max(model.id)).where(model.status == 'Active')
+    ).one()
+    if lo is None:
+        return []
+    return [(start, start + size) for start in range(lo, hi + 1, size)]
+
+
+def _bill_shard(kind, lo, hi, today):
+    try:
+        return (bill_students if kind == STUDENT else bill_tutors)(lo, hi, today)
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Billing {kind}s {lo}-{hi - 1} failed: {str(e)}")
+        return None
+
+
+def _init_worker():
+    # Forked workers must not share the parent's pooled connections
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def _run_shard_in_worker(kind, lo, hi, today, branch):
+    with app.app_context(), branch_context(branch):
+        try:
+            return _bill_shard(kind, lo, hi, today)
+        finally:
+            db.session.remove()
+            # Pool workers never run atexit hooks, so the shard's audit entries are written before it returns
+            try:
+                flush_audit()
+            except Exception as e:
+                logging.error(f"Error writing audit log for {kind}s {lo}-{hi - 1}: {str(e)}")
+
+
+def run_billing(processes=None, shard_size=SHARD_SIZE, today=None):
+    """Bill every due student and tutor, sharded by id range across a process pool.
+
+    processes=1 bills in the calling process (e.g. inside a request).
+    Returns {'student': {...}, 'tutor': {...}} with created/skipped/failed counts.
+    """
+    today = today or datetime.utcnow().date()
+    shards = [(STUDENT, lo, hi) for lo, hi in _shards(Student, shard_size)] + \
+             [(TUTOR, lo, hi) for lo, hi in _shards(Tutor, shard_size)]
+    processes = min(processes or os.cpu_count() or 1, len(shards) or 1)
+
+    if processes == 1:
+        results = [_bill_shard(kind, lo, hi, today) for kind, lo, hi in shards]
+    else:
+        db.session.commit()  # don't carry an open transaction into forked workers
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as pool:
+            futures = [pool.submit(_run_shard_in_worker, kind, lo, hi, today, current_branch())
+                       for kind, lo, hi in shards]
+            results = [future.result() for future in futures]
+
+    summary = {kind: {'created': 0, 'skipped': 0, 'failed_shards': 0} for kind in (STUDENT, TUTOR)}
+    for (kind, _, _), result in zip(shards, results):
+        if result is None:
+            summary[kind]['failed_shards'] += 1
+        else:
+            summary[kind]['created'] += result[0]
+            summary[kind]['skipped'] += result[1]
+    logging.info(f"Billing run over {len(shards)} shard(s) with {processes} process(es): {summary}")
+    refresh_after_commit('billing')
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate due student invoices and tutor receipts")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help="students/tutors per shard")
+    args = parser.parse_args()
+
+    with app.app_context():
+        result = run_billing(processes=args.processes, shard_size=args.shard_size)
+    for kind, counts in result.items():
+        print(f"{kind}: {counts['created']} created, {counts['skipped']} already billed"
+              + (f", {counts['failed_shards']} shard(s) failed" if counts['failed_shards'] else ""))
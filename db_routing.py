@@ -0,0 +1,164 @@
+import os
+import time
+import random
+import logging
+from contextlib import contextmanager
+import sqlalchemy as sa
+from sqlalchemy.sql.util import find_tables
+from flask import g, request, session, has_request_context, has_app_context
+from flask_sqlalchemy.session import Session
+
+# Bind keys for read replicas are named replica_0, replica_1, ...
+REPLICA_BIND_PREFIX = 'replica_'
+
+# Bind keys for branch databases are named branch_<name>
+BRANCH_BIND_PREFIX = 'branch_'
+
+# The user directory: always kept in the default database, whichever branch is open
+SHARED_TABLES = frozenset({'user', 'role', 'user_roles', 'user_branch'})
+
+# After a user writes, keep their reads on the primary for this long to hide replica lag
+PRIMARY_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 15))
+
+
+def replica_binds_from_env():
+    """Build SQLALCHEMY_BINDS entries from the comma-separated REPLICA_DATABASE_URLS"""
+    urls = [url.strip() for url in os.environ.get('REPLICA_DATABASE_URLS', '').split(',') if url.strip()]
+    return {f'{REPLICA_BIND_PREFIX}{i}': url for i, url in enumerate(urls)}
+
+
+def branch_binds_from_env():
+    """Build SQLALCHEMY_BINDS entries from BRANCH_DATABASE_URLS, comma-separated name=url pairs"""
+    binds = {}
+    for pair in os.environ.get('BRANCH_DATABASE_URLS', '').split(','):
+        if not pair.strip():
+            continue
+        name, _, url = pair.partition('=')
+        if not name.strip() or not url.strip():
+            raise ValueError(f"BRANCH_DATABASE_URLS entries must look like name=url, got '{pair.strip()}'")
+        binds[f'{BRANCH_BIND_PREFIX}{name.strip().lower()}'] = url.strip()
+    return binds
+
+
+def current_branch():
+    """The branch whose database is in use, or None for the default database.
+
+    Requests set it from their host or path; scripts and workers use
+    MENTORSCUE_BRANCH or branch_context().
+    """
+    if has_app_context() and 'branch' in g:
+        return g.branch
+    return os.environ.get('MENTORSCUE_BRANCH') or None
+
+
+@contextmanager
+def branch_context(branch):
+    """Work on one branch's database inside the current app context"""
+    had_branch, previous = 'branch' in g, g.get('branch')
+    g.branch = branch
+    try:
+        yield
+    finally:
+        if had_branch:
+            g.branch = previous
+        else:
+            g.pop('branch', None)
+
+
+def read_only(f):
+    """Mark a view as read-only so its queries may be served by a replica"""
+    f._db_read_only = True
+    return f
+
+
+def primary_only(f):
+    """Mark a view that must always read from the primary"""
+    f._db_primary_only = True
+    return f
+
+
+class RoutingSession(Session):
+    """Session that sends branch data to the branch's database and reads to a replica when allowed"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or engine is not self._db.engines.get(None):
+            return engine
+        branch = current_branch()
+        if branch and not _uses_shared_tables(mapper, clause):
+            try:
+                return self._db.engines[f'{BRANCH_BIND_PREFIX}{branch}']
+            except KeyError:
+                raise LookupError(f"Unknown branch '{branch}'") from None
+        # Without a statement the caller wants a connection to write with (e.g. migrations)
+        if clause is None or isinstance(clause, sa.UpdateBase) or not self._replica_allowed():
+            return engine
+        return _pick_replica(self._db.engines) or engine
+
+    def _replica_allowed(self):
+        if not has_request_context() or not g.get('db_use_replica'):
+            return False
+        if g.get('db_wrote') or self._flushing or self.new or self.dirty or self.deleted:
+            return False
+        return True
+
+
+def _uses_shared_tables(mapper, clause):
+    """Whether a statement only touches the user directory"""
+    tables = {table.name for table in find_tables(clause, include_crud=True)} if clause is not None else set()
+    if not tables and mapper is not None:
+        tables = {table.name for table in mapper.tables}
+    return bool(tables) and tables <= SHARED_TABLES
+
+
+def _pick_replica(engines):
+    replicas = [engine for key, engine in engines.items()
+                if key and key.startswith(REPLICA_BIND_PREFIX)]
+    return random.choice(replicas) if replicas else None
+
+
+def _mark_write(*args, **kwargs):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _mark_orm_write(orm_execute_state):
+    state = orm_execute_state
+    if state.is_insert or state.is_update or state.is_delete:
+        _mark_write()
+    elif isinstance(state.statement, sa.TextClause) and \
+            str(state.statement).lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+        _mark_write()
+
+
+def init_db_routing(app):
+    """Register the request hooks that decide between primary and replica"""
+    if not any(key and key.startswith(REPLICA_BIND_PREFIX) for key in app.config.get('SQLALCHEMY_BINDS', {})):
+        return
+
+    from flask_login import current_user
+
+    sa.event.listen(RoutingSession, 'after_flush', _mark_write)
+    sa.event.listen(RoutingSession, 'do_orm_execute', _mark_orm_write)
+
+    @app.before_request
+    def choose_database():
+        g.db_use_replica = False
+        view = app.view_functions.get(request.endpoint)
+        if view is None or getattr(view, '_db_primary_only', False):
+            return
+        if session.get('_primary_until', 0) > time.time():
+            return  # read-after-write: this user just changed something
+
+        if getattr(view, '_db_read_only', False):
+            g.db_use_replica = True
+        elif request.method in ('GET', 'HEAD') and current_user.is_authenticated and current_user.is_read_only():
+            g.db_use_replica = True
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get('db_wrote'):
+            session['_primary_until'] = time.time() + PRIMARY_STICKY_SECONDS
+        return response
+
+    logging.info(f"Read replicas enabled: {len(app.config['SQLALCHEMY_BINDS'])} bind(s)")
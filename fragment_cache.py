@@ -0,0 +1,158 @@
+"""Template fragment cache: {% cache %} blocks render once per role and data version.
+
+    {% cache "dashboard_stats", "student", "tutor", vary=today, ttl=600 %}
+        ... expensive HTML ...
+    {% endcache %}
+
+A block's HTML is kept under its name, the permission mask and role names of
+the current user, the branch and URL prefix, any vary= value, and the
+table_version counters of the tables listed after the name. Users with the
+same roles share the entry until one of those tables changes, ttl seconds
+pass (FRAGMENT_CACHE_TTL, default 300) or invalidate_fragment() is called.
+Nothing user-specific (names, ids) belongs inside a block unless it is in vary=.
+
+Entries live in this process, FRAGMENT_CACHE_SIZE at most (default 1000);
+FRAGMENT_CACHE=off renders every block each time. Render times and hit
+ratios per fragment are listed at /admin/cache.
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from flask import request, has_request_context
+from flask_login import current_user
+from versioning import on_tables_changed
+from db_routing import current_branch
+from query_cache import table_versions
+
+DEFAULT_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+MAX_ENTRIES = int(os.environ.get('FRAGMENT_CACHE_SIZE', 1000))
+ENABLED = os.environ.get('FRAGMENT_CACHE', 'on') != 'off'
+
+_OPTIONS = ('ttl', 'vary')
+
+_entries = OrderedDict()  # key -> (name, tables, expires_at, html)
+_generations = defaultdict(int)  # bumped by invalidate_fragment
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'render_ms': 0.0})
+_lock = threading.Lock()
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache name[, table...][, ttl=seconds][, vary=value] %}...{% endcache %}"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        tables, options = [], {}
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.type == 'name' and parser.stream.look().type == 'assign':
+                option = next(parser.stream).value
+                if option not in _OPTIONS:
+                    parser.fail(f"Unknown cache option '{option}'", lineno)
+                next(parser.stream)
+                options[option] = parser.parse_expression()
+            else:
+                tables.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        args = [name, nodes.List(tables)] + [options.get(option, nodes.Const(None)) for option in _OPTIONS]
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, tables, ttl, vary, caller):
+        return render_fragment(name, tables, caller, ttl=ttl, vary=vary)
+
+
+def permission_mask(user):
+    """(OR of the user's role permissions, role names): what templates branch on"""
+    if not user.is_authenticated:
+        return 0, ()
+    mask = 0
+    for role in user.roles:
+        mask |= role.permissions
+    return mask, tuple(sorted(role.name for role in user.roles))
+
+
+def _record(name, outcome, render_ms=0.0):
+    with _lock:
+        stats = _stats[name]
+        stats[outcome] += 1
+        stats['render_ms'] += render_ms
+
+
+def render_fragment(name, tables, render, ttl=None, vary=None):
+    """Cached HTML for a fragment, calling render() only when there is none"""
+    if not ENABLED or not has_request_context():
+        return render()
+    tables = frozenset(tables)
+    key = repr((name, _generations[name], permission_mask(current_user), current_branch(),
+                request.script_root, vary, table_versions(tables)))
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[2] > now:
+            _entries.move_to_end(key)
+            _stats[name]['hits'] += 1
+            return entry[3]
+
+    started = time.perf_counter()
+    html = Markup(render())
+    _record(name, 'misses', (time.perf_counter() - started) * 1000)
+    with _lock:
+        _entries[key] = (name, tables, now + (DEFAULT_TTL if ttl is None else ttl), html)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return html
+
+
+def invalidate_fragment(name=None):
+    """Drop a fragment's cached HTML everywhere it is used in this process, or every fragment's"""
+    with _lock:
+        if name is None:
+            _entries.clear()
+            _generations.clear()
+            return
+        _generations[name] += 1
+        for key in [key for key, entry in _entries.items() if entry[0] == name]:
+            del _entries[key]
+
+
+def _drop_tables(tables):
+    # Their versions already moved on; this only frees the stale entries sooner
+    tables = set(tables)
+    with _lock:
+        for key in [key for key, entry in _entries.items() if entry[1] & tables]:
+            del _entries[key]
+
+
+def init_fragment_cache(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    on_tables_changed(_drop_tables)
+    if ENABLED:
+        logging.info(f"Fragment cache enabled: {MAX_ENTRIES} entries, {DEFAULT_TTL}s")
+
+
+def clear_fragment_stats():
+    with _lock:
+        _stats.clear()
+
+
+def fragment_cache_stats():
+    """Hits, misses and render times per fragment in this process"""
+    with _lock:
+        fragments = {}
+        for name, stats in sorted(_stats.items()):
+            average = stats['render_ms'] / (stats['misses'] or 1)
+            fragments[name] = dict(stats, average_ms=average, saved_ms=average * stats['hits'],
+                                   ratio=stats['hits'] / ((stats['hits'] + stats['misses']) or 1))
+        entries = len(_entries)
+    hits = sum(stats['hits'] for stats in fragments.values())
+    misses = sum(stats['misses'] for stats in fragments.values())
+    return {'enabled': ENABLED, 'entries': entries, 'hits': hits, 'misses': misses,
+            'ratio': hits / ((hits + misses) or 1),
+            'saved_ms': sum(stats['saved_ms'] for stats in fragments.values()), 'fragments': fragments}
@@ -0,0 +1,275 @@
+"""Payment ledger and per-account balances.
+
+Every invoice/receipt is ledgered as a charge and every change to what has been
+paid as a payment (negative for reversals). AccountBalance rows carry the running
+totals plus the latest document, so dues and dashboards read one row per account.
+
+Run `python ledger.py` to check balances against the ledger, `--fix` to repair them.
+"""
+import logging
+from datetime import datetime
+from flask import has_request_context
+from flask_login import current_user
+from app import db
+from models import StudentInvoice, TutorReceipt, LedgerEntry, AccountBalance, insert_ignore
+from audit import in_transaction
+
+STUDENT, TUTOR = 'student', 'tutor'
+CHARGE, PAYMENT = 'charge', 'payment'
+
+_LATEST_FIELDS = ('latest_document_id', 'latest_document_at', 'latest_amount', 'latest_paid', 'latest_status')
+
+
+def account_of(document):
+    """(entity_type, entity_id) of the account an invoice or receipt belongs to"""
+    if isinstance(document, StudentInvoice):
+        return STUDENT, document.student_id
+    return TUTOR, document.tutor_id
+
+
+def document_amount(document):
+    return (document.total_amount if isinstance(document, StudentInvoice) else document.total_earnings) or 0.0
+
+
+def document_paid(document):
+    """How much of an invoice has been received, or of a receipt paid out"""
+    if isinstance(document, StudentInvoice):
+        return document.amount_paid or 0.0
+    return document_amount(document) if document.status == 'Paid' else 0.0
+
+
+def record_charge(document, note=None):
+    """Ledger a newly generated invoice/receipt and add it to the account balance"""
+    record_charges([document], note)
+
+
+def record_charges(documents, note=None):
+    """Ledger a batch of new invoices/receipts, updating balances with one executemany"""
+    if not documents:
+        return
+    now = datetime.utcnow()
+    params = []
+    for document in documents:
+        entity_type, entity_id = account_of(document)
+        amount = document_amount(document)
+        _append(entity_type, entity_id, CHARGE, document.id, amount, note)
+        params.append({
+            'b_type': entity_type, 'b_id': entity_id, 'b_amount': amount,
+            'b_document_id': document.id, 'b_document_at': document.generated_at or now,
+            'b_paid': document_paid(document), 'b_status': document.status or 'Due',
+        })
+    db.session.flush()
+    db.session.execute(insert_ignore(AccountBalance),
+                       [{'entity_type': p['b_type'], 'entity_id': p['b_id']} for p in params])
+
+    # Relative updates, so concurrent writers can't lose each other's amounts;
+    # the "latest document" fields only ever move forward.
+    table = AccountBalance.__table__
+    newer = db.or_(table.c.latest_document_at.is_(None),
+                   table.c.latest_document_at <= db.bindparam('b_document_at'))
+    latest = dict(zip(_LATEST_FIELDS, ('b_document_id', 'b_document_at', 'b_amount', 'b_paid', 'b_status')))
+    values = {field: db.case((newer, db.bindparam(param)), else_=table.c[field]) for field, param in latest.items()}
+    entity_id = db.bindparam('b_id')
+    values.update({
+        'total_charged': table.c.total_charged + db.bindparam('b_amount'),
+        'outstanding': table.c.outstanding + db.bindparam('b_amount'),
+        'oldest_unpaid_at': db.case((db.bindparam('b_type') == STUDENT, _unpaid_since(STUDENT, entity_id)),
+                                    else_=_unpaid_since(TUTOR, entity_id)),
+        'updated_at': now,
+    })
+    db.session.execute(
+        table.update()
+        .where(table.c.entity_type == db.bindparam('b_type'), table.c.entity_id == entity_id)
+        .values(values),
+        params
+    )
+
+
+def record_payment(document, amount_paid, status, note=None):
+    """Set how much of a document is settled, ledgering the difference as a payment"""
+    # Payments are audited in their own transaction, never left to the write-behind batch
+    in_transaction()
+    entity_type, entity_id = account_of(document)
+    delta = round((amount_paid or 0.0) - document_paid(document), 2)
+    if isinstance(document, StudentInvoice):
+        document.amount_paid = amount_paid
+    document.status = status
+    if delta:
+        _append(entity_type, entity_id, PAYMENT, document.id, delta, note)
+
+    is_latest = AccountBalance.latest_document_id == document.id
+    _update_account(entity_type, entity_id, {
+        AccountBalance.total_paid: AccountBalance.total_paid + delta,
+        AccountBalance.outstanding: AccountBalance.outstanding - delta,
+        AccountBalance.latest_paid: db.case((is_latest, amount_paid), else_=AccountBalance.latest_paid),
+        AccountBalance.latest_status: db.case((is_latest, status), else_=AccountBalance.latest_status),
+    })
+
+
+def _append(entity_type, entity_id, entry_type, document_id, amount, note=None):
+    recorded_by = None
+    if has_request_context() and current_user.is_authenticated:
+        recorded_by = current_user.id
+    db.session.add(LedgerEntry(entity_type=entity_type, entity_id=entity_id, entry_type=entry_type,
+                               document_id=document_id, amount=amount, note=note, recorded_by=recorded_by))
+
+
+def _unpaid_since(entity_type, entity_id):
+    """Subquery for when the account's oldest unsettled document was issued"""
+    if entity_type == STUDENT:
+        return db.select(db.func.min(StudentInvoice.generated_at)).where(
+            StudentInvoice.student_id == entity_id, StudentInvoice.status != 'Paid',
+            StudentInvoice.total_amount > 0
+        ).scalar_subquery()
+    return db.select(db.func.min(TutorReceipt.generated_at)).where(
+        TutorReceipt.tutor_id == entity_id, TutorReceipt.status != 'Paid',
+        TutorReceipt.total_earnings > 0
+    ).scalar_subquery()
+
+
+def _update_account(entity_type, entity_id, values):
+    # Relative updates in a single statement, so concurrent payments can't lose each other
+    db.session.flush()
+    db.session.execute(insert_ignore(AccountBalance).values(entity_type=entity_type, entity_id=entity_id))
+    values[AccountBalance.oldest_unpaid_at] = _unpaid_since(entity_type, entity_id)
+    values[AccountBalance.updated_at] = datetime.utcnow()
+    db.session.execute(
+        db.update(AccountBalance)
+        .where(AccountBalance.entity_type == entity_type, AccountBalance.entity_id == entity_id)
+        .values(values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def get_balance(entity_type, entity_id):
+    return db.session.get(AccountBalance, (entity_type, entity_id))
+
+
+def account_totals():
+    """{entity_type: (total_paid, outstanding)} summed over all accounts"""
+    rows = db.session.execute(
+        db.select(AccountBalance.entity_type, db.func.sum(AccountBalance.total_paid),
+                  db.func.sum(AccountBalance.outstanding))
+        .group_by(AccountBalance.entity_type)
+    ).all()
+    return {entity_type: (paid or 0.0, outstanding or 0.0) for entity_type, paid, outstanding in rows}
+
+
+def dues_status(account, attended_since_latest, today=None):
+    """Dues colour key for an account, from its latest invoice/receipt"""
+    if account is None or account.latest_document_id is None:
+        return 'just_joined'
+    if account.latest_status == 'Paid':
+        return 'paid_attended' if attended_since_latest else 'paid_no_class'
+    if account.latest_status == 'Partial':
+        return 'partial_payment'
+    days_overdue = ((today or datetime.utcnow().date()) - account.latest_document_at.date()).days
+    if days_overdue <= 5:
+        return 'first_5_days'
+    if days_overdue <= 10:
+        return 'next_5_days'
+    return 'after_10_days'
+
+
+def refresh_latest(account):
+    """Re-read an account's latest document and ageing from the invoice/receipt tables"""
+    if account.entity_type == STUDENT:
+        document = StudentInvoice.query.filter_by(student_id=account.entity_id)\
+            .order_by(StudentInvoice.generated_at.desc()).first()
+    else:
+        document = TutorReceipt.query.filter_by(tutor_id=account.entity_id)\
+            .order_by(TutorReceipt.generated_at.desc()).first()
+    values = (document.id, document.generated_at, document_amount(document),
+              document_paid(document), document.status) if document else (None,) * len(_LATEST_FIELDS)
+    for field, value in zip(_LATEST_FIELDS, values):
+        setattr(account, field, value)
+    account.oldest_unpaid_at = db.session.execute(
+        db.select(_unpaid_since(account.entity_type, account.entity_id))
+    ).scalar()
+    account.updated_at = datetime.utcnow()
+
+
+def refresh_all_latest():
+    """Refresh every account's latest document, e.g. after old documents are deleted"""
+    for account in AccountBalance.query.all():
+        refresh_latest(account)
+
+
+def reconcile(fix=False):
+    """Compare every balance with its ledger totals and return the accounts that differ.
+
+    With fix=True the drifted accounts are rewritten from the ledger and committed.
+    """
+    charged = db.func.sum(db.case((LedgerEntry.entry_type == CHARGE, LedgerEntry.amount), else_=0))
+    paid = db.func.sum(db.case((LedgerEntry.entry_type == PAYMENT, LedgerEntry.amount), else_=0))
+    totals = {
+        (row.entity_type, row.entity_id): (round(row.charged or 0, 2), round(row.paid or 0, 2))
+        for row in db.session.execute(
+            db.select(LedgerEntry.entity_type, LedgerEntry.entity_id,
+                      charged.label('charged'), paid.label('paid'))
+            .group_by(LedgerEntry.entity_type, LedgerEntry.entity_id)
+        )
+    }
+    accounts = {(a.entity_type, a.entity_id): a for a in AccountBalance.query.all()}
+
+    mismatches = []
+    for key in sorted(set(totals) | set(accounts)):
+        expected_charged, expected_paid = totals.get(key, (0.0, 0.0))
+        expected = (expected_charged, expected_paid, round(expected_charged - expected_paid, 2))
+        account = accounts.get(key)
+        actual = None if account is None else (
+            round(account.total_charged, 2), round(account.total_paid, 2), round(account.outstanding, 2))
+        if actual == expected:
+            continue
+        mismatches.append({'entity_type': key[0], 'entity_id': key[1], 'expected': expected, 'actual': actual})
+        if fix:
+            if account is None:
+                account = AccountBalance(entity_type=key[0], entity_id=key[1])
+                db.session.add(account)
+            account.total_charged, account.total_paid, account.outstanding = expected
+            refresh_latest(account)
+
+    if fix and mismatches:
+        db.session.commit()
+    if mismatches:
+        logging.warning(f"Ledger reconciliation: {len(mismatches)} account(s) out of balance"
+                        + (" (fixed)" if fix else ""))
+    return mismatches
+
+
+def backfill_ledger():
+    """Ledger invoices and receipts that predate the ledger, then rebuild their balances"""
+    added = 0
+    for model, entity_type in ((StudentInvoice, STUDENT), (TutorReceipt, TUTOR)):
+        ledgered = db.select(LedgerEntry.document_id).where(
+            LedgerEntry.entity_type == entity_type, LedgerEntry.entry_type == CHARGE)
+        for document in model.query.filter(model.id.not_in(ledgered)).all():
+            entity_id = account_of(document)[1]
+            entries = [(CHARGE, document_amount(document)), (PAYMENT, document_paid(document))]
+            for entry_type, amount in entries:
+                if entry_type == CHARGE or amount:
+                    db.session.add(LedgerEntry(entity_type=entity_type, entity_id=entity_id,
+                                               entry_type=entry_type, document_id=document.id, amount=amount,
+                                               note='Backfilled', created_at=document.generated_at))
+            added += 1
+    if added:
+        db.session.flush()
+        reconcile(fix=True)
+        logging.info(f"Payment ledger: backfilled {added} invoices/receipts")
+    return added
+
+
+if __name__ == "__main__":
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Check account balances against the payment ledger")
+    parser.add_argument('--fix', action='store_true', help="rewrite drifted balances from the ledger")
+    args = parser.parse_args()
+
+    with app.app_context():
+        problems = reconcile(fix=args.fix)
+        for problem in problems:
+            print(f"{problem['entity_type']} {problem['entity_id']}: "
+                  f"expected {problem['expected']}, balance has {problem['actual']}")
+        print(f"{len(problems)} account(s) out of balance" + (" - fixed" if args.fix and problems else ""))
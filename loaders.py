@@ -0,0 +1,66 @@
+import logging
+from functools import wraps
+import sqlalchemy as sa
+from sqlalchemy.orm import raiseload
+from flask import g, current_app, has_request_context
+
+
+def loader_profile(profile):
+    """Declare the eager loads a view needs as {Model: [loader options]}.
+
+    While the view runs, every ORM select whose primary entity is a key in the
+    profile gets those options, so templates walk relationships without issuing
+    one lazy SELECT per row. With STRICT_LOADING enabled every other relationship
+    on the loaded objects raises instead of lazy loading, exposing unplanned access.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.loader_profile = profile
+            try:
+                return f(*args, **kwargs)
+            finally:
+                g.pop('loader_profile', None)
+        return decorated_function
+    return decorator
+
+
+def _primary_entity(statement):
+    try:
+        descriptions = statement.column_descriptions
+    except AttributeError:
+        return None
+    if not descriptions:
+        return None
+    entity = descriptions[0].get('entity')
+    # Only whole-entity selects; column and aggregate queries get no loader options
+    if entity is None or descriptions[0].get('type') is not entity:
+        return None
+    return entity
+
+
+def _apply_profile(orm_execute_state):
+    state = orm_execute_state
+    if not state.is_select or state.is_column_load or state.is_relationship_load:
+        return
+    if not has_request_context():
+        return
+    profile = g.get('loader_profile')
+    if profile is None:
+        return
+
+    entity = _primary_entity(state.statement)
+    if entity is None:
+        return
+    options = list(profile.get(entity, ()))
+    if current_app.config.get('STRICT_LOADING'):
+        options = [option.raiseload('*') for option in options] + [raiseload('*')]
+    if options:
+        state.statement = state.statement.options(*options)
+
+
+def init_loader_profiles(app, session_class):
+    """Apply view loader profiles to ORM queries made through session_class"""
+    sa.event.listen(session_class, 'do_orm_execute', _apply_profile)
+    if app.config.get('STRICT_LOADING'):
+        logging.info("Strict loading enabled: unplanned lazy loads in profiled views will raise")
@@ -0,0 +1,157 @@
+import logging
+from sqlalchemy import inspect, text
+from app import db
+
+
+def current_engine():
+    """The engine of the database being migrated: the default one or the current branch's"""
+    return db.session.get_bind()
+
+
+def column_exists(table, column):
+    """Check whether a column exists in the live database"""
+    return any(c['name'] == column for c in inspect(current_engine()).get_columns(table))
+
+
+def add_column_if_missing(table, column, ddl):
+    """Add a nullable column to an existing table (create_all never alters tables)"""
+    if column_exists(table, column):
+        return False
+    with current_engine().begin() as conn:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+    logging.info(f"Added column {table}.{column}")
+    return True
+
+
+def ensure_indexes(model):
+    """Create any indexes declared on a model that the live table is missing"""
+    for index in model.__table__.indexes:
+        index.create(current_engine(), checkfirst=True)
+
+
+def migrate_subject_catalog():
+    """Parse Student.subjects strings into the subject catalog and link attendance"""
+    from models import Student, Subject, Attendance, student_subjects
+
+    add_column_if_missing('attendance', 'subject_id', 'INTEGER REFERENCES subject (id)')
+    ensure_indexes(Attendance)
+
+    linked = {row[0] for row in db.session.execute(db.select(student_subjects.c.student_id).distinct())}
+    students = [s for s in Student.query.all() if s.id not in linked and s.subjects]
+    for student in students:
+        student.set_subjects(student.subjects)
+
+    unlinked = db.session.execute(
+        db.select(Attendance.subject).where(Attendance.subject_id.is_(None)).distinct()
+    ).scalars().all()
+    unlinked = [name for name in unlinked if name.strip()]
+    if unlinked:
+        catalog = {s.name_key: s for s in Subject.intern([' '.join(name.split()) for name in unlinked])}
+        db.session.flush()
+        for name in unlinked:
+            subject = catalog[Subject.make_key(name)]
+            Attendance.query.filter(Attendance.subject == name, Attendance.subject_id.is_(None))\
+                .update({'subject_id': subject.id}, synchronize_session=False)
+
+    db.session.commit()
+    if students or unlinked:
+        logging.info(f"Subject catalog: linked {len(students)} students, {len(unlinked)} attendance subjects")
+
+
+def migrate_tutor_user_link():
+    """Link tutors to their login accounts through tutor.user_id"""
+    from models import Tutor, User, Role
+
+    # fix.py drops this column on older deployments, so it may need re-adding
+    add_column_if_missing('tutor', 'user_id', 'INTEGER REFERENCES "user" (id)')
+    ensure_indexes(Tutor)
+
+    unlinked = Tutor.query.filter(Tutor.user_id.is_(None)).all()
+    if not unlinked:
+        return
+
+    # Accounts were created with the tutor's mobile and username; either may have drifted since
+    users = User.query.filter(User.roles.any(Role.name == 'Tutor')).filter(db.or_(
+        User.mobile.in_([tutor.mobile for tutor in unlinked]),
+        User.username.in_([tutor.username for tutor in unlinked])
+    )).all()
+    by_mobile = {user.mobile: user for user in users if user.mobile}
+    by_username = {user.username: user for user in users}
+    taken = set(db.session.execute(
+        db.select(Tutor.user_id).where(Tutor.user_id.isnot(None))
+    ).scalars())
+
+    linked = 0
+    for tutor in unlinked:
+        user = by_mobile.get(tutor.mobile) or by_username.get(tutor.username)
+        if user is not None and user.id not in taken:
+            tutor.user_id = user.id
+            taken.add(user.id)
+            linked += 1
+    db.session.commit()
+    logging.info(f"Tutor accounts: linked {linked} of {len(unlinked)} tutors to users")
+
+
+def migrate_payment_ledger():
+    """Ledger invoices and receipts created before the payment ledger existed"""
+    from ledger import backfill_ledger
+    backfill_ledger()
+    db.session.commit()
+
+
+def migrate_billing_periods():
+    """Enforce one invoice/receipt per billing period with unique indexes"""
+    from models import StudentInvoice, TutorReceipt
+
+    for model, owner in ((StudentInvoice, StudentInvoice.student_id), (TutorReceipt, TutorReceipt.tutor_id)):
+        duplicates = db.session.execute(
+            db.select(owner, model.start_date, model.end_date)
+            .group_by(owner, model.start_date, model.end_date)
+            .having(db.func.count() > 1)
+        ).all()
+        if duplicates:
+            # Double-billed periods need a human decision before the index can exist
+            logging.error(f"{model.__tablename__}: {len(duplicates)} billing period(s) were billed more than once "
+                          f"({duplicates[:5]}); billing runs skip ON CONFLICT and are not safe to overlap "
+                          f"until the duplicates are removed and the index exists")
+            continue
+        ensure_indexes(model)
+
+
+def migrate_report_cube():
+    """Index the reporting months and build the cube the first time"""
+    from models import LedgerEntry, Attendance, ReportCube
+    from reports import refresh_cube
+
+    ensure_indexes(LedgerEntry)
+    ensure_indexes(Attendance)
+    if db.session.execute(db.select(ReportCube.period).limit(1)).first() is None:
+        refresh_cube(full=True)
+
+
+def migrate_attendance_client_key():
+    """Add the offline queue's idempotency key; before anything that ensures the attendance indexes"""
+    add_column_if_missing('attendance', 'client_key', 'VARCHAR(64)')
+    # Replaced by uq_attendance_client_key_date, which a partitioned table can hold
+    with current_engine().begin() as conn:
+        conn.execute(text('DROP INDEX IF EXISTS uq_attendance_client_key'))
+
+
+def migrate_attendance_partitions():
+    """Partition attendance by month on PostgreSQL, then create or archive the months due"""
+    from partitions import partition_attendance, maintain_partitions
+
+    partition_attendance()
+    maintain_partitions()
+    db.session.commit()
+
+
+def run_migrations():
+    """Bring an existing database up to date with the current models"""
+    migrate_attendance_client_key()
+    migrate_subject_catalog()
+    migrate_tutor_user_link()
+    migrate_payment_ledger()
+    migrate_billing_periods()
+    migrate_report_cube()
+    migrate_attendance_partitions()
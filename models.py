@@ -2,8 +2,10 @@ from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.dialects import postgresql, sqlite
 from app import db
 import logging
+import json
 
 # Association tables for many-to-many relationships
 user_roles = db.Table('user_roles',
@@ -17,6 +19,11 @@ student_tutors = db.Table('student_tutors',
     db.Column('pay_per_class', db.Float, nullable=False, default=0.0)
 )
 
+student_subjects = db.Table('student_subjects',
+    db.Column('student_id', db.Integer, db.ForeignKey('student.id'), primary_key=True),
+    db.Column('subject_id', db.Integer, db.ForeignKey('subject.id'), primary_key=True, index=True)
+)
+
 class Permission:
     """Permission constants using binary flags"""
     VIEW_STUDENTS = 1           # 00000001
@@ -37,6 +44,12 @@ class Permission:
     MANAGE_USERS = 32768        # 1000000000000000
     MANAGE_ROLES = 65536        # 10000000000000000
 
+    # Roles holding none of these can only read
+    WRITE_PERMISSIONS = (ADD_STUDENTS | EDIT_STUDENTS | DELETE_STUDENTS |
+                         ADD_TUTORS | EDIT_TUTORS | DELETE_TUTORS |
+                         SUBMIT_ATTENDANCE | GENERATE_INVOICES | MARK_PAYMENTS |
+                         ACCESS_SETTINGS | MANAGE_USERS | MANAGE_ROLES)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -69,6 +82,10 @@ class User(UserMixin, db.Model):
     
     def is_tutor_user(self):
         return self.has_role('Tutor')
+    
+    def is_read_only(self):
+        """Check if none of the user's roles grant a write permission"""
+        return not any(role.permissions & Permission.WRITE_PERMISSIONS for role in self.roles)
 
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -93,13 +110,18 @@ class Role(db.Model):
     def has_permission(self, perm):
         return self.permissions & perm == perm
 
+class UserBranch(db.Model):
+    """A branch a user may open; users without any rows may open every branch"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    branch = db.Column(db.String(50), primary_key=True)
+
 class Student(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     full_name = db.Column(db.String(120), nullable=False)
     parent_name = db.Column(db.String(120), nullable=False)
     parent_whatsapp = db.Column(db.String(20), nullable=False)
     class_level = db.Column(db.String(20), nullable=False)
-    subjects = db.Column(db.Text, nullable=False)  # Comma-separated subjects
+    subjects = db.Column(db.Text, nullable=False)  # Comma-separated subjects, kept for display
     per_class_fee = db.Column(db.Float, nullable=False, default=0.0)
     billing_start_date = db.Column(db.Date, default=datetime.utcnow().date)
     status = db.Column(db.String(20), default='Active')  # Active, Inactive, Graduated
@@ -107,9 +129,16 @@ class Student(db.Model):
     
     # Relationships
     tutors = db.relationship('Tutor', secondary=student_tutors, backref='students')
+    subject_list = db.relationship('Subject', secondary=student_subjects, backref='students',
+                                   order_by='Subject.name')
     attendance_records = db.relationship('Attendance', backref='student', lazy='dynamic')
     invoices = db.relationship('StudentInvoice', backref='student', lazy='dynamic')
     
+    def set_subjects(self, subjects_text):
+        """Set subjects from comma-separated text, linking them to the subject catalog"""
+        self.subject_list = Subject.intern(Subject.parse_names(subjects_text))
+        self.subjects = ', '.join(subject.name for subject in self.subject_list)
+    
     def get_next_billing_date(self):
         """Calculate next billing date (30 days from billing start)"""
         return self.billing_start_date + timedelta(days=30)
@@ -128,7 +157,7 @@ class Student(db.Model):
 
 class Tutor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)  # Login account
     full_name = db.Column(db.String(120), nullable=False)
     date_of_birth = db.Column(db.Date, nullable=True)
     mobile = db.Column(db.String(20), nullable=False, unique=True)
@@ -142,7 +171,7 @@ class Tutor(db.Model):
     # Relationships
     attendance_records = db.relationship('Attendance', backref='tutor', lazy='dynamic')
     receipts = db.relationship('TutorReceipt', backref='tutor', lazy='dynamic')
-    user = db.relationship('User', backref='tutor_profile', uselist=False)
+    user = db.relationship('User', backref=db.backref('tutor_profile', uselist=False))
     
     def get_next_payment_date(self):
         """Calculate next payment date (40 days from billing start)"""
@@ -160,18 +189,67 @@ class Tutor(db.Model):
             return f"{first_name}{day_month}"
         return self.full_name.replace(" ", "").lower()
 
+class Subject(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), unique=True, nullable=False)  # Lowercased for matching
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @staticmethod
+    def make_key(name):
+        """Normalize a subject name for case- and spacing-insensitive matching"""
+        return ' '.join(name.split()).lower()
+    
+    @classmethod
+    def parse_names(cls, subjects_text):
+        """Split comma-separated subjects, dropping blanks and duplicates"""
+        names = {}
+        for part in (subjects_text or '').split(','):
+            name = ' '.join(part.split())
+            if name and cls.make_key(name) not in names:
+                names[cls.make_key(name)] = name
+        return list(names.values())
+    
+    @classmethod
+    def intern(cls, names):
+        """Get catalog rows for the given names, creating any that are missing"""
+        keys = {cls.make_key(name): name for name in names}
+        if not keys:
+            return []
+        existing = {s.name_key: s for s in cls.query.filter(cls.name_key.in_(list(keys))).all()}
+        for key, name in keys.items():
+            if key not in existing:
+                existing[key] = cls(name=name, name_key=key)
+                db.session.add(existing[key])
+        return [existing[key] for key in keys]
+
 class Attendance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     tutor_id = db.Column(db.Integer, db.ForeignKey('tutor.id'), nullable=False)
     subject = db.Column(db.String(100), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=True, index=True)
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime, nullable=False)
     duration_minutes = db.Column(db.Integer, nullable=False)
     rating = db.Column(db.Integer, nullable=False)  # 1-10
     remarks = db.Column(db.Text, nullable=True)
-    date_recorded = db.Column(db.Date, default=datetime.utcnow().date)
+    date_recorded = db.Column(db.Date, default=datetime.utcnow().date, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Generated by the browser when the class is recorded, so a resent entry is stored once (attendance_sync.py)
+    client_key = db.Column(db.String(64), nullable=True)
+    
+    subject_record = db.relationship('Subject')
+    
+    # Range scans for double-booking checks (overlaps.py)
+    __table_args__ = (
+        db.Index('ix_attendance_tutor_start', 'tutor_id', 'start_time'),
+        db.Index('ix_attendance_student_start', 'student_id', 'start_time'),
+        # With the date: unique indexes on a partitioned table must include its partition column (partitions.py)
+        db.Index('uq_attendance_client_key_date', 'client_key', 'date_recorded', unique=True),
+        # Ids of rows archived out of the main file are never reused (partitions.py)
+        {'sqlite_autoincrement': True},
+    )
     
     def calculate_duration(self):
         """Calculate duration in minutes"""
@@ -180,6 +258,13 @@ class Attendance(db.Model):
             return int(delta.total_seconds() / 60)
         return 0
 
+class AttendancePartition(db.Model):
+    """A month of attendance archived out of the main SQLite file (partitions.py)"""
+    period = db.Column(db.Date, primary_key=True)  # first day of the month
+    table_name = db.Column(db.String(64), nullable=False)
+    archive_file = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class StudentInvoice(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
@@ -192,10 +277,10 @@ class StudentInvoice(db.Model):
     amount_paid = db.Column(db.Float, default=0.0)
     generated_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    def generate_invoice_number(self):
-        """Generate unique invoice number"""
-        year_month = datetime.utcnow().strftime("%Y%m")
-        return f"INV-{year_month}-{self.student_id}-{self.id}"
+    # A billing period is invoiced once, however many billing runs overlap
+    __table_args__ = (
+        db.Index('uq_student_invoice_period', 'student_id', 'start_date', 'end_date', unique=True),
+    )
 
 class TutorReceipt(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -208,10 +293,49 @@ class TutorReceipt(db.Model):
     status = db.Column(db.String(20), default='Due')  # Due, Paid
     generated_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    def generate_receipt_number(self):
-        """Generate unique receipt number"""
-        year_month = datetime.utcnow().strftime("%Y%m")
-        return f"REC-{year_month}-{self.tutor_id}-{self.id}"
+    __table_args__ = (
+        db.Index('uq_tutor_receipt_period', 'tutor_id', 'start_date', 'end_date', unique=True),
+    )
+
+class DocumentSequence(db.Model):
+    """Next invoice/receipt sequence number per number prefix and month"""
+    prefix = db.Column(db.String(40), primary_key=True)
+    period = db.Column(db.String(6), primary_key=True)  # YYYYMM
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+
+class LedgerEntry(db.Model):
+    """Append-only money movement: invoices/receipts are charges, money in/out are payments.
+    Corrections are recorded as new entries with a negative amount, never edits."""
+    id = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(10), nullable=False)  # student, tutor
+    entity_id = db.Column(db.Integer, nullable=False)
+    entry_type = db.Column(db.String(10), nullable=False)  # charge, payment
+    document_id = db.Column(db.Integer, nullable=True)  # StudentInvoice / TutorReceipt id
+    amount = db.Column(db.Float, nullable=False)
+    note = db.Column(db.String(255), nullable=True)
+    recorded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Reporting month
+
+    __table_args__ = (
+        db.Index('ix_ledger_entry_entity', 'entity_type', 'entity_id'),
+        db.Index('ix_ledger_entry_document', 'entity_type', 'document_id'),
+    )
+
+class AccountBalance(db.Model):
+    """Running totals per student/tutor, updated in the same transaction as each ledger entry"""
+    entity_type = db.Column(db.String(10), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    total_charged = db.Column(db.Float, nullable=False, default=0.0)
+    total_paid = db.Column(db.Float, nullable=False, default=0.0)
+    outstanding = db.Column(db.Float, nullable=False, default=0.0)
+    oldest_unpaid_at = db.Column(db.DateTime, nullable=True)  # For ageing
+    # Latest invoice/receipt, which drives the dues status
+    latest_document_id = db.Column(db.Integer, nullable=True)
+    latest_document_at = db.Column(db.DateTime, nullable=True)
+    latest_amount = db.Column(db.Float, nullable=True)
+    latest_paid = db.Column(db.Float, nullable=True)
+    latest_status = db.Column(db.String(20), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 def create_default_roles():
     """Create default roles with predefined permissions"""
@@ -278,12 +402,19 @@ class Announcement(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
     creator = db.relationship('User', backref='announcements')
+    reads = db.relationship('AnnouncementRead', cascade='all, delete-orphan')
     
     def is_expired(self):
         if self.expiry_date:
             return datetime.utcnow().date() > self.expiry_date
         return False
 
+class AnnouncementRead(db.Model):
+    """An announcement a user has seen; keyed by user first for unread counts"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    announcement_id = db.Column(db.Integer, db.ForeignKey('announcement.id'), primary_key=True)
+    read_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(100), unique=True, nullable=False)
@@ -315,6 +446,91 @@ class Settings(db.Model):
             db.session.add(setting)
         db.session.commit()
 
+class OutboundMessage(db.Model):
+    """A queued WhatsApp message and its delivery state (see reminders.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(20), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    dedupe_key = db.Column(db.String(120), unique=True, nullable=False)  # One message per key, ever
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=True)
+    invoice_id = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_outbound_message_due', 'status', 'next_attempt_at'),
+    )
+
+class ReportCube(db.Model):
+    """Money and classes pre-aggregated per month and reporting dimension (see reports.py)"""
+    period = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    dimension = db.Column(db.String(20), primary_key=True)  # all, class_level, subject, tutor
+    member = db.Column(db.String(100), primary_key=True)  # Class level, subject name or tutor id
+    invoiced = db.Column(db.Float, nullable=False, default=0.0)
+    collected = db.Column(db.Float, nullable=False, default=0.0)
+    tutor_cost = db.Column(db.Float, nullable=False, default=0.0)
+    paid_out = db.Column(db.Float, nullable=False, default=0.0)
+    classes = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_report_cube_dimension', 'dimension', 'period'),
+    )
+
+class ReportDirtyPeriod(db.Model):
+    """A month whose cube rows are stale, written in the transaction that changed it"""
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AuditLog(db.Model):
+    """Who changed what, written in batches by audit.py or with the change itself for critical actions"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # No foreign key: the user directory can live in another database than a branch's log
+    user_id = db.Column(db.Integer, nullable=True)
+    username = db.Column(db.String(80), nullable=True)
+    action = db.Column(db.String(30), nullable=False)  # create, update, delete or a named action
+    entity_type = db.Column(db.String(50), nullable=True)
+    entity_id = db.Column(db.String(50), nullable=True)
+    changes = db.Column(db.Text, nullable=True)  # JSON: {column: [old, new]} or action details
+    endpoint = db.Column(db.String(100), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_audit_log_created', 'created_at'),
+        db.Index('ix_audit_log_user_created', 'user_id', 'created_at'),
+        db.Index('ix_audit_log_entity_created', 'entity_type', 'entity_id', 'created_at'),
+    )
+
+    def get_changes(self):
+        return json.loads(self.changes) if self.changes else {}
+
+class TableVersion(db.Model):
+    """Change counter per table, bumped by each transaction that changes it as it commits"""
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+def insert_ignore(model, *index_elements):
+    """INSERT ... ON CONFLICT DO NOTHING for the configured database (SQLite or PostgreSQL).
+
+    With index_elements only conflicts on that unique key are skipped; others still raise.
+    """
+    insert = sqlite.insert if db.session.get_bind().dialect.name == 'sqlite' else postgresql.insert
+    return insert(model).on_conflict_do_nothing(index_elements=list(index_elements) or None)
+
+def create_table_versions():
+    """Create a version row for every table that does not have one yet"""
+    existing = {row.table_name for row in TableVersion.query.all()}
+    for table_name in db.metadata.tables:
+        if table_name not in existing:
+            db.session.add(TableVersion(table_name=table_name, version=0))
+    db.session.commit()
+
 def create_default_settings():
     """Create default theme and system settings"""
     default_settings = {
@@ -338,6 +554,25 @@ def create_default_settings():
         'general': {
             'invoice_prefix': 'MC-INV-',
             'receipt_prefix': 'MC-REC-'
+        },
+        'payment': {
+            'gpay_number': '7994829844',
+            'upi_id': 'Jafaraliva869@oksbi',
+            'contact_mobile': '8921378863'
+        },
+        'pdf': {
+            'backend_student_invoice': 'weasyprint',
+            'backend_tutor_receipt': 'weasyprint'
+        },
+        'reminders': {
+            'first_5_days': 'Dear {parent_name}, invoice {invoice_number} for {student_name} of Rs. {amount_due} '
+                            'is due. Please pay at your earliest convenience. - MENTORSCUE',
+            'next_5_days': 'Dear {parent_name}, a gentle reminder that Rs. {amount_due} for {student_name} '
+                           '(invoice {invoice_number}) has been due for {days_overdue} days. - MENTORSCUE',
+            'after_10_days': 'Dear {parent_name}, Rs. {amount_due} for {student_name} (invoice {invoice_number}) '
+                             'is overdue by {days_overdue} days. Please clear it to continue classes. - MENTORSCUE',
+            'partial_payment': 'Dear {parent_name}, thank you for your payment. Rs. {amount_due} is still pending '
+                               'on invoice {invoice_number} for {student_name}. - MENTORSCUE'
         }
     }
     
@@ -0,0 +1,104 @@
+"""Invoice and receipt numbers, reserved from the database in blocks.
+
+Numbers look like <prefix><YYYYMM>-<sequence>: the prefix comes from the
+general_invoice_prefix / general_receipt_prefix settings and each prefix has its
+own sequence per month. Numbers are assigned before the rows are inserted, so
+documents can be written in bulk without a flush per row to learn their ids.
+"""
+import os
+import threading
+from datetime import datetime
+from app import db
+from models import DocumentSequence, Settings, insert_ignore
+from db_routing import current_branch
+
+INVOICE, RECEIPT = 'invoice', 'receipt'
+
+PREFIX_SETTINGS = {
+    INVOICE: ('general_invoice_prefix', 'MC-INV-'),
+    RECEIPT: ('general_receipt_prefix', 'MC-REC-'),
+}
+
+# Numbers a process reserves at a time on PostgreSQL; unused ones are skipped when it exits
+BLOCK_SIZE = int(os.environ.get('DOCUMENT_NUMBER_BLOCK', 50))
+
+# Prefix + YYYYMM + "-" + a sequence of up to 10 digits fits the 50-character number columns
+MAX_PREFIX_LENGTH = 30
+
+# (branch, prefix, period) -> [next, end) still unused in this process's current block
+_blocks = {}
+_lock = threading.Lock()
+
+
+def _forget_blocks():
+    # A forked child (billing workers) must not hand out the parent's block again
+    global _lock
+    _blocks.clear()
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_blocks)
+
+
+def validate_prefix(prefix):
+    """Raise ValueError for a number prefix that is empty or too long; returns it stripped"""
+    prefix = (prefix or '').strip()
+    if not prefix:
+        raise ValueError('Number prefixes cannot be empty')
+    if len(prefix) > MAX_PREFIX_LENGTH:
+        raise ValueError(f'Number prefixes can be at most {MAX_PREFIX_LENGTH} characters')
+    return prefix
+
+
+def next_numbers(kind, count, when=None):
+    """Reserve `count` document numbers for invoices or receipts"""
+    if count <= 0:
+        return []
+    setting, default = PREFIX_SETTINGS[kind]
+    prefix = validate_prefix(Settings.get_setting(setting, default))
+    period = (when or datetime.utcnow()).strftime('%Y%m')
+    return [f"{prefix}{period}-{value:05d}" for value in _take(prefix, period, count)]
+
+
+def next_number(kind, when=None):
+    return next_numbers(kind, 1, when)[0]
+
+
+def _take(prefix, period, count):
+    engine = db.session.get_bind()
+    if engine.dialect.name == 'sqlite':
+        # SQLite has one writer at a time, and a second connection would queue behind
+        # our own transaction, so reserve exactly what is needed inside it. A rollback
+        # then returns the numbers too.
+        start, end = _reserve(db.session, prefix, period, count)
+        return list(range(start, end))
+
+    values = []
+    with _lock:
+        key = (current_branch(), prefix, period)
+        next_value, end = _blocks.get(key, (0, 0))
+        available = min(end - next_value, count)
+        values.extend(range(next_value, next_value + available))
+        _blocks[key] = (next_value + available, end)
+        if len(values) < count:
+            # A separate, immediately committed transaction keeps the sequence row
+            # locked only for this statement, not for the caller's whole billing run.
+            with engine.begin() as conn:
+                start, end = _reserve(conn, prefix, period, max(count - len(values), BLOCK_SIZE))
+            needed = count - len(values)
+            values.extend(range(start, start + needed))
+            _blocks[key] = (start + needed, end)
+    return values
+
+
+def _reserve(executor, prefix, period, count):
+    """Advance the sequence by `count` in one UPDATE ... RETURNING; returns [start, end)"""
+    executor.execute(insert_ignore(DocumentSequence).values(prefix=prefix, period=period, next_value=1))
+    end = executor.execute(
+        db.update(DocumentSequence)
+        .where(DocumentSequence.prefix == prefix, DocumentSequence.period == period)
+        .values(next_value=DocumentSequence.next_value + count)
+        .returning(DocumentSequence.next_value)
+        .execution_options(synchronize_session=False)
+    ).scalar_one()
+    return end - count, end
@@ -0,0 +1,175 @@
+"""Double-booking checks for attendance: a tutor or a student in two classes at once.
+
+Classes are looked up through the (tutor_id, start_time) and (student_id,
+start_time) indexes. A class is at most MAX_CLASS_LENGTH long, so anything
+overlapping [start, end) must start in [start - MAX_CLASS_LENGTH, end): a single
+index range scan per entity. Batches are checked against an in-memory
+IntervalIndex, and find_overlaps audits all history in one sorted sweep.
+
+A check and the insert it allows must run under lock_schedules, or two
+submissions for the same slot can both pass before either is written.
+
+Run `python overlaps.py` to list historical overlaps.
+"""
+import os
+import heapq
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import timedelta
+from app import db
+from models import Attendance
+
+TUTOR, STUDENT = 'tutor', 'student'
+
+# Longest class accepted; also bounds how far back a lookup has to search
+MAX_CLASS_LENGTH = timedelta(hours=int(os.environ.get('ATTENDANCE_MAX_CLASS_HOURS', 12)))
+
+_COLUMNS = {TUTOR: Attendance.tutor_id, STUDENT: Attendance.student_id}
+
+# First key of the PostgreSQL advisory locks taken per tutor and per student
+_LOCK_CLASSES = {TUTOR: 3801, STUDENT: 3802}
+
+
+class IntervalIndex:
+    """Intervals sorted by start time; overlaps are found with a bisect plus a bounded scan"""
+
+    def __init__(self, max_length=MAX_CLASS_LENGTH):
+        self.max_length = max_length
+        self._intervals = []  # (start, end, sequence, key), sorted
+        self._added = 0
+
+    def add(self, start, end, key=None):
+        # The sequence breaks ties, so keys never need to be comparable
+        self._added += 1
+        insort(self._intervals, (start, end, self._added, key))
+
+    def overlapping(self, start, end):
+        """Keys of stored intervals that overlap [start, end); touching ends don't count"""
+        lo = bisect_left(self._intervals, (start - self.max_length,))
+        hi = bisect_left(self._intervals, (end,))
+        return [key for _, other_end, _, key in self._intervals[lo:hi] if other_end > start]
+
+    def __len__(self):
+        return len(self._intervals)
+
+
+def validate_class_times(start, end):
+    if end <= start:
+        raise ValueError('End time must be after start time')
+    if end - start > MAX_CLASS_LENGTH:
+        raise ValueError(f'A class cannot be longer than {MAX_CLASS_LENGTH.total_seconds() / 3600:g} hours')
+
+
+def lock_schedules(tutor_ids, student_ids):
+    """Serialize overlap checks for these tutors and students until the transaction ends.
+
+    SQLite takes the database write lock up front with a no-op write, so no other
+    writer can slip a class in between the check and the insert. PostgreSQL takes
+    a transaction-level advisory lock per tutor and per student, in a fixed order
+    so two batches can never wait on each other.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        db.session.execute(db.text('UPDATE table_version SET version = version WHERE 1 = 0'))
+    elif dialect == 'postgresql':
+        keys = sorted({(_LOCK_CLASSES[TUTOR], int(i)) for i in tutor_ids} |
+                      {(_LOCK_CLASSES[STUDENT], int(i)) for i in student_ids})
+        for lock_class, entity_id in keys:
+            db.session.execute(db.text('SELECT pg_advisory_xact_lock(:lock_class, :entity_id)'),
+                               {'lock_class': lock_class, 'entity_id': entity_id})
+
+
+def find_conflicts(tutor_id, student_id, start, end, exclude_id=None):
+    """Attendance rows that clash with a class for this tutor or student, as (kind, Attendance)"""
+    conflicts = []
+    for kind, entity_id in ((TUTOR, tutor_id), (STUDENT, student_id)):
+        column = _COLUMNS[kind]
+        query = Attendance.query.filter(
+            column == entity_id,
+            Attendance.start_time >= start - MAX_CLASS_LENGTH,
+            Attendance.start_time < end,
+            Attendance.end_time > start
+        )
+        if exclude_id is not None:
+            query = query.filter(Attendance.id != exclude_id)
+        conflicts.extend((kind, record) for record in query.order_by(Attendance.start_time))
+    return conflicts
+
+
+def describe_conflicts(conflicts):
+    """One line per clashing class, for flashing back to whoever submitted it"""
+    kinds = defaultdict(list)
+    for kind, record in conflicts:
+        kinds[record].append(kind)
+    return '; '.join(
+        f"the {' and '.join(names)} already {'have' if len(names) > 1 else 'has'} a class on "
+        f"{record.start_time:%d %b %Y} from {record.start_time:%H:%M} to {record.end_time:%H:%M}"
+        for record, names in kinds.items()
+    )
+
+
+class BatchChecker:
+    """Check many new classes against the database and each other.
+
+    Existing classes for the batch's tutors and students are loaded once into
+    per-entity IntervalIndexes; each accepted class is added, so later rows in
+    the batch are checked against earlier ones.
+    """
+
+    def __init__(self, classes):
+        """classes: iterable of dicts with tutor_id, student_id, start_time, end_time"""
+        classes = list(classes)
+        self._index = defaultdict(IntervalIndex)
+        if not classes:
+            return
+        lo = min(c['start_time'] for c in classes) - MAX_CLASS_LENGTH
+        hi = max(c['end_time'] for c in classes)
+        for kind, column in _COLUMNS.items():
+            ids = {c[f'{kind}_id'] for c in classes}
+            for entity_id, start, end, attendance_id in db.session.execute(
+                db.select(column, Attendance.start_time, Attendance.end_time, Attendance.id)
+                .where(column.in_(ids), Attendance.start_time >= lo, Attendance.start_time < hi)
+            ):
+                self._index[(kind, entity_id)].add(start, end, attendance_id)
+
+    def check(self, tutor_id, student_id, start, end):
+        """[(kind, attendance id or None for a class earlier in the batch)] that clash"""
+        return [(kind, key) for kind, entity_id in ((TUTOR, tutor_id), (STUDENT, student_id))
+                for key in self._index[(kind, entity_id)].overlapping(start, end)]
+
+    def add(self, tutor_id, student_id, start, end, key=None):
+        self._index[(TUTOR, tutor_id)].add(start, end, key)
+        self._index[(STUDENT, student_id)].add(start, end, key)
+
+
+def find_overlaps():
+    """Every pair of overlapping classes for the same tutor or student, found in one sorted sweep each"""
+    overlaps = []
+    for kind, column in _COLUMNS.items():
+        entity, active = None, []  # heap of (end, id) for classes still running
+        rows = db.session.execute(
+            db.select(column, Attendance.id, Attendance.start_time, Attendance.end_time)
+            .order_by(column, Attendance.start_time, Attendance.id)
+            .execution_options(yield_per=1000)
+        )
+        for entity_id, attendance_id, start, end in rows:
+            if entity_id != entity:
+                entity, active = entity_id, []
+            while active and active[0][0] <= start:
+                heapq.heappop(active)
+            for other_end, other_id in active:
+                overlaps.append({'kind': kind, 'entity_id': entity_id, 'first_id': other_id, 'second_id': attendance_id,
+                                 'start': start, 'end': min(end, other_end)})
+            heapq.heappush(active, (end, attendance_id))
+    return overlaps
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        found = find_overlaps()
+    for overlap in found:
+        print(f"{overlap['kind']} {overlap['entity_id']}: attendance {overlap['first_id']} and "
+              f"{overlap['second_id']} overlap {overlap['start']:%Y-%m-%d %H:%M}-{overlap['end']:%H:%M}")
+    print(f"{len(found)} overlapping pair(s)")
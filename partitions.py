@@ -0,0 +1,508 @@
+"""Monthly partitions for attendance, so retention drops whole months.
+
+Attendance is the one table that grows without bound, and billing, profiles and
+dashboards all read it by date_recorded. On PostgreSQL it becomes a table
+partitioned by month (PARTITION BY RANGE (date_recorded)): attendance_2025_06
+holds June 2025, attendance_default anything no partition covers yet, and the
+planner prunes every query to the months its dates touch. Partitions for the
+next ATTENDANCE_PARTITIONS_AHEAD months (default 12) are created in advance.
+
+SQLite has no partitioning, so closed months move out of the main file. Each
+becomes a table attendance_YYYY_MM in the yearly archive file
+<database>-attendance/YYYY.db, listed in attendance_partition. Every pooled
+connection attaches the archives and puts a TEMP view named attendance in front
+of main.attendance: a UNION ALL of the main table and the archived months, into
+which SQLite pushes date filters so each month answers from its own indexes.
+Statements that write to attendance are pointed at main.attendance, so archived
+months are read-only: an UPDATE or DELETE matching archived rows changes none
+of them and raises nothing. Only drop_attendance_before() removes them, and
+students and tutors are deactivated rather than deleted, so nothing leaves
+archived rows behind; code that must change an archived month has to address
+its archive_<year> schema itself. The current month and the ATTENDANCE_HOT_MONTHS - 1
+before it (3 in all by default) stay in the main file, and at most nine years
+of archives can be attached at once (SQLite's limit is ten databases).
+
+drop_attendance_before() drops whole partitions and trims only the month the
+cutoff falls in. maintain_partitions() runs with the migrations at startup; run
+`python partitions.py` from a scheduler to keep a long-running deployment's
+partitions current.
+"""
+import os
+import re
+import logging
+import sqlite3
+from datetime import date, datetime
+from sqlalchemy import event, inspect, text
+from sqlalchemy.schema import AddConstraint, CreateTable
+
+TABLE = 'attendance'
+DEFAULT_PARTITION = 'attendance_default'
+CATALOG = 'attendance_partition'
+ARCHIVE_SCHEMA_PREFIX = 'archive_'
+
+HOT_MONTHS = max(1, int(os.environ.get('ATTENDANCE_HOT_MONTHS', 3)))
+PARTITIONS_AHEAD = int(os.environ.get('ATTENDANCE_PARTITIONS_AHEAD', 12))
+# One of SQLite's ten attachments stays free for maintain_partitions to open a new year
+MAX_ARCHIVES = 9
+
+_PARTITION_NAME = re.compile(r'^attendance_(\d{4})_(\d{2})$')
+
+# Statements that write to or alter a table named right after their keyword
+_WRITE_TARGET = re.compile(
+    r'^(\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM|ALTER\s+TABLE'
+    r'|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+)("?attendance"?)(?=[\s(]|$)',
+    re.IGNORECASE
+)
+# CREATE INDEX takes its schema from the index name, not the table's
+_INDEX_TARGET = re.compile(
+    r'^(\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?)("?\w+"?)(\s+ON\s+"?attendance"?\s*\()',
+    re.IGNORECASE
+)
+_VIEW_KEY = 'attendance_partitions'
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(period, months):
+    index = period.year * 12 + period.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(period):
+    """attendance_2025_06 for June 2025"""
+    return f'{TABLE}_{period:%Y_%m}'
+
+
+def archive_directory(engine):
+    """Where a SQLite database keeps its archived months: mentorscue.db -> mentorscue-attendance/"""
+    return f'{os.path.splitext(engine.url.database)[0]}-attendance'
+
+
+def archive_schema(archive_file):
+    """The name a yearly archive file is attached under: 2025.db -> archive_2025"""
+    return ARCHIVE_SCHEMA_PREFIX + os.path.splitext(archive_file)[0]
+
+
+def _archives(engine):
+    return engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:')
+
+
+# SQLite connections: archives attached, the view in front of the main table
+
+def init_attendance_partitions(engine):
+    """On a SQLite file database, show the archived months to every pooled connection"""
+    if not _archives(engine):
+        return engine
+    directory = archive_directory(engine)
+
+    def refresh(dbapi_connection, connection_record, connection_proxy):
+        _refresh_view(dbapi_connection, connection_record, directory)
+
+    event.listen(engine.pool, 'checkout', refresh)
+    event.listen(engine, 'before_cursor_execute', _to_main_table, retval=True)
+    return engine
+
+
+def _refresh_view(dbapi_connection, connection_record, directory):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        # The catalog says which months are archived; the schema version moves when columns are added
+        cursor.execute("PRAGMA main.schema_version")
+        schema_version = cursor.fetchone()[0]
+        try:
+            cursor.execute(f"SELECT period, table_name, archive_file FROM main.{CATALOG} ORDER BY period")
+            partitions = tuple(cursor.fetchall())
+        except sqlite3.OperationalError:
+            partitions = ()  # before create_all
+        signature = (schema_version, partitions)
+        current = connection_record.info.get(_VIEW_KEY)
+        if current is None and not partitions:
+            connection_record.info[_VIEW_KEY] = (signature, False)
+        elif current is None or current[0] != signature:
+            connection_record.info[_VIEW_KEY] = (signature, _build_view(cursor, directory, partitions))
+    except sqlite3.Error as e:
+        logging.error(f"Could not attach the attendance archives: {e}")
+    finally:
+        cursor.close()
+
+
+def _columns(cursor, schema, table):
+    cursor.execute(f'PRAGMA {schema}.table_info("{table}")')
+    return [row[1] for row in cursor.fetchall()]
+
+
+def _build_view(cursor, directory, partitions):
+    """(Re)create the attendance view over the main table and the archived months; False when there are none"""
+    cursor.execute(f"DROP VIEW IF EXISTS temp.{TABLE}")
+    files = sorted({archive_file for _, _, archive_file in partitions}, reverse=True)
+    if len(files) > MAX_ARCHIVES:
+        logging.warning(f"Attendance archives: only the newest {MAX_ARCHIVES} of {len(files)} years are visible")
+        files = files[:MAX_ARCHIVES]
+    wanted = {archive_schema(archive_file): archive_file for archive_file in files
+              if os.path.exists(os.path.join(directory, archive_file))}
+
+    cursor.execute("PRAGMA database_list")
+    attached = {row[1] for row in cursor.fetchall() if row[1].startswith(ARCHIVE_SCHEMA_PREFIX)}
+    for schema in attached - set(wanted):
+        cursor.execute(f"DETACH DATABASE {schema}")
+    for schema, archive_file in wanted.items():
+        if schema not in attached:
+            cursor.execute(f"ATTACH DATABASE ? AS {schema}", (os.path.join(directory, archive_file),))
+
+    columns = _columns(cursor, 'main', TABLE)
+    selects = [f"SELECT {', '.join(columns)} FROM main.{TABLE}"]
+    for period, table, archive_file in partitions:
+        schema = archive_schema(archive_file)
+        present = set(_columns(cursor, schema, table)) if schema in wanted else set()
+        if not present:
+            logging.warning(f"Attendance archive {archive_file} has no {table}; {period} is not visible")
+            continue
+        # Columns added after the month was archived read as NULL
+        selects.append(f"SELECT {', '.join(c if c in present else f'NULL AS {c}' for c in columns)} "
+                       f"FROM {schema}.{table}")
+    if len(selects) == 1:
+        return False
+    cursor.execute(f"CREATE TEMP VIEW {TABLE} AS {' UNION ALL '.join(selects)}")
+    return True
+
+
+def _to_main_table(conn, cursor, statement, parameters, context, executemany):
+    state = conn.info.get(_VIEW_KEY)
+    if state and state[1]:
+        statement = _WRITE_TARGET.sub(r'\1main.\2', statement, count=1)
+        statement = _INDEX_TARGET.sub(r'\1main.\2\3', statement, count=1)
+    return statement, parameters
+
+
+# Maintenance
+
+def maintain_partitions():
+    """Create the coming months' partitions (PostgreSQL) or archive closed months (SQLite).
+
+    Returns the months created or archived. On PostgreSQL the caller commits.
+    """
+    from app import db
+    from migrations import current_engine
+
+    engine = current_engine()
+    if engine.dialect.name == 'postgresql':
+        conn = db.session.connection()
+        this_month = month_start(date.today())
+        return [period for period in (add_months(this_month, i) for i in range(PARTITIONS_AHEAD + 1))
+                if _pg_create_partition(conn, period)]
+    if _archives(engine):
+        return _sqlite_archive(engine)
+    return []
+
+
+def drop_attendance_before(cutoff):
+    """Remove attendance dated before cutoff, dropping every month that ends by then; returns the rows removed.
+
+    Only the month the cutoff falls in is trimmed row by row. On PostgreSQL this
+    runs in the session's transaction and the caller commits; the SQLite archive
+    files are changed and committed straight away, so commit the session's other
+    deletes first and call it last, after which nothing can roll them back.
+    """
+    from app import db
+    from migrations import current_engine
+
+    if isinstance(cutoff, datetime):
+        cutoff = cutoff.date()
+    engine = current_engine()
+    if engine.dialect.name == 'postgresql':
+        return _pg_drop_before(db.session.connection(), cutoff)
+    if _archives(engine):
+        return _sqlite_drop_before(engine, cutoff)
+    return db.session.execute(
+        text(f"DELETE FROM {TABLE} WHERE date_recorded < :cutoff"), {'cutoff': cutoff}
+    ).rowcount
+
+
+def list_partitions():
+    """[(period, where it is stored, rows)], oldest first; the main table's months are not listed on SQLite"""
+    from app import db
+    from migrations import current_engine
+
+    engine = current_engine()
+    if engine.dialect.name == 'postgresql':
+        conn = db.session.connection()
+        return [(period, name, conn.execute(text(f"SELECT count(*) FROM {name}")).scalar())
+                for period, name in _pg_partitions(conn)]
+    if not _archives(engine):
+        return []
+    with engine.connect() as conn:
+        return [(date.fromisoformat(period), f"{archive_file}:{table}",
+                 conn.exec_driver_sql(f"SELECT count(*) FROM {archive_schema(archive_file)}.{table}").scalar())
+                for period, table, archive_file in _catalog(conn)]
+
+
+# PostgreSQL
+
+def _pg_is_partitioned(conn):
+    return conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {'name': TABLE}
+    ).scalar() == 'p'
+
+
+def partition_attendance():
+    """Get the attendance table ready for partitions, once.
+
+    PostgreSQL: a plain table becomes one partitioned by month, rows and all.
+    SQLite: the table is rebuilt with AUTOINCREMENT ids, so the ids of rows
+    moved to the archives are never handed out again.
+    """
+    from migrations import current_engine
+
+    engine = current_engine()
+    if engine.dialect.name == 'postgresql':
+        return _pg_partition_table(engine)
+    if _archives(engine):
+        return _sqlite_autoincrement(engine)
+    return False
+
+
+def _pg_partition_table(engine):
+    from models import Attendance
+    from migrations import ensure_indexes
+
+    with engine.begin() as conn:
+        if _pg_is_partitioned(conn):
+            return False
+        old = f'{TABLE}_unpartitioned'
+        columns = [column['name'] for column in inspect(conn).get_columns(TABLE)]
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:name, 'id')"), {'name': TABLE}).scalar()
+        primary_key = conn.execute(text(
+            "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'p'"
+        ), {'name': TABLE}).scalar()
+
+        # The old table gives up its name and its primary key's index name
+        conn.execute(text(f'ALTER TABLE {TABLE} RENAME TO {old}'))
+        if primary_key:
+            conn.execute(text(f'ALTER TABLE {old} RENAME CONSTRAINT "{primary_key}" TO {old}_pkey'))
+        conn.execute(text(f'CREATE TABLE {TABLE} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (date_recorded)'))
+        # A partitioned table's keys must include the partition column
+        conn.execute(text(f'ALTER TABLE {TABLE} ALTER COLUMN date_recorded SET NOT NULL'))
+        conn.execute(text(f'ALTER TABLE {TABLE} ADD PRIMARY KEY (id, date_recorded)'))
+        for constraint in Attendance.__table__.foreign_key_constraints:
+            conn.execute(AddConstraint(constraint))
+        conn.execute(text(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT'))
+
+        recorded = "COALESCE(date_recorded, CAST(start_time AS DATE))"
+        months = conn.execute(text(
+            f"SELECT DISTINCT CAST(date_trunc('month', {recorded}) AS DATE) FROM {old}"
+        )).scalars().all()
+        for period in months:
+            _pg_create_partition(conn, period)
+        conn.execute(text(
+            f"INSERT INTO {TABLE} ({', '.join(columns)}) "
+            f"SELECT {', '.join(recorded if c == 'date_recorded' else c for c in columns)} FROM {old}"
+        ))
+        if sequence:
+            conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id'))
+        conn.execute(text(f'DROP TABLE {old}'))
+    # Declared on the parent, the indexes are built on every partition
+    ensure_indexes(Attendance)
+    logging.info(f"Attendance: partitioned by month ({len(months)} month(s) of existing rows)")
+    return True
+
+
+def _pg_partitions(conn):
+    """[(period, partition name)] of the monthly partitions, oldest first"""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:name)"
+    ), {'name': TABLE}).scalars()
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions.append((date(int(match.group(1)), int(match.group(2)), 1), name))
+    return sorted(partitions)
+
+
+def _pg_create_partition(conn, period):
+    name = partition_name(period)
+    if conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar():
+        return False
+    bounds = {'start': period, 'end': add_months(period, 1)}
+    in_month = "date_recorded >= :start AND date_recorded < :end"
+    values = f"FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"
+    stray = conn.execute(text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_month} LIMIT 1"), bounds).first()
+    if stray is None:
+        conn.execute(text(f"CREATE TABLE {name} PARTITION OF {TABLE} {values}"))
+    else:
+        # The month's rows landed in the default partition; they move before it is attached
+        conn.execute(text(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)"))
+        conn.execute(text(f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE {in_month}"), bounds)
+        conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_month}"), bounds)
+        conn.execute(text(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} {values}"))
+    return True
+
+
+def _pg_drop_before(conn, cutoff):
+    first_kept = month_start(cutoff)
+    removed = 0
+    for period, name in _pg_partitions(conn):
+        if period < first_kept:
+            removed += conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+            conn.execute(text(f"DROP TABLE {name}"))
+    # Pruned to the cutoff's month and the default partition
+    removed += conn.execute(text(f"DELETE FROM {TABLE} WHERE date_recorded < :cutoff"), {'cutoff': cutoff}).rowcount
+    return removed
+
+
+# SQLite
+
+def _catalog(conn):
+    return conn.exec_driver_sql(
+        f"SELECT period, table_name, archive_file FROM main.{CATALOG} ORDER BY period"
+    ).all()
+
+
+def _attach(conn, directory, archive_file):
+    schema = archive_schema(archive_file)
+    if schema not in {row[1] for row in conn.exec_driver_sql("PRAGMA database_list")}:
+        os.makedirs(directory, exist_ok=True)
+        conn.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (os.path.join(directory, archive_file),))
+    return schema
+
+
+def _sqlite_autoincrement(engine):
+    from models import Attendance
+    from migrations import ensure_indexes
+
+    rebuilt = f'{TABLE}_rebuild'
+    with engine.begin() as conn:
+        ddl = conn.exec_driver_sql(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (TABLE,)
+        ).scalar()
+        if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+            return False
+        live = {row[1] for row in conn.exec_driver_sql(f'PRAGMA main.table_info("{TABLE}")')}
+        columns = ', '.join(column.name for column in Attendance.__table__.columns if column.name in live)
+        create = str(CreateTable(Attendance.__table__).compile(dialect=engine.dialect))
+        conn.exec_driver_sql(f"DROP TABLE IF EXISTS main.{rebuilt}")
+        conn.exec_driver_sql(create.replace(f'CREATE TABLE {TABLE} ', f'CREATE TABLE main.{rebuilt} ', 1))
+        conn.exec_driver_sql(f"INSERT INTO main.{rebuilt} ({columns}) SELECT {columns} FROM main.{TABLE}")
+        conn.exec_driver_sql(f"DROP TABLE main.{TABLE}")
+        conn.exec_driver_sql(f"ALTER TABLE main.{rebuilt} RENAME TO {TABLE}")
+    ensure_indexes(Attendance)
+    logging.info("Attendance: rebuilt with AUTOINCREMENT ids")
+    return True
+
+
+def _sqlite_archive(engine):
+    directory = archive_directory(engine)
+    hot_from = add_months(month_start(date.today()), 1 - HOT_MONTHS)
+    with engine.connect() as conn:
+        periods = [date.fromisoformat(f'{month}-01') for month in conn.exec_driver_sql(
+            f"SELECT DISTINCT substr(date_recorded, 1, 7) FROM main.{TABLE} "
+            f"WHERE date_recorded < ? ORDER BY 1", (hot_from.isoformat(),)
+        ).scalars()]
+        for period in periods:
+            _archive_month(conn, directory, period)
+    if periods:
+        logging.info(f"Attendance: archived {len(periods)} month(s) into {directory}")
+    return periods
+
+
+def _archive_month(conn, directory, period):
+    from models import Attendance
+
+    archive_file = f'{period.year}.db'
+    schema = _attach(conn, directory, archive_file)
+    table = partition_name(period)
+    columns = conn.exec_driver_sql(f'PRAGMA main.table_info("{TABLE}")').all()
+    existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA {schema}.table_info("{table}")')}
+    if not existing:
+        definitions = ', '.join(f'{row[1]} {row[2]}' + (' PRIMARY KEY' if row[5] else '') for row in columns)
+        conn.exec_driver_sql(f'CREATE TABLE {schema}.{table} ({definitions})')
+        for index in Attendance.__table__.indexes:
+            conn.exec_driver_sql(
+                f"CREATE INDEX {schema}.{index.name.replace(TABLE, table, 1)} "
+                f"ON {table} ({', '.join(column.name for column in index.columns)})"
+            )
+    else:
+        # Late rows for a month archived before a column was added
+        for row in columns:
+            if row[1] not in existing:
+                conn.exec_driver_sql(f'ALTER TABLE {schema}.{table} ADD COLUMN {row[1]} {row[2]}')
+
+    names = ', '.join(row[1] for row in columns)
+    bounds = (period.isoformat(), add_months(period, 1).isoformat())
+    # Copied and committed first: a crash before the delete below leaves the rows in the
+    # main table, and running again skips the ids the archive already has
+    conn.exec_driver_sql(
+        f"INSERT OR IGNORE INTO {schema}.{table} ({names}) SELECT {names} FROM main.{TABLE} "
+        f"WHERE date_recorded >= ? AND date_recorded < ?", bounds
+    )
+    conn.commit()
+    # The catalog entry and the delete commit together, so the rows are always visible exactly once
+    conn.exec_driver_sql(
+        f"INSERT OR IGNORE INTO main.{CATALOG} (period, table_name, archive_file, created_at) VALUES (?, ?, ?, ?)",
+        (period.isoformat(), table, archive_file, datetime.utcnow().isoformat(' '))
+    )
+    conn.exec_driver_sql(f"DELETE FROM main.{TABLE} WHERE date_recorded >= ? AND date_recorded < ?", bounds)
+    conn.commit()
+
+
+def _sqlite_drop_before(engine, cutoff):
+    directory = archive_directory(engine)
+    first_kept = month_start(cutoff)
+    removed = 0
+    with engine.connect() as conn:
+        partitions = [(date.fromisoformat(period), table, archive_file)
+                      for period, table, archive_file in _catalog(conn)]
+        expired = [partition for partition in partitions if partition[0] < first_kept]
+        for period, table, archive_file in expired:
+            schema = _attach(conn, directory, archive_file)
+            removed += conn.exec_driver_sql(f"SELECT count(*) FROM {schema}.{table}").scalar()
+
+        # Out of the catalog first, so connections stop reading the months before they are dropped
+        conn.exec_driver_sql(f"DELETE FROM main.{CATALOG} WHERE period < ?", (first_kept.isoformat(),))
+        removed += conn.exec_driver_sql(
+            f"DELETE FROM main.{TABLE} WHERE date_recorded < ?", (cutoff.isoformat(),)
+        ).rowcount
+        conn.commit()
+
+        for period, table, archive_file in expired:
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {archive_schema(archive_file)}.{table}")
+        for period, table, archive_file in partitions:
+            if period == first_kept and cutoff > first_kept:
+                schema = _attach(conn, directory, archive_file)
+                removed += conn.exec_driver_sql(
+                    f"DELETE FROM {schema}.{table} WHERE date_recorded < ?", (cutoff.isoformat(),)
+                ).rowcount
+        conn.commit()
+
+        # A year with none of its months left goes entirely
+        kept_files = {archive_file for period, _, archive_file in partitions if period >= first_kept}
+        for archive_file in {archive_file for _, _, archive_file in expired} - kept_files:
+            conn.exec_driver_sql(f"DETACH DATABASE {archive_schema(archive_file)}")
+            try:
+                os.remove(os.path.join(directory, archive_file))
+            except OSError as e:
+                logging.warning(f"Could not remove attendance archive {archive_file}: {e}")
+    return removed
+
+
+if __name__ == "__main__":
+    import argparse
+    from app import app, db
+
+    parser = argparse.ArgumentParser(description="Create or archive monthly attendance partitions")
+    parser.add_argument('--list', action='store_true', help="list the partitions and their row counts")
+    args = parser.parse_args()
+
+    with app.app_context():
+        handled = maintain_partitions()
+        db.session.commit()
+        print(f"{len(handled)} month(s) created or archived" +
+              (f": {', '.join(f'{period:%Y-%m}' for period in handled)}" if handled else ""))
+        if args.list:
+            for period, location, rows in list_partitions():
+                print(f"{period:%Y-%m}  {rows:>8}  {location}")
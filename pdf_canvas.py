@@ -0,0 +1,122 @@
+"""A minimal PDF writer for fixed layouts: text, lines and boxes on A4 pages.
+
+Uses the standard Helvetica fonts every PDF reader has, so nothing is embedded
+and there is no layout engine; callers place everything themselves, with y
+measured down from the top of the page. Text must fit the WinAnsi (cp1252)
+character set; anything else raises UnicodeEncodeError so the caller can fall
+back to the HTML renderer.
+"""
+import zlib
+
+PAGE_WIDTH, PAGE_HEIGHT = 595.28, 841.89  # A4 in points
+
+# Advance widths (1/1000 em) of characters 32-126 from the standard font metrics
+_HELVETICA = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_HELVETICA_BOLD = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+FONTS = {False: ('F1', 'Helvetica', _HELVETICA), True: ('F2', 'Helvetica-Bold', _HELVETICA_BOLD)}
+
+
+def hex_color(value):
+    """'#344e80' -> (r, g, b) in 0-1"""
+    value = value.lstrip('#')
+    return tuple(int(value[i:i + 2], 16) / 255 for i in (0, 2, 4))
+
+
+def text_width(value, size, bold=False):
+    widths = FONTS[bool(bold)][2]
+    return sum(widths[ord(ch) - 32] if 32 <= ord(ch) <= 126 else 556 for ch in str(value)) * size / 1000
+
+
+def _escape(data):
+    return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+class PDFCanvas:
+    """Drawing operations collected per page and written out as one PDF"""
+
+    def __init__(self, title=None):
+        self.title = title
+        self._pages = []
+        self.new_page()
+
+    def new_page(self):
+        self._ops = []
+        self._pages.append(self._ops)
+
+    @staticmethod
+    def _color(color, operator):
+        return b'%.3f %.3f %.3f %s' % (*color, operator)
+
+    def text(self, x, y, value, size=10, bold=False, color=(0.2, 0.2, 0.2), align='left'):
+        """Draw value with its baseline at y; align 'center' or 'right' makes x the middle or end"""
+        value = str(value)
+        if align == 'center':
+            x -= text_width(value, size, bold) / 2
+        elif align == 'right':
+            x -= text_width(value, size, bold)
+        font = FONTS[bool(bold)][0].encode()
+        self._ops.append(b'BT %s /%s %.1f Tf %.2f %.2f Td (%s) Tj ET' % (
+            self._color(color, b'rg'), font, size, x, PAGE_HEIGHT - y, _escape(value.encode('cp1252'))))
+
+    def rect(self, x, y, width, height, fill=None, stroke=None, line_width=0.5):
+        """A box whose top-left corner is (x, y)"""
+        ops = [b'%.2f w' % line_width]
+        if fill:
+            ops.append(self._color(fill, b'rg'))
+        if stroke:
+            ops.append(self._color(stroke, b'RG'))
+        paint = b'B' if fill and stroke else b'f' if fill else b'S'
+        ops.append(b'%.2f %.2f %.2f %.2f re %s' % (x, PAGE_HEIGHT - y - height, width, height, paint))
+        self._ops.append(b' '.join(ops))
+
+    def line(self, x1, y1, x2, y2, color=(0.87, 0.87, 0.87), line_width=0.5):
+        self._ops.append(b'%.2f w %s %.2f %.2f m %.2f %.2f l S' % (
+            line_width, self._color(color, b'RG'), x1, PAGE_HEIGHT - y1, x2, PAGE_HEIGHT - y2))
+
+    def output(self):
+        """The finished document as bytes"""
+        objects = [None, None]  # catalog and page tree, filled in below
+        for _, base, _ in FONTS.values():
+            objects.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>'
+                           % base.encode())
+        resources = b'<< /Font << /F1 3 0 R /F2 4 0 R >> >>'
+        kids = []
+        for ops in self._pages:
+            stream = zlib.compress(b'\n'.join(ops))
+            objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(stream), stream))
+            objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources %s /Contents %d 0 R >>'
+                           % (PAGE_WIDTH, PAGE_HEIGHT, resources, len(objects)))
+            kids.append(b'%d 0 R' % len(objects))
+        objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+        objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), len(kids))
+        info = None
+        if self.title:
+            objects.append(b'<< /Title (%s) /Producer (MENTORSCUE) >>'
+                           % _escape(str(self.title).encode('cp1252', 'replace')))
+            info = len(objects)
+
+        out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(out))
+            out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+        xref = len(out)
+        out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        out += b'trailer\n<< /Size %d /Root 1 0 R%s >>\nstartxref\n%d\n%%%%EOF\n' % (
+            len(objects) + 1, b' /Info %d 0 R' % info if info else b'', xref)
+        return bytes(out)
@@ -1,102 +1,316 @@
+"""Invoice and receipt PDFs, through a backend chosen per document type.
+
+"weasyprint" renders the templates in templates/pdf. Templates are compiled
+once per process, and their bytecode is kept in PDF_TEMPLATE_CACHE_DIR so a
+freshly started worker loads them without compiling; the shared stylesheet is
+parsed once into a WeasyPrint CSS object. "direct" draws the same fixed
+layouts straight to PDF (pdf_canvas.py) at a fraction of the time and memory,
+falling back to WeasyPrint for text outside the standard PDF fonts.
+
+The backend per document type (pdf_backend_<type>) and the payment details
+printed on documents (payment_*) are Settings, read again only after Settings
+change. Compare the backends with `python benchmark_pdf.py`.
+"""
 import os
-from weasyprint import HTML, CSS
-from flask import render_template_string
-from datetime import datetime
+import logging
+import tempfile
+import threading
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from versioning import get_versions
+from db_routing import current_branch
+from pdf_canvas import PDFCanvas, PAGE_WIDTH, PAGE_HEIGHT, hex_color, text_width
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'pdf')
+BYTECODE_DIR = os.environ.get('PDF_TEMPLATE_CACHE_DIR',
+                              os.path.join(tempfile.gettempdir(), 'mentorscue-pdf-templates'))
+STYLESHEET = 'document.css'
+
+# Document type -> template in templates/pdf
+PDF_TEMPLATES = {
+    'student_invoice': 'student_invoice.html',
+    'tutor_receipt': 'tutor_receipt.html',
+}
+
+# Printed on documents; the defaults live in create_default_settings
+PAYMENT_SETTINGS = ('gpay_number', 'upi_id', 'contact_mobile')
+DEFAULT_BACKEND = 'weasyprint'
+
+_env = None
+_stylesheet = None
+_templates = {}
+_settings = None
+_settings_version = None
+_lock = threading.Lock()
+
+
+def _environment():
+    global _env
+    if _env is None:
+        os.makedirs(BYTECODE_DIR, exist_ok=True)
+        _env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=True, auto_reload=False,
+                           bytecode_cache=FileSystemBytecodeCache(BYTECODE_DIR, 'pdf-%s.cache'))
+    return _env
+
+
+def get_pdf_template(kind):
+    """The compiled template for a document type, loaded on first use"""
+    template = _templates.get(kind)
+    if template is None:
+        if kind not in PDF_TEMPLATES:
+            raise ValueError(f"Unknown PDF document type '{kind}'")
+        with _lock:
+            template = _templates.get(kind)
+            if template is None:
+                template = _templates[kind] = _environment().get_template(PDF_TEMPLATES[kind])
+    return template
+
+
+def get_stylesheet():
+    global _stylesheet
+    if _stylesheet is None:
+        from weasyprint import CSS
+        with _lock:
+            if _stylesheet is None:
+                _stylesheet = CSS(filename=os.path.join(TEMPLATE_DIR, STYLESHEET))
+    return _stylesheet
+
+
+def _document_settings():
+    # Payment details and backends, cached until the settings table changes
+    global _settings, _settings_version
+    from models import Settings
+    version = (current_branch(),) + tuple(version for _, (version, _) in sorted(get_versions([Settings]).items()))
+    with _lock:
+        if version == _settings_version:
+            return _settings
+
+    keys = [f'payment_{name}' for name in PAYMENT_SETTINGS] + [f'pdf_backend_{kind}' for kind in PDF_TEMPLATES]
+    settings = {row.key: row.value for row in Settings.query.filter(Settings.key.in_(keys)).all()}
+    with _lock:
+        _settings, _settings_version = settings, version
+    return settings
+
+
+def payment_details():
+    """{setting: value} for PAYMENT_SETTINGS"""
+    settings = _document_settings()
+    return {name: settings.get(f'payment_{name}', '') for name in PAYMENT_SETTINGS}
+
+
+def backend_for(kind):
+    """Name of the backend the Settings choose for a document type"""
+    name = _document_settings().get(f'pdf_backend_{kind}') or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        logging.warning(f"Unknown PDF backend '{name}' for {kind}; using {DEFAULT_BACKEND}")
+        return DEFAULT_BACKEND
+    return name
+
+
+class PDFBackend:
+    """Turns a document type and its template context into PDF bytes"""
+
+    name = None
+    label = None
+
+    def render(self, kind, context):
+        raise NotImplementedError
+
+
+class WeasyPrintBackend(PDFBackend):
+    name = 'weasyprint'
+    label = 'WeasyPrint (HTML templates)'
+
+    def render(self, kind, context):
+        from weasyprint import HTML
+        html = get_pdf_template(kind).render(**context)
+        return HTML(string=html, base_url=TEMPLATE_DIR).write_pdf(stylesheets=[get_stylesheet()])
+
+
+class DirectBackend(PDFBackend):
+    name = 'direct'
+    label = 'Direct drawing (fast, fixed layout)'
+
+    def render(self, kind, context):
+        layout = LAYOUTS.get(kind)
+        if layout is None:
+            raise ValueError(f"No direct layout for PDF document type '{kind}'")
+        canvas = PDFCanvas(title=layout.__doc__)
+        layout(canvas, **context)
+        return canvas.output()
+
+
+def render_pdf(kind, backend=None, **context):
+    """PDF bytes for a document type, through the given backend or the one Settings choose"""
+    context.setdefault('payment', payment_details())
+    name = backend or backend_for(kind)
+    try:
+        return BACKENDS[name].render(kind, context)
+    except UnicodeEncodeError:
+        if name == DEFAULT_BACKEND:
+            raise
+        # The standard PDF fonts only cover Western European text
+        logging.info(f"{kind} has text the {name} backend cannot draw; rendering with {DEFAULT_BACKEND}")
+        return BACKENDS[DEFAULT_BACKEND].render(kind, context)
+
+
+# Fixed layouts for the direct backend, matching templates/pdf
+MARGIN = 40
+CONTENT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+ROW_HEIGHT = 22
+PRIMARY = hex_color('#344e80')
+TEXT = hex_color('#333333')
+MUTED = hex_color('#666666')
+BORDER = hex_color('#dddddd')
+TOTAL_FILL = hex_color('#f9f9f9')
+BOX_FILL = hex_color('#f5f5f5')
+WHITE = (1, 1, 1)
+
+
+def _fit(value, width, size, bold=False):
+    value = str(value)
+    if text_width(value, size, bold) <= width:
+        return value
+    while value and text_width(value + '...', size, bold) > width:
+        value = value[:-1]
+    return value + '...'
+
+
+def _money(value):
+    return f"{value or 0:.2f}"
+
+
+def _header(canvas, title):
+    canvas.text(PAGE_WIDTH / 2, 70, 'MENTORSCUE', size=24, bold=True, color=PRIMARY, align='center')
+    canvas.text(PAGE_WIDTH / 2, 100, title, size=16, color=TEXT, align='center')
+    return 135
+
+
+def _fields(canvas, y, fields, heading=None):
+    if heading:
+        canvas.text(MARGIN, y, heading, size=13, bold=True, color=TEXT)
+        y += 20
+    for label, value in fields:
+        label = f"{label}: "
+        canvas.text(MARGIN, y, label, bold=True, color=TEXT)
+        offset = text_width(label, 10, True)
+        canvas.text(MARGIN + offset, y, _fit(value, CONTENT_WIDTH - offset, 10), color=TEXT)
+        y += 15
+    return y + 12
+
+
+def _ensure_room(canvas, y, height):
+    if y + height > PAGE_HEIGHT - MARGIN:
+        canvas.new_page()
+        return MARGIN
+    return y
+
+
+def _row(canvas, y, cells, widths, bold=False, fill=None, color=TEXT):
+    x = MARGIN
+    for value, width in zip(cells, widths):
+        canvas.rect(x, y, width, ROW_HEIGHT, fill=fill, stroke=BORDER)
+        canvas.text(x + 6, y + 15, _fit(value, width - 12, 10, bold), bold=bold, color=color)
+        x += width
+
+
+def _table(canvas, y, headers, rows, total_label, total_value, widths):
+    """Header, rows and a total row; the header repeats on every page the rows run onto"""
+    widths = [CONTENT_WIDTH * share for share in widths]
+    y = _ensure_room(canvas, y, ROW_HEIGHT * 2)
+    _row(canvas, y, headers, widths, bold=True, fill=PRIMARY, color=WHITE)
+    y += ROW_HEIGHT
+    for cells in rows:
+        if y + ROW_HEIGHT > PAGE_HEIGHT - MARGIN:
+            canvas.new_page()
+            y = MARGIN
+            _row(canvas, y, headers, widths, bold=True, fill=PRIMARY, color=WHITE)
+            y += ROW_HEIGHT
+        _row(canvas, y, cells, widths)
+        y += ROW_HEIGHT
+    y = _ensure_room(canvas, y, ROW_HEIGHT)
+    _row(canvas, y, [total_label, total_value], [sum(widths[:-1]), widths[-1]], bold=True, fill=TOTAL_FILL)
+    return y + ROW_HEIGHT + 20
+
+
+def _box(canvas, y, heading, fields, note):
+    height = 40 + 15 * len(fields) + 25
+    y = _ensure_room(canvas, y, height)
+    canvas.rect(MARGIN, y, CONTENT_WIDTH, height, fill=BOX_FILL)
+    canvas.text(MARGIN + 15, y + 25, heading, size=13, bold=True, color=TEXT)
+    line = y + 45
+    for label, value in fields:
+        label = f"{label}: "
+        canvas.text(MARGIN + 15, line, label, bold=True, color=TEXT)
+        canvas.text(MARGIN + 15 + text_width(label, 10, True), line, value, color=TEXT)
+        line += 15
+    canvas.text(MARGIN + 15, line + 10, note, color=TEXT)
+    return y + height + 30
+
+
+def _footer(canvas, y, text):
+    y = _ensure_room(canvas, y, 20)
+    canvas.text(PAGE_WIDTH / 2, y, text, size=9, color=MUTED, align='center')
+
+
+def draw_student_invoice(canvas, invoice, student, payment):
+    """Student Invoice"""
+    y = _header(canvas, 'Student Invoice')
+    y = _fields(canvas, y, [
+        ('Invoice Number', invoice.invoice_number),
+        ('Generated Date', invoice.generated_at.strftime('%d/%m/%Y')),
+        ('Billing Period', f"{invoice.start_date.strftime('%d/%m/%Y')} to {invoice.end_date.strftime('%d/%m/%Y')}"),
+    ])
+    y = _fields(canvas, y, [
+        ('Student Name', student.full_name),
+        ('Class Level', student.class_level),
+        ('Subjects', student.subjects),
+        ('Parent Name', student.parent_name),
+        ('Parent WhatsApp', student.parent_whatsapp),
+    ], heading='Student Information')
+    y = _table(canvas, y, ['Description', 'Quantity', 'Rate (Rs.)', 'Amount (Rs.)'],
+               [['Classes Attended', invoice.total_classes, _money(student.per_class_fee),
+                 _money(invoice.total_amount)]],
+               'Total Amount Due', f"Rs. {_money(invoice.total_amount)}", [0.4, 0.2, 0.2, 0.2])
+    fields = [(label, payment[key]) for label, key in (('GPay', 'gpay_number'), ('UPI ID', 'upi_id'))
+              if payment.get(key)]
+    y = _box(canvas, y, 'Payment Instructions', fields,
+             'Please send payment confirmation screenshot to complete the payment process.')
+    _footer(canvas, y, 'Thank you for choosing MENTORSCUE for your educational needs.')
+
+
+def draw_tutor_receipt(canvas, receipt, tutor, student_summary, payment):
+    """Tutor Salary Receipt"""
+    y = _header(canvas, 'Tutor Salary Receipt')
+    y = _fields(canvas, y, [
+        ('Receipt Number', receipt.receipt_number),
+        ('Generated Date', receipt.generated_at.strftime('%d/%m/%Y')),
+        ('Payment Period', f"{receipt.start_date.strftime('%d/%m/%Y')} to {receipt.end_date.strftime('%d/%m/%Y')}"),
+    ])
+    fields = [('Tutor Name', tutor.full_name), ('Mobile Number', tutor.mobile)]
+    if tutor.upi_id:
+        fields.append(('UPI ID', tutor.upi_id))
+    y = _fields(canvas, y, fields, heading='Tutor Information')
+    y = _table(canvas, y, ['Student Name', 'Classes Taught', 'Pay per Class (Rs.)', 'Total Earning (Rs.)'],
+               [[details['name'], details['classes'], _money(details['pay_rate']), _money(details['total_earning'])]
+                for details in student_summary.values()],
+               'Total Payout Due', f"Rs. {_money(receipt.total_earnings)}", [0.4, 0.2, 0.2, 0.2])
+    fields = [('Mobile', payment['contact_mobile'])] if payment.get('contact_mobile') else []
+    y = _box(canvas, y, 'Contact Information', fields, 'Please contact for payment schedule and details.')
+    _footer(canvas, y, 'Thank you for your dedicated service to MENTORSCUE.')
+
+
+LAYOUTS = {
+    'student_invoice': draw_student_invoice,
+    'tutor_receipt': draw_tutor_receipt,
+}
+
+BACKENDS = {backend.name: backend for backend in (WeasyPrintBackend(), DirectBackend())}
+
 
 def generate_student_invoice_pdf(invoice):
     """Generate PDF for student invoice"""
     try:
-        student = invoice.student
-        
-        # HTML template for invoice
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                body { font-family: Arial, sans-serif; margin: 20px; color: #333; }
-                .header { text-align: center; margin-bottom: 30px; }
-                .company-name { font-size: 24px; font-weight: bold; color: #344e80; margin-bottom: 10px; }
-                .invoice-title { font-size: 18px; margin-bottom: 20px; }
-                .invoice-info { margin-bottom: 20px; }
-                .student-info { margin-bottom: 20px; }
-                .invoice-details { width: 100%; border-collapse: collapse; margin-bottom: 20px; }
-                .invoice-details th, .invoice-details td { border: 1px solid #ddd; padding: 8px; text-align: left; }
-                .invoice-details th { background-color: #344e80; color: white; }
-                .total-row { font-weight: bold; background-color: #f9f9f9; }
-                .payment-info { margin-top: 20px; padding: 15px; background-color: #f5f5f5; border-radius: 5px; }
-                .footer { margin-top: 30px; text-align: center; font-size: 12px; color: #666; }
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <div class="company-name">MENTORSCUE</div>
-                <div class="invoice-title">Student Invoice</div>
-            </div>
-            
-            <div class="invoice-info">
-                <strong>Invoice Number:</strong> {{ invoice.invoice_number }}<br>
-                <strong>Generated Date:</strong> {{ invoice.generated_at.strftime('%d/%m/%Y') }}<br>
-                <strong>Billing Period:</strong> {{ invoice.start_date.strftime('%d/%m/%Y') }} to {{ invoice.end_date.strftime('%d/%m/%Y') }}
-            </div>
-            
-            <div class="student-info">
-                <h3>Student Information</h3>
-                <strong>Student Name:</strong> {{ student.full_name }}<br>
-                <strong>Class Level:</strong> {{ student.class_level }}<br>
-                <strong>Subjects:</strong> {{ student.subjects }}<br>
-                <strong>Parent Name:</strong> {{ student.parent_name }}<br>
-                <strong>Parent WhatsApp:</strong> {{ student.parent_whatsapp }}
-            </div>
-            
-            <table class="invoice-details">
-                <thead>
-                    <tr>
-                        <th>Description</th>
-                        <th>Quantity</th>
-                        <th>Rate (₹)</th>
-                        <th>Amount (₹)</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    <tr>
-                        <td>Classes Attended</td>
-                        <td>{{ invoice.total_classes }}</td>
-                        <td>{{ "%.2f"|format(student.per_class_fee) }}</td>
-                        <td>{{ "%.2f"|format(invoice.total_amount) }}</td>
-                    </tr>
-                    <tr class="total-row">
-                        <td colspan="3"><strong>Total Amount Due</strong></td>
-                        <td><strong>₹ {{ "%.2f"|format(invoice.total_amount) }}</strong></td>
-                    </tr>
-                </tbody>
-            </table>
-            
-            <div class="payment-info">
-                <h3>Payment Instructions</h3>
-                <strong>GPay:</strong> 7994829844<br>
-                <strong>UPI ID:</strong> Jafaraliva869@oksbi<br>
-                <br>
-                Please send payment confirmation screenshot to complete the payment process.
-            </div>
-            
-            <div class="footer">
-                Thank you for choosing MENTORSCUE for your educational needs.
-            </div>
-        </body>
-        </html>
-        """
-        
-        # Render HTML with data
-        html_content = render_template_string(html_template, invoice=invoice, student=student)
-        
-        # Generate PDF
-        html_doc = HTML(string=html_content)
-        pdf_bytes = html_doc.write_pdf()
-        
-        return pdf_bytes
-        
+        return render_pdf('student_invoice', invoice=invoice, student=invoice.student)
     except Exception as e:
         print(f"Error generating student invoice PDF: {str(e)}")
         return None
@@ -105,7 +319,7 @@ def generate_tutor_receipt_pdf(receipt):
     """Generate PDF for tutor receipt"""
     try:
         tutor = receipt.tutor
-        
+
         # Get attendance details for the period
         from models import Attendance
         attendance_records = Attendance.query.filter(
@@ -113,7 +327,7 @@ def generate_tutor_receipt_pdf(receipt):
             Attendance.date_recorded >= receipt.start_date,
             Attendance.date_recorded <= receipt.end_date
         ).all()
-        
+
         # Group by student
         student_summary = {}
         for record in attendance_records:
@@ -125,100 +339,12 @@ def generate_tutor_receipt_pdf(receipt):
                     'pay_rate': student.get_tutor_pay_rate(tutor.id),
                     'total_earning': 0.0
                 }
-            
+
             student_summary[student.id]['classes'] += 1
             student_summary[student.id]['total_earning'] += student_summary[student.id]['pay_rate']
-        
-        # HTML template for receipt
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                body { font-family: Arial, sans-serif; margin: 20px; color: #333; }
-                .header { text-align: center; margin-bottom: 30px; }
-                .company-name { font-size: 24px; font-weight: bold; color: #344e80; margin-bottom: 10px; }
-                .receipt-title { font-size: 18px; margin-bottom: 20px; }
-                .receipt-info { margin-bottom: 20px; }
-                .tutor-info { margin-bottom: 20px; }
-                .receipt-details { width: 100%; border-collapse: collapse; margin-bottom: 20px; }
-                .receipt-details th, .receipt-details td { border: 1px solid #ddd; padding: 8px; text-align: left; }
-                .receipt-details th { background-color: #344e80; color: white; }
-                .total-row { font-weight: bold; background-color: #f9f9f9; }
-                .payment-info { margin-top: 20px; padding: 15px; background-color: #f5f5f5; border-radius: 5px; }
-                .footer { margin-top: 30px; text-align: center; font-size: 12px; color: #666; }
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <div class="company-name">MENTORSCUE</div>
-                <div class="receipt-title">Tutor Salary Receipt</div>
-            </div>
-            
-            <div class="receipt-info">
-                <strong>Receipt Number:</strong> {{ receipt.receipt_number }}<br>
-                <strong>Generated Date:</strong> {{ receipt.generated_at.strftime('%d/%m/%Y') }}<br>
-                <strong>Payment Period:</strong> {{ receipt.start_date.strftime('%d/%m/%Y') }} to {{ receipt.end_date.strftime('%d/%m/%Y') }}
-            </div>
-            
-            <div class="tutor-info">
-                <h3>Tutor Information</h3>
-                <strong>Tutor Name:</strong> {{ tutor.full_name }}<br>
-                <strong>Mobile Number:</strong> {{ tutor.mobile }}<br>
-                {% if tutor.upi_id %}
-                <strong>UPI ID:</strong> {{ tutor.upi_id }}<br>
-                {% endif %}
-            </div>
-            
-            <table class="receipt-details">
-                <thead>
-                    <tr>
-                        <th>Student Name</th>
-                        <th>Classes Taught</th>
-                        <th>Pay per Class (₹)</th>
-                        <th>Total Earning (₹)</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {% for student_id, details in student_summary.items() %}
-                    <tr>
-                        <td>{{ details.name }}</td>
-                        <td>{{ details.classes }}</td>
-                        <td>{{ "%.2f"|format(details.pay_rate) }}</td>
-                        <td>{{ "%.2f"|format(details.total_earning) }}</td>
-                    </tr>
-                    {% endfor %}
-                    <tr class="total-row">
-                        <td colspan="3"><strong>Total Payout Due</strong></td>
-                        <td><strong>₹ {{ "%.2f"|format(receipt.total_earnings) }}</strong></td>
-                    </tr>
-                </tbody>
-            </table>
-            
-            <div class="payment-info">
-                <h3>Contact Information</h3>
-                <strong>Mobile:</strong> 8921378863<br>
-                <br>
-                Please contact for payment schedule and details.
-            </div>
-            
-            <div class="footer">
-                Thank you for your dedicated service to MENTORSCUE.
-            </div>
-        </body>
-        </html>
-        """
-        
-        # Render HTML with data
-        html_content = render_template_string(html_template, receipt=receipt, tutor=tutor, student_summary=student_summary)
-        
-        # Generate PDF
-        html_doc = HTML(string=html_content)
-        pdf_bytes = html_doc.write_pdf()
-        
-        return pdf_bytes
-        
+
+        return render_pdf('tutor_receipt', receipt=receipt, tutor=tutor, student_summary=student_summary)
+
     except Exception as e:
         print(f"Error generating tutor receipt PDF: {str(e)}")
         return None
@@ -0,0 +1,357 @@
+"""On-demand request profiling, switched on by admins for a route, a user or a share of requests.
+
+A rule picks requests by endpoint, username and/or a percentage, says how to
+profile them and when to stop (at most MAX_RULE_MINUTES ahead). Rules are kept
+in rules.json in PROFILE_DIR (default instance/profiles), so every worker on
+the machine follows them; a worker looks at the file at most once a second, and
+while no rule is live a request costs one clock comparison.
+
+"sample" records the request thread's stack every PROFILER_SAMPLE_MS (default
+5) from a helper thread and barely slows the request; "cprofile" runs cProfile
+for exact call counts at a much higher cost. Each profile is saved as
+<id>.json: the request, the top functions and, for samples, collapsed stacks
+(one "outer;...;inner count" line each) that flamegraph.pl and speedscope read.
+cProfile runs also keep <id>.prof for pstats and snakeviz. Beyond
+PROFILER_MAX_PROFILES (default 200) the oldest are deleted. Rules and profiles
+are managed at /admin/profiler.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import pstats
+import random
+import logging
+import cProfile
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+
+SAMPLE, CPROFILE = 'sample', 'cprofile'
+MODES = (SAMPLE, CPROFILE)
+
+SAMPLE_INTERVAL = float(os.environ.get('PROFILER_SAMPLE_MS', 5)) / 1000
+MAX_PROFILES = int(os.environ.get('PROFILER_MAX_PROFILES', 200))
+MAX_RULE_MINUTES = 24 * 60
+TOP_FUNCTIONS = 50
+RULES_FILE = 'rules.json'
+RELOAD_SECONDS = 1.0
+
+PROFILE_DIR = None  # set by init_profiler
+
+_lock = threading.Lock()
+_rules = []
+_rules_mtime = None
+_next_check = 0.0
+_root = os.path.dirname(os.path.abspath(__file__))
+
+
+def init_profiler(app):
+    """Profile the requests the live rules pick"""
+    global PROFILE_DIR
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+    @app.before_request
+    def start_profile():
+        rules = live_rules()
+        if not rules:
+            return
+        rule = _match(rules)
+        if rule is not None:
+            g.profile_capture = _Capture(rule)
+            g.profile_capture.start()
+
+    @app.after_request
+    def note_status(response):
+        capture = g.get('profile_capture')
+        if capture is not None:
+            capture.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def save_profile(exc=None):
+        capture = g.pop('profile_capture', None)
+        if capture is None:
+            return
+        try:
+            capture.stop()
+            capture.save()
+        except Exception as e:
+            logging.error(f"Error saving request profile: {e}")
+
+
+# Rules
+
+def _rules_path():
+    return os.path.join(PROFILE_DIR, RULES_FILE)
+
+
+def _read_rules():
+    try:
+        with open(_rules_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read profiling rules: {e}")
+        return []
+
+
+def _write_rules(rules):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # Written aside and renamed, so other workers never read half a file
+    temp = f'{_rules_path()}.{os.getpid()}.tmp'
+    with open(temp, 'w') as f:
+        json.dump(rules, f, indent=1)
+    os.replace(temp, _rules_path())
+    _reload(force=True)
+
+
+def _reload(force=False):
+    global _rules, _rules_mtime, _next_check
+    _next_check = time.monotonic() + RELOAD_SECONDS
+    try:
+        mtime = os.stat(_rules_path()).st_mtime_ns
+    except OSError:
+        mtime = None
+    if force or mtime != _rules_mtime:
+        _rules_mtime = mtime
+        _rules = _read_rules() if mtime is not None else []
+
+
+def live_rules():
+    """Rules that have not expired yet"""
+    if PROFILE_DIR is None:
+        return []
+    if time.monotonic() >= _next_check:
+        with _lock:
+            _reload()
+    if not _rules:
+        return []
+    now = time.time()
+    return [rule for rule in _rules if rule['expires_at'] > now]
+
+
+def add_rule(endpoint=None, username=None, percent=100, mode=SAMPLE, minutes=15, created_by=None):
+    """Start profiling the matching requests for the next minutes; returns the rule"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown profiling mode '{mode}'")
+    if not 0 < percent <= 100:
+        raise ValueError('Percentage must be between 1 and 100')
+    if not 0 < minutes <= MAX_RULE_MINUTES:
+        raise ValueError(f'A rule can run for at most {MAX_RULE_MINUTES} minutes')
+    rule = {'id': uuid.uuid4().hex[:8], 'endpoint': endpoint or None, 'username': username or None,
+            'percent': percent, 'mode': mode, 'created_by': created_by,
+            'created_at': time.time(), 'expires_at': time.time() + minutes * 60}
+    with _lock:
+        _write_rules([r for r in _read_rules() if r['expires_at'] > time.time()] + [rule])
+    return rule
+
+
+def remove_rule(rule_id):
+    with _lock:
+        _write_rules([rule for rule in _read_rules() if rule['id'] != rule_id and rule['expires_at'] > time.time()])
+
+
+def _match(rules):
+    for rule in rules:
+        if rule['endpoint'] != request.endpoint and (rule['endpoint'] or request.endpoint == 'static'):
+            continue
+        if rule['username'] and (not current_user.is_authenticated or current_user.username != rule['username']):
+            continue
+        if rule['percent'] < 100 and random.random() * 100 >= rule['percent']:
+            continue
+        return rule
+    return None
+
+
+# Capture
+
+def _short_path(filename):
+    if filename.startswith(_root):
+        return os.path.relpath(filename, _root)
+    # Library code: from the package directory on
+    return '/'.join(filename.replace('\\', '/').split('/')[-2:])
+
+
+def _label(code):
+    return f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})'.replace(';', ',')
+
+
+class _Sampler(threading.Thread):
+    """Counts the stacks one thread is in, every interval seconds"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class _Capture:
+    """One request being profiled"""
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.mode = rule['mode']
+        self.status = 500
+        self.profile = None
+        self.sampler = None
+
+    def start(self):
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        if self.mode == CPROFILE:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Another profiler is active in this process; fall back to sampling
+                self.profile, self.mode = None, SAMPLE
+        if self.mode == SAMPLE:
+            self.sampler = _Sampler(threading.get_ident(), SAMPLE_INTERVAL)
+            self.sampler.start()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.wall_ms = (time.perf_counter() - self.started) * 1000
+        self.cpu_ms = (time.thread_time() - self.cpu_started) * 1000
+
+    def save(self):
+        profile_id = f'{self.started_at:%Y%m%d-%H%M%S%f}-{uuid.uuid4().hex[:6]}'
+        record = {
+            'id': profile_id, 'rule': self.rule['id'], 'mode': self.mode,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'method': request.method, 'path': request.full_path.rstrip('?'), 'endpoint': request.endpoint,
+            'user': current_user.username if current_user.is_authenticated else None,
+            'status': self.status, 'wall_ms': round(self.wall_ms, 1), 'cpu_ms': round(self.cpu_ms, 1),
+        }
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if self.profile is not None:
+            self.profile.dump_stats(os.path.join(PROFILE_DIR, f'{profile_id}.prof'))
+            record['functions'] = _cprofile_functions(self.profile)
+        else:
+            record['samples'] = sum(self.sampler.stacks.values())
+            record['interval_ms'] = SAMPLE_INTERVAL * 1000
+            record['functions'] = _sampled_functions(self.sampler.stacks)
+            record['stacks'] = dict(self.sampler.stacks.most_common())
+        with open(os.path.join(PROFILE_DIR, f'{profile_id}.json'), 'w') as f:
+            json.dump(record, f)
+        _rotate()
+
+
+def _cprofile_functions(profile):
+    stats = pstats.Stats(profile).stats
+    rows = []
+    for (filename, line, name), (_, calls, self_time, total_time, _) in stats.items():
+        rows.append({'function': f'{name} ({_short_path(filename)}:{line})', 'calls': calls,
+                     'self_ms': round(self_time * 1000, 2), 'total_ms': round(total_time * 1000, 2)})
+    rows.sort(key=lambda row: row['total_ms'], reverse=True)
+    return rows[:TOP_FUNCTIONS]
+
+
+def _sampled_functions(stacks):
+    total, own = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        # Recursion counts once per sample
+        for frame in set(frames):
+            total[frame] += count
+    rows = [{'function': frame, 'samples': count, 'self_samples': own[frame]} for frame, count in total.items()]
+    rows.sort(key=lambda row: (row['samples'], row['self_samples']), reverse=True)
+    return rows[:TOP_FUNCTIONS]
+
+
+# Stored profiles
+
+def _rotate():
+    names = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.json') and name != RULES_FILE)
+    for name in names[:max(0, len(names) - MAX_PROFILES)]:
+        _delete(name[:-len('.json')])
+
+
+def _delete(profile_id):
+    for suffix in ('.json', '.prof'):
+        try:
+            os.remove(os.path.join(PROFILE_DIR, profile_id + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def _valid_id(profile_id):
+    return bool(profile_id) and all(ch.isalnum() or ch == '-' for ch in profile_id)
+
+
+def list_profiles(limit=100):
+    """The newest saved profiles, without their functions and stacks"""
+    if PROFILE_DIR is None or not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith('.json') and name != RULES_FILE),
+                   reverse=True)
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue  # rotated away meanwhile
+        record.pop('functions', None)
+        record.pop('stacks', None)
+        profiles.append(record)
+    return profiles
+
+
+def load_profile(profile_id):
+    """A saved profile, or None"""
+    if not _valid_id(profile_id):
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, f'{profile_id}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def profile_file(profile_id):
+    """Path of a cProfile run's pstats file, or None"""
+    if not _valid_id(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, f'{profile_id}.prof')
+    return path if os.path.exists(path) else None
+
+
+def collapsed_stacks(profile):
+    """Collapsed stack lines (flamegraph.pl, speedscope) for a sampled profile"""
+    return ''.join(f'{stack} {count}\n' for stack, count in profile.get('stacks', {}).items())
+
+
+def clear_profiles():
+    if PROFILE_DIR is None or not os.path.isdir(PROFILE_DIR):
+        return 0
+    ids = [name[:-len('.json')] for name in os.listdir(PROFILE_DIR) if name.endswith('.json') and name != RULES_FILE]
+    for profile_id in ids:
+        _delete(profile_id)
+    return len(ids)
@@ -0,0 +1,323 @@
+"""Query result cache for read-mostly pages, keyed by statement, parameters and table versions.
+
+A select with FromCache(name) among its options is answered from the cache
+when the same statement with the same parameters already ran since the tables
+it reads last changed. Those tables come from the statement itself plus any the
+option names for eager loads. table_version (versioning.py) is bumped by every
+writing transaction as it commits, so keys built from it stay correct across
+workers, and this process also drops entries for those tables at that point.
+Results are stored pickled and merged into the session without loading, so
+cached objects behave like freshly queried ones.
+
+QUERY_CACHE picks the backend: "lru" (default; per process, QUERY_CACHE_SIZE
+entries), "sqlite" (a file shared by the workers on a host, QUERY_CACHE_PATH or
+instance/query_cache/query_cache.db) or "off". Its entries are unpickled, so
+the file and its folder are created private to the app's user, and are not
+used if anyone else owns them or can write to them.
+
+Credentials (CREDENTIAL_COLUMNS) never go in. Views defer them on cached
+selects, and any object that has one loaded anyway (it was already in the
+session) is pickled without it, so it loads again on access from the cache.
+
+Run `python query_cache.py [--clear]` to see or empty the shared sqlite cache.
+"""
+import io
+import os
+import time
+import pickle
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from sqlalchemy import event
+from sqlalchemy.orm import UserDefinedOption, loading
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.util import LRUCache
+from flask import g, has_request_context
+from versioning import get_versions, on_tables_changed
+from db_routing import current_branch
+
+_VERSIONS_KEY = 'query_cache_versions'
+
+# Password hashes (user) and tutors' plain-text passwords (tutor) never go in the cache
+CREDENTIAL_COLUMNS = {'user': ('password_hash',), 'tutor': ('password',)}
+
+
+class FromCache(UserDefinedOption):
+    """Serve this select from the query cache; depends_on lists models or tables read by its eager loads"""
+
+    propagate_to_loaders = False
+
+    def __init__(self, name, *depends_on):
+        self.name = name
+        self.depends_on = depends_on
+
+    def _gen_cache_key(self, anon_map, bindparams):
+        # Not part of SQLAlchemy's own compiled-statement cache key
+        return None
+
+
+class LRUBackend:
+    """Pickled results in this process; the least recently used go beyond max_entries"""
+
+    name = 'lru'
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (tables, pickled result)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, tables, data):
+        with self._lock:
+            self._entries[key] = (frozenset(tables), data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        with self._lock:
+            stale = [key for key, (depends_on, _) in self._entries.items() if depends_on & tables]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': sum(len(data) for _, data in self._entries.values()),
+                    'evictions': self.evictions}
+
+
+class SQLiteBackend:
+    """Pickled results in a SQLite file shared by every worker on this host; oldest go beyond max_entries"""
+
+    name = 'sqlite'
+
+    def __init__(self, path, max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        _check_private(directory, 0o022)
+        _check_private(path, 0o077)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS query_cache (key TEXT PRIMARY KEY, tables TEXT NOT NULL, "
+            "value BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        # One connection per thread and process; autocommit, so readers never hold locks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            _check_private(self.path, 0o077)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")  # a lost write is only a cache miss
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value FROM query_cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, tables, data):
+        conn = self._connect()
+        # Tables are stored space-delimited so invalidate can match whole names
+        conn.execute("INSERT OR REPLACE INTO query_cache (key, tables, value, created_at) VALUES (?, ?, ?, ?)",
+                     (key, f" {' '.join(sorted(tables))} ", data, time.time()))
+        if random.random() < 0.05:
+            conn.execute("DELETE FROM query_cache WHERE key IN "
+                         "(SELECT key FROM query_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+
+    def invalidate(self, tables):
+        conn = self._connect()
+        removed = 0
+        for table in tables:
+            removed += conn.execute("DELETE FROM query_cache WHERE tables LIKE ?", (f'% {table} %',)).rowcount
+        return removed
+
+    def clear(self):
+        self._connect().execute("DELETE FROM query_cache")
+
+    def stats(self):
+        entries, size = self._connect().execute(
+            "SELECT count(*), coalesce(sum(length(value)), 0) FROM query_cache").fetchone()
+        return {'entries': entries, 'bytes': size, 'evictions': None}
+
+
+def _check_private(path, forbidden_mode):
+    """Refuse a cache path that another user owns or could have written pickles into"""
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & forbidden_mode:
+        raise PermissionError(f"Query cache path {path} must be owned by this user and not writable by others "
+                              f"(owner uid {info.st_uid}, mode {oct(info.st_mode & 0o777)})")
+
+
+def default_cache_path(app):
+    return os.environ.get('QUERY_CACHE_PATH', os.path.join(app.instance_path, 'query_cache', 'query_cache.db'))
+
+
+BACKENDS = {'lru': LRUBackend, 'sqlite': SQLiteBackend}
+
+_backend = None
+_statements = LRUCache(500)  # compiled SQL per statement shape, for building keys
+_counts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+_counts_lock = threading.Lock()
+
+
+def backend_from_env(app):
+    name = os.environ.get('QUERY_CACHE', 'lru')
+    if name == 'off':
+        return None
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown QUERY_CACHE backend '{name}' (choose from {', '.join(BACKENDS)} or off)")
+    if name == 'lru':
+        return LRUBackend(int(os.environ.get('QUERY_CACHE_SIZE', 500)))
+    return SQLiteBackend(default_cache_path(app), max_entries=int(os.environ.get('QUERY_CACHE_SIZE', 5000)))
+
+
+def init_query_cache(app, session_class, backend=None):
+    """Serve FromCache selects made through session_class (register after the loader profiles)"""
+    global _backend
+    _backend = backend or backend_from_env(app)
+    if _backend is None:
+        return
+    event.listen(session_class, 'do_orm_execute', _execute)
+    on_tables_changed(_invalidate)
+    logging.info(f"Query cache enabled: {_backend.name}")
+
+
+def _table_names(tables):
+    return {table if isinstance(table, str) else getattr(table, '__table__', table).name for table in tables}
+
+
+def table_versions(tables):
+    """Sorted (table, version) pairs for a set of table names, read once per request"""
+    # A commit in this process drops the request's copy (see _invalidate)
+    known = g.setdefault(_VERSIONS_KEY, {}) if has_request_context() else {}
+    missing = tables - known.keys()
+    if missing:
+        known.update({name: version for name, (version, _) in get_versions(missing).items()})
+    return sorted((name, known[name]) for name in tables)
+
+
+def _count(name, outcome):
+    with _counts_lock:
+        _counts[name][outcome] += 1
+
+
+def _execute(orm_execute_state):
+    state = orm_execute_state
+    # Eager and deferred loads run under the cached select and are stored with its result
+    if not state.is_select or state.is_relationship_load or state.is_column_load:
+        return None
+    option = next((opt for opt in state.user_defined_options if isinstance(opt, FromCache)), None)
+    if option is None:
+        return None
+
+    statement = state.statement
+    tables = {table.name for table in find_tables(statement)} | _table_names(option.depends_on)
+    sql = statement._generate_cache_key().to_offline_string(_statements, statement, state.parameters or {})
+    raw = repr((option.name, current_branch(), sql, table_versions(tables)))
+    key = hashlib.sha1(raw.encode()).hexdigest()
+
+    frozen = None
+    data = _backend.get(key)
+    if data is not None:
+        try:
+            frozen = pickle.loads(data)
+            _count(option.name, 'hits')
+        except Exception as e:
+            logging.warning(f"Discarding unreadable query cache entry for {option.name}: {str(e)}")
+    if frozen is None:
+        _count(option.name, 'misses')
+        frozen = state.invoke_statement().freeze()
+        try:
+            _backend.set(key, tables, _dumps(frozen))
+        except Exception as e:
+            logging.error(f"Error storing query cache entry for {option.name}: {str(e)}")
+    return loading.merge_frozen_result(state.session, statement, frozen, load=False)()
+
+
+class _CachePickler(pickle.Pickler):
+    """Pickles results with credential columns left out of every object, wherever it sits in them"""
+
+    def reducer_override(self, obj):
+        state = None if isinstance(obj, type) else getattr(obj, '_sa_instance_state', None)
+        columns = CREDENTIAL_COLUMNS.get(state.mapper.local_table.name, ()) if state is not None else ()
+        if not any(column in state.dict for column in columns):
+            return NotImplemented
+        reduced = obj.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+        # Left out like a deferred column: an object merged from the cache loads it on access
+        attributes = {key: value for key, value in reduced[2].items() if key not in columns}
+        return reduced[:2] + (attributes,) + reduced[3:]
+
+
+def _dumps(frozen):
+    buffer = io.BytesIO()
+    _CachePickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(frozen)
+    return buffer.getvalue()
+
+
+def _invalidate(tables):
+    if has_request_context():
+        g.pop(_VERSIONS_KEY, None)
+    if _backend is not None:
+        try:
+            _backend.invalidate(set(tables))
+        except Exception as e:
+            logging.error(f"Error invalidating query cache: {str(e)}")
+
+
+def clear_query_cache():
+    if _backend is not None:
+        _backend.clear()
+    with _counts_lock:
+        _counts.clear()
+
+
+def query_cache_stats():
+    """Hit ratios per cached query in this process, plus the backend's size"""
+    with _counts_lock:
+        queries = {name: dict(counts, ratio=counts['hits'] / ((counts['hits'] + counts['misses']) or 1))
+                   for name, counts in sorted(_counts.items())}
+    hits = sum(counts['hits'] for counts in queries.values())
+    misses = sum(counts['misses'] for counts in queries.values())
+    stats = {'backend': _backend.name if _backend else 'off', 'hits': hits, 'misses': misses,
+             'ratio': hits / ((hits + misses) or 1), 'queries': queries}
+    if _backend is not None:
+        stats.update(_backend.stats())
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Show or clear the shared sqlite query cache")
+    parser.add_argument('--clear', action='store_true', help="remove every entry")
+    args = parser.parse_args()
+
+    cache = SQLiteBackend(default_cache_path(app))
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print(f"{cache.path}: {stats['entries']} entries, {stats['bytes'] / 1024:.1f} KiB")
@@ -0,0 +1,342 @@
+"""WhatsApp dues reminders: select, render, queue, dispatch.
+
+Reminders for every unpaid student invoice are picked in one query from the
+account balances, using the same ageing as the dues page, and rendered from the
+reminders_* settings. They are queued in outbound_message with a dedupe key
+per invoice and ageing stage, so a parent gets at most one message per stage
+however often the job runs. Dispatch claims small batches of due messages, sends them
+through the configured sender at a limited rate, commits each message's state
+as soon as it is sent, and retries failures with exponential backoff.
+
+WHATSAPP_SENDER picks the sender: "file" (default) appends JSON lines to
+WHATSAPP_OUTBOX for local testing, "http" posts to WHATSAPP_API_URL.
+Run `python reminders.py [--dispatch-only]` from a scheduler.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import urllib.request
+import urllib.error
+from datetime import datetime, timedelta
+from app import app, db
+from models import Student, StudentInvoice, AccountBalance, OutboundMessage, Settings, insert_ignore
+from ledger import STUDENT, dues_status
+from db_routing import current_branch, branch_context
+
+# Ageing stages that get a reminder, as in ledger.dues_status
+STAGES = ('first_5_days', 'next_5_days', 'after_10_days', 'partial_payment')
+
+QUEUED, SENDING, SENT, FAILED = 'queued', 'sending', 'sent', 'failed'
+
+RATE_PER_SECOND = float(os.environ.get('WHATSAPP_RATE_PER_SECOND', 5))
+MAX_ATTEMPTS = int(os.environ.get('WHATSAPP_MAX_ATTEMPTS', 5))
+BATCH_SIZE = 20
+# Seconds the HTTP sender waits for the gateway
+SEND_TIMEOUT = 10
+# A claimed message not finished within this long (e.g. the worker died) is sent again. It covers
+# a whole batch timing out behind the rate limit twice over, so a live worker never loses its claim
+_SEND_SECONDS = SEND_TIMEOUT + (1 / RATE_PER_SECOND if RATE_PER_SECOND > 0 else 0)
+CLAIM_LEASE = timedelta(seconds=max(600, 2 * BATCH_SIZE * _SEND_SECONDS))
+
+
+class SendError(Exception):
+    """A message could not be delivered; retryable errors are tried again later"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class FileSender:
+    """Local stand-in for a WhatsApp API: appends each message to a JSON-lines file"""
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('WHATSAPP_OUTBOX', 'whatsapp_outbox.jsonl')
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        line = json.dumps({'id': message.id, 'to': message.recipient, 'body': message.body,
+                           'sent_at': datetime.utcnow().isoformat()})
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+class HttpSender:
+    """POSTs {"to", "body", "reference"} as JSON to a WhatsApp gateway"""
+
+    def __init__(self, url=None, token=None, timeout=SEND_TIMEOUT):
+        self.url = url or os.environ['WHATSAPP_API_URL']
+        self.token = token or os.environ.get('WHATSAPP_API_TOKEN')
+        self.timeout = timeout
+
+    def send(self, message):
+        payload = json.dumps({'to': message.recipient, 'body': message.body,
+                              'reference': message.dedupe_key}).encode()
+        request = urllib.request.Request(self.url, data=payload, method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        if self.token:
+            request.add_header('Authorization', f'Bearer {self.token}')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except urllib.error.HTTPError as e:
+            # Rate limited or a server error may succeed later; other client errors won't
+            raise SendError(f'HTTP {e.code}: {e.reason}', retryable=e.code == 429 or e.code >= 500)
+        except (urllib.error.URLError, TimeoutError) as e:
+            raise SendError(str(e))
+
+
+SENDERS = {'file': FileSender, 'http': HttpSender}
+
+
+def get_sender(name=None):
+    name = name or os.environ.get('WHATSAPP_SENDER', 'file')
+    if name not in SENDERS:
+        raise ValueError(f"Unknown WhatsApp sender '{name}' (choose from {', '.join(SENDERS)})")
+    return SENDERS[name]()
+
+
+class RateLimiter:
+    """Token bucket: at most `rate` sends per second on average, bursts up to `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.updated = time.monotonic()
+            self.tokens = 1
+        self.tokens -= 1
+
+
+# Placeholders a reminder template can use
+TEMPLATE_FIELDS = ('parent_name', 'student_name', 'invoice_number', 'invoice_date', 'amount_due', 'days_overdue')
+
+
+def template_for(stage):
+    return Settings.get_setting(f'reminders_{stage}',
+                                'Dear {parent_name}, Rs. {amount_due} for {student_name} is due '
+                                '(invoice {invoice_number}).')
+
+
+class _Fields(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'  # Unknown placeholders are left as typed
+
+
+def render(template, **fields):
+    """The template with its placeholders filled; ValueError if it is malformed (a stray brace, {0}, ...)"""
+    try:
+        return template.format_map(_Fields(fields))
+    except Exception as e:
+        raise ValueError(f'Invalid reminder template: {str(e)}') from e
+
+
+def validate_template(template):
+    """Raise ValueError unless the template renders with every field filled in"""
+    render(template, parent_name='Parent', student_name='Student', invoice_number='MC-INV-202601-00001',
+           invoice_date='01 Jan 2026', amount_due='1000.00', days_overdue=5)
+    return template
+
+
+def due_reminders(today=None, stages=STAGES):
+    """(student, account, stage) for every active student whose latest invoice is unpaid"""
+    today = today or datetime.utcnow().date()
+    rows = db.session.execute(
+        db.select(Student, AccountBalance)
+        .join(AccountBalance, db.and_(AccountBalance.entity_type == STUDENT, AccountBalance.entity_id == Student.id))
+        .where(Student.status == 'Active', AccountBalance.latest_document_id.isnot(None),
+               AccountBalance.latest_status != 'Paid',
+               AccountBalance.latest_amount > db.func.coalesce(AccountBalance.latest_paid, 0))
+    ).all()
+    for student, account in rows:
+        stage = dues_status(account, False, today)
+        if stage in stages:
+            yield student, account, stage
+
+
+def enqueue_reminders(today=None, stages=STAGES):
+    """Queue a reminder for each due invoice and stage not already messaged; returns how many were new"""
+    today = today or datetime.utcnow().date()
+    templates = {stage: template_for(stage) for stage in stages}
+    invoice_numbers = {}
+    reminders = list(due_reminders(today, stages))
+    if reminders:
+        invoice_numbers = dict(db.session.execute(
+            db.select(StudentInvoice.id, StudentInvoice.invoice_number)
+            .where(StudentInvoice.id.in_([account.latest_document_id for _, account, _ in reminders]))
+        ).all())
+
+    now = datetime.utcnow()
+    rows = []
+    for student, account, stage in reminders:
+        recipient = ''.join(ch for ch in student.parent_whatsapp if ch.isdigit())
+        if not recipient:
+            continue
+        row = {'recipient': recipient, 'student_id': student.id, 'invoice_id': account.latest_document_id,
+               'dedupe_key': f"dues:{account.latest_document_id}:{stage}",
+               'status': QUEUED, 'attempts': 0, 'next_attempt_at': now, 'created_at': now, 'last_error': None}
+        try:
+            row['body'] = render(templates[stage], parent_name=student.parent_name, student_name=student.full_name,
+                                 invoice_number=invoice_numbers.get(account.latest_document_id, ''),
+                                 amount_due=f"{account.latest_amount - (account.latest_paid or 0):.2f}",
+                                 days_overdue=(today - account.latest_document_at.date()).days,
+                                 invoice_date=f"{account.latest_document_at:%d %b %Y}")
+        except ValueError as e:
+            # Only this message fails; retry_failed has it rendered again once the template is fixed
+            row.update(body='', status=FAILED, last_error=str(e))
+        rows.append(row)
+    if not rows:
+        return 0
+
+    # Keys already queued or sent are skipped by the unique index, not re-sent
+    statuses = db.session.scalars(
+        insert_ignore(OutboundMessage, 'dedupe_key').returning(OutboundMessage.status), rows
+    ).all()
+    db.session.commit()
+    queued, unrendered = statuses.count(QUEUED), statuses.count(FAILED)
+    logging.info(f"Dues reminders: queued {queued} of {len(rows)} ({len(rows) - len(statuses)} already sent or queued)")
+    if unrendered:
+        logging.error(f"Dues reminders: {unrendered} could not be rendered from their template")
+    return queued
+
+
+def _claim(limit):
+    """Take due messages for this worker; a lease keeps other workers off them"""
+    now = datetime.utcnow()
+    ids = db.session.execute(
+        db.select(OutboundMessage.id)
+        .where(OutboundMessage.status.in_([QUEUED, SENDING]), OutboundMessage.next_attempt_at <= now)
+        .order_by(OutboundMessage.next_attempt_at, OutboundMessage.id)
+        .limit(limit)
+    ).scalars().all()
+    if not ids:
+        return []
+    # Compare-and-set on next_attempt_at, so a message claimed concurrently is skipped
+    claimed = db.session.execute(
+        db.update(OutboundMessage)
+        .where(OutboundMessage.id.in_(ids), OutboundMessage.status.in_([QUEUED, SENDING]),
+               OutboundMessage.next_attempt_at <= now)
+        .values(status=SENDING, next_attempt_at=now + CLAIM_LEASE)
+        .returning(OutboundMessage.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.session.commit()
+    return OutboundMessage.query.filter(OutboundMessage.id.in_(claimed)).order_by(OutboundMessage.id).all()
+
+
+def dispatch(sender=None, limit=None, rate=RATE_PER_SECOND):
+    """Send due messages in batches until none are left (or `limit` were tried); returns counts"""
+    sender = sender or get_sender()
+    limiter = RateLimiter(rate)
+    counts = {SENT: 0, 'retrying': 0, FAILED: 0}
+    tried = 0
+    while limit is None or tried < limit:
+        # Taken before claiming, so it never falls after the lease _claim sets
+        claimed_until = datetime.utcnow() + CLAIM_LEASE
+        batch = _claim(BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - tried))
+        if not batch:
+            break
+        for message in batch:
+            limiter.wait()
+            if datetime.utcnow() >= claimed_until:
+                # The claim ran out, so another worker may take the rest; leave them to it
+                logging.warning("WhatsApp dispatch: claim expired before the batch was sent")
+                break
+            message.attempts += 1
+            try:
+                sender.send(message)
+                message.status, message.sent_at, message.last_error = SENT, datetime.utcnow(), None
+                counts[SENT] += 1
+            except Exception as e:
+                retryable = getattr(e, 'retryable', True) and message.attempts < MAX_ATTEMPTS
+                message.last_error = str(e)[:1000]
+                if retryable:
+                    message.status = QUEUED
+                    message.next_attempt_at = datetime.utcnow() + timedelta(minutes=2 ** message.attempts)
+                    counts['retrying'] += 1
+                else:
+                    message.status = FAILED
+                    counts[FAILED] += 1
+            # Committed one by one, so a worker dying mid-batch never sends these again
+            db.session.commit()
+            tried += 1
+    if tried:
+        logging.info(f"WhatsApp dispatch: {counts}")
+    return counts
+
+
+def queue_summary():
+    """{status: count} over the outbound queue"""
+    return dict(db.session.execute(
+        db.select(OutboundMessage.status, db.func.count()).group_by(OutboundMessage.status)
+    ).all())
+
+
+def retry_failed():
+    """Put failed messages back in the queue with a fresh set of attempts.
+
+    Messages that failed to render were never sent; they are dropped instead, so
+    the next reminder run renders them again from the current template.
+    """
+    unrendered = OutboundMessage.query.filter_by(status=FAILED, attempts=0).delete(synchronize_session=False)
+    count = OutboundMessage.query.filter_by(status=FAILED).update(
+        {'status': QUEUED, 'attempts': 0, 'next_attempt_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return count + unrendered
+
+
+def run_reminders(today=None, stages=STAGES):
+    """The reminder job: queue what is due, then send everything that is waiting"""
+    queued = enqueue_reminders(today, stages)
+    return queued, dispatch()
+
+
+_job_lock = threading.Lock()
+
+
+def start_reminder_job(stages=STAGES):
+    """Run the reminder job in a background thread of this process, unless one is already running"""
+    if not _job_lock.acquire(blocking=False):
+        return False
+    branch = current_branch()
+
+    def job():
+        try:
+            with app.app_context(), branch_context(branch):
+                try:
+                    run_reminders(stages=stages)
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            logging.error(f"Dues reminder job failed: {str(e)}")
+        finally:
+            _job_lock.release()
+
+    threading.Thread(target=job, name='dues-reminders', daemon=True).start()
+    return True
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Queue and send WhatsApp dues reminders")
+    parser.add_argument('--dispatch-only', action='store_true', help="send what is queued without adding reminders")
+    parser.add_argument('--stage', action='append', choices=STAGES, help="only remind these stages (repeatable)")
+    args = parser.parse_args()
+
+    with app.app_context():
+        added = 0 if args.dispatch_only else enqueue_reminders(stages=tuple(args.stage or STAGES))
+        result = dispatch()
+    print(f"{added} reminder(s) queued; {result[SENT]} sent, {result['retrying']} to retry, {result[FAILED]} failed")
@@ -0,0 +1,294 @@
+"""Financial reporting cube: money and classes per month, by class level, subject and tutor.
+
+Each month's cube rows are rebuilt from the payment ledger and attendance. Any
+flush that writes ledger entries or attendance also records the months it
+touched in report_dirty_period, so refresh_cube only rebuilds those months.
+Student amounts are shared out to tutors and subjects by the classes on their
+invoice; tutor amounts to class levels and subjects by the pay rate of each class.
+
+Billing and payment changes refresh the cube once they commit
+(refresh_after_commit); the report pages refresh whatever is still marked.
+
+Run `python reports.py` to refresh changed months, `--full` to rebuild every month.
+"""
+import io
+import csv
+import logging
+from itertools import chain
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event, inspect
+from app import db
+from models import (Student, Tutor, Subject, Attendance, StudentInvoice, TutorReceipt, LedgerEntry,
+                    ReportCube, ReportDirtyPeriod, student_tutors)
+
+MONEY = ('invoiced', 'collected', 'tutor_cost', 'paid_out')
+MEASURES = MONEY + ('classes',)
+DIMENSIONS = ('all', 'class_level', 'subject', 'tutor')
+
+# Ledger (entity_type, entry_type) -> measure
+_LEDGER_MEASURES = {
+    ('student', 'charge'): 'invoiced',
+    ('student', 'payment'): 'collected',
+    ('tutor', 'charge'): 'tutor_cost',
+    ('tutor', 'payment'): 'paid_out',
+}
+
+
+def period_of(moment):
+    return moment.strftime('%Y-%m')
+
+
+def _month_bounds(period):
+    start = datetime.strptime(period, '%Y-%m')
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+
+def init_report_cube(session_class):
+    """Mark the months touched by each flush as stale"""
+    event.listen(session_class, 'after_flush', _mark_dirty_periods)
+
+
+def _mark_dirty_periods(session, flush_context):
+    periods = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, LedgerEntry):
+            moments = [obj.created_at or datetime.utcnow()]
+        elif isinstance(obj, Attendance):
+            # A moved class leaves its old month stale too
+            moments = [obj.date_recorded, *inspect(obj).attrs.date_recorded.history.deleted]
+        else:
+            continue
+        periods.update(period_of(moment) for moment in moments if moment)
+    if periods:
+        now = datetime.utcnow()
+        session.execute(ReportDirtyPeriod.__table__.insert(),
+                        [{'period': period, 'created_at': now} for period in sorted(periods)])
+
+
+def refresh_after_commit(what):
+    """Refresh the cube after a committed change; a failure is logged and the months stay marked"""
+    try:
+        return refresh_cube()
+    except Exception as e:
+        logging.error(f"Error refreshing the report cube after {what}: {str(e)}")
+        return []
+
+
+def refresh_cube(full=False):
+    """Rebuild the cube rows of every month changed since the last refresh, and commit.
+
+    full=True rebuilds every month that has ledger entries or attendance; months whose
+    raw rows were flushed away then lose their history, so it is meant for repairs.
+    Returns the periods rebuilt.
+    """
+    last_mark = db.session.execute(db.select(db.func.max(ReportDirtyPeriod.id))).scalar()
+    if full:
+        periods = _all_periods()
+    elif last_mark is None:
+        return []
+    else:
+        periods = db.session.execute(
+            db.select(ReportDirtyPeriod.period).where(ReportDirtyPeriod.id <= last_mark).distinct()
+        ).scalars().all()
+
+    try:
+        for period in sorted(periods):
+            _rebuild_period(period)
+        if last_mark is not None:
+            # Marks added while we worked stay for the next refresh
+            db.session.execute(db.delete(ReportDirtyPeriod).where(ReportDirtyPeriod.id <= last_mark))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if periods:
+        logging.info(f"Report cube: rebuilt {len(periods)} month(s)")
+    return sorted(periods)
+
+
+def _all_periods():
+    bounds = [db.session.execute(db.select(db.func.min(column), db.func.max(column))).one()
+              for column in (LedgerEntry.created_at, Attendance.date_recorded)]
+    periods = [period_of(moment) for pair in bounds for moment in pair if moment]
+    if not periods:
+        return []
+    first, last = min(periods), max(periods)
+    periods, period = [], first
+    while period <= last:
+        periods.append(period)
+        period = period_of(_month_bounds(period)[1])
+    return periods
+
+
+def _rebuild_period(period):
+    start, end = _month_bounds(period)
+    cells = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+
+    def add(dimension, member, measure, amount):
+        cells[(dimension, member or '')][measure] += amount
+
+    entries = db.session.execute(
+        db.select(LedgerEntry.entity_type, LedgerEntry.entity_id, LedgerEntry.entry_type,
+                  LedgerEntry.document_id, LedgerEntry.amount)
+        .where(LedgerEntry.created_at >= start, LedgerEntry.created_at < end)
+    ).all()
+    student_ids = {e.entity_id for e in entries if e.entity_type == 'student'}
+    class_levels = dict(db.session.execute(
+        db.select(Student.id, Student.class_level).where(Student.id.in_(student_ids))
+    ).all()) if student_ids else {}
+    invoice_shares = _invoice_shares({e.document_id for e in entries if e.entity_type == 'student'})
+    receipt_shares = _receipt_shares({e.document_id for e in entries if e.entity_type == 'tutor'})
+
+    for entry in entries:
+        measure = _LEDGER_MEASURES.get((entry.entity_type, entry.entry_type))
+        if measure is None:
+            continue
+        add('all', '', measure, entry.amount)
+        if entry.entity_type == 'student':
+            add('class_level', class_levels.get(entry.entity_id), measure, entry.amount)
+            shared = ('tutor', 'subject')
+            shares = invoice_shares.get(entry.document_id)
+        else:
+            add('tutor', str(entry.entity_id), measure, entry.amount)
+            shared = ('class_level', 'subject')
+            shares = receipt_shares.get(entry.document_id)
+        # Unattributable amounts (no classes, or the document was flushed) go to member ''
+        total = sum(weight for *_, weight in shares) if shares else 0
+        for (first, second, weight) in (shares if total else [('', '', 1)]):
+            amount = entry.amount * weight / (total or 1)
+            add(shared[0], first, measure, amount)
+            add(shared[1], second, measure, amount)
+
+    subject = db.func.coalesce(Subject.name, Attendance.subject)
+    for class_level, subject_name, tutor_id, count in db.session.execute(
+        db.select(Student.class_level, subject, Attendance.tutor_id, db.func.count())
+        .join(Student, Student.id == Attendance.student_id)
+        .outerjoin(Subject, Subject.id == Attendance.subject_id)
+        .where(Attendance.date_recorded >= start.date(), Attendance.date_recorded < end.date())
+        .group_by(Student.class_level, subject, Attendance.tutor_id)
+    ):
+        for dimension, member in (('all', ''), ('class_level', class_level), ('subject', subject_name),
+                                  ('tutor', str(tutor_id))):
+            add(dimension, member, 'classes', count)
+
+    now = datetime.utcnow()
+    db.session.execute(db.delete(ReportCube).where(ReportCube.period == period))
+    if cells:
+        db.session.execute(ReportCube.__table__.insert(), [
+            {'period': period, 'dimension': dimension, 'member': member, 'updated_at': now,
+             **{measure: round(value, 2) if measure in MONEY else value for measure, value in values.items()}}
+            for (dimension, member), values in cells.items()
+        ])
+
+
+def _invoice_shares(invoice_ids):
+    """{invoice_id: [(tutor_id, subject, classes)]} for the classes each invoice billed"""
+    invoice_ids = [i for i in invoice_ids if i]
+    if not invoice_ids:
+        return {}
+    subject = db.func.coalesce(Subject.name, Attendance.subject)
+    shares = defaultdict(list)
+    for invoice_id, tutor_id, subject_name, count in db.session.execute(
+        db.select(StudentInvoice.id, Attendance.tutor_id, subject, db.func.count())
+        .join(Attendance, db.and_(Attendance.student_id == StudentInvoice.student_id,
+                                  Attendance.date_recorded >= StudentInvoice.start_date,
+                                  Attendance.date_recorded <= StudentInvoice.end_date))
+        .outerjoin(Subject, Subject.id == Attendance.subject_id)
+        .where(StudentInvoice.id.in_(invoice_ids))
+        .group_by(StudentInvoice.id, Attendance.tutor_id, subject)
+    ):
+        shares[invoice_id].append((str(tutor_id), subject_name, count))
+    return shares
+
+
+def _receipt_shares(receipt_ids):
+    """{receipt_id: [(class_level, subject, earnings)]} for the classes each receipt paid"""
+    receipt_ids = [i for i in receipt_ids if i]
+    if not receipt_ids:
+        return {}
+    subject = db.func.coalesce(Subject.name, Attendance.subject)
+    shares = defaultdict(list)
+    for receipt_id, class_level, subject_name, earnings in db.session.execute(
+        db.select(TutorReceipt.id, Student.class_level, subject,
+                  db.func.sum(db.func.coalesce(student_tutors.c.pay_per_class, 0.0)))
+        .join(Attendance, db.and_(Attendance.tutor_id == TutorReceipt.tutor_id,
+                                  Attendance.date_recorded >= TutorReceipt.start_date,
+                                  Attendance.date_recorded <= TutorReceipt.end_date))
+        .join(Student, Student.id == Attendance.student_id)
+        .outerjoin(Subject, Subject.id == Attendance.subject_id)
+        .outerjoin(student_tutors, db.and_(student_tutors.c.student_id == Attendance.student_id,
+                                           student_tutors.c.tutor_id == Attendance.tutor_id))
+        .where(TutorReceipt.id.in_(receipt_ids))
+        .group_by(TutorReceipt.id, Student.class_level, subject)
+    ):
+        shares[receipt_id].append((class_level, subject_name, earnings or 0.0))
+    return shares
+
+
+def iter_cube(dimension='all', start=None, end=None, members=None, by_period=True):
+    """Yield cube rows for one dimension as dicts, oldest month first.
+
+    start/end are inclusive YYYY-MM bounds and members limits the slice to some
+    class levels, subjects or tutor ids. by_period=False sums the range into one
+    row per member. Rows carry a display label and margin (invoiced - tutor_cost).
+    """
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown report dimension '{dimension}'")
+    measures = [db.func.sum(getattr(ReportCube, measure)).label(measure) for measure in MEASURES]
+    keys = [ReportCube.period, ReportCube.member] if by_period else [ReportCube.member]
+    query = db.select(*keys, *measures).where(ReportCube.dimension == dimension).group_by(*keys).order_by(*keys)
+    if start:
+        query = query.where(ReportCube.period >= start)
+    if end:
+        query = query.where(ReportCube.period <= end)
+    if members:
+        query = query.where(ReportCube.member.in_([str(member) for member in members]))
+
+    labels = {}
+    if dimension == 'tutor':
+        labels = {str(tutor_id): name for tutor_id, name in
+                  db.session.execute(db.select(Tutor.id, Tutor.full_name))}
+    for row in db.session.execute(query.execution_options(yield_per=500)):
+        values = row._asdict()
+        values['label'] = 'All' if dimension == 'all' else labels.get(row.member, row.member) or 'Unallocated'
+        for measure in MONEY:
+            values[measure] = round(values[measure] or 0.0, 2)
+        values['margin'] = round(values['invoiced'] - values['tutor_cost'], 2)
+        yield values
+
+
+def query_cube(dimension='all', start=None, end=None, members=None, by_period=True):
+    """The rows of iter_cube as a list"""
+    return list(iter_cube(dimension, start, end, members, by_period))
+
+
+CSV_COLUMNS = ('period', 'member', 'label') + MONEY + ('margin', 'classes')
+
+
+def iter_csv(rows, chunk_rows=200):
+    """Encode report rows as CSV text, a chunk of rows at a time, for streaming responses"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+if __name__ == "__main__":
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Refresh the financial reporting cube")
+    parser.add_argument('--full', action='store_true', help="rebuild every month from the ledger and attendance")
+    args = parser.parse_args()
+
+    with app.app_context():
+        rebuilt = refresh_cube(full=args.full)
+    print(f"Rebuilt {len(rebuilt)} month(s)" + (f": {', '.join(rebuilt)}" if rebuilt else ""))
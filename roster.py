@@ -0,0 +1,358 @@
+"""Bulk roster import: tutors, students and tutor assignments from CSV or XLSX.
+
+Every row of every file is validated before anything is written, and a dry run
+returns the same report without writing. A real import hashes the new tutors'
+passwords in a thread pool and inserts all rows with batched statements in a
+single transaction, so a failed import leaves nothing behind.
+
+Run `python roster.py --tutors tutors.csv --students students.xlsx --assignments pay.csv [--commit]`.
+"""
+import io
+import os
+import csv
+import logging
+from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash
+from app import db
+from models import User, Role, Tutor, Student, Subject, user_roles, student_tutors, student_subjects
+
+try:
+    import openpyxl
+except ImportError:  # optional: only CSV rosters can be read without it
+    openpyxl = None
+
+# Columns per roster file; True marks the required ones
+ROSTER_COLUMNS = {
+    'tutors': {'full_name': True, 'date_of_birth': True, 'mobile': True, 'upi_id': False},
+    'students': {'full_name': True, 'parent_name': True, 'parent_whatsapp': True, 'class_level': True,
+                 'subjects': True, 'per_class_fee': True, 'billing_start_date': False},
+    'assignments': {'student_name': True, 'parent_whatsapp': True, 'tutor_mobile': True, 'pay_per_class': True},
+}
+
+# Below this many passwords a pool costs more than it saves
+PARALLEL_HASH_MIN = 16
+
+_DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y')
+
+
+def read_rows(filename, data):
+    """Rows of a CSV or XLSX file as (row number, {column: value}) pairs"""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        if openpyxl is None:
+            raise ValueError("Reading .xlsx rosters needs openpyxl (pip install openpyxl); upload a CSV instead")
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))
+    else:
+        rows = list(csv.reader(io.StringIO(data.decode('utf-8-sig'))))
+    if not rows:
+        return []
+
+    header = ['_'.join(str(name or '').strip().lower().split()) for name in rows[0]]
+    result = []
+    for number, values in enumerate(rows[1:], start=2):
+        cells = {column: _cell(value) for column, value in zip(header, values) if column}
+        if any(value != '' for value in cells.values()):
+            result.append((number, cells))
+    return result
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # spreadsheet numbers such as mobiles
+    return value if isinstance(value, date) else str(value).strip()
+
+
+def _parse_date(value):
+    if isinstance(value, date):
+        return value
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"'{value}' is not a date (use YYYY-MM-DD)")
+
+
+def _parse_amount(value):
+    amount = float(value)
+    if amount < 0:
+        raise ValueError(f"'{value}' is negative")
+    return amount
+
+
+def _phone(value):
+    return ''.join(str(value).split())
+
+
+def _student_key(name, whatsapp):
+    return ' '.join(name.lower().split()), _phone(whatsapp)
+
+
+def hash_passwords(passwords, workers=None):
+    """Hash passwords with werkzeug's default method, in parallel when there are many.
+
+    Threads, not processes: this runs inside a request, and forked children would
+    inherit the server's locks and pooled connections. hashlib's scrypt and pbkdf2
+    release the GIL, so the threads still hash on every core.
+    """
+    if len(passwords) < PARALLEL_HASH_MIN or workers == 1:
+        return [generate_password_hash(password) for password in passwords]
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(generate_password_hash, passwords))
+
+
+def run_import(tutors=(), students=(), assignments=(), dry_run=True, workers=None):
+    """Validate the roster rows and, unless dry_run or anything is invalid, import them.
+
+    Each argument is a list of (row number, {column: value}) from read_rows.
+    Returns a report dict with the rows to create, any errors and whether it committed.
+    """
+    report = {'dry_run': dry_run, 'committed': False, 'errors': [],
+              'tutors': [], 'students': [], 'assignments': []}
+
+    def error(sheet, number, message):
+        report['errors'].append({'sheet': sheet, 'row': number, 'message': message})
+
+    for sheet, rows in (('tutors', tutors), ('students', students), ('assignments', assignments)):
+        if rows:
+            missing = [c for c, required in ROSTER_COLUMNS[sheet].items() if required and c not in rows[0][1]]
+            if missing:
+                error(sheet, 1, f"Missing column(s): {', '.join(missing)}")
+    if report['errors']:
+        return report
+
+    new_tutors = _validate_tutors(tutors, error)
+    new_students = _validate_students(students, error)
+    new_assignments = _validate_assignments(assignments, new_tutors, new_students, error)
+    report['tutors'], report['students'], report['assignments'] = new_tutors, new_students, new_assignments
+
+    if dry_run or report['errors'] or not (new_tutors or new_students or new_assignments):
+        return report
+
+    try:
+        _write(new_tutors, new_students, new_assignments, workers)
+        db.session.commit()
+        report['committed'] = True
+        logging.info(f"Roster import: {len(new_tutors)} tutors, {len(new_students)} students, "
+                     f"{len(new_assignments)} assignments")
+    except Exception:
+        db.session.rollback()
+        raise
+    return report
+
+
+def _validate_tutors(rows, error):
+    mobiles = [_phone(cells.get('mobile', '')) for _, cells in rows]
+    existing_mobiles = set(db.session.execute(
+        db.select(Tutor.mobile).where(Tutor.mobile.in_(mobiles))
+    ).scalars()) if mobiles else set()
+    # Usernames are unique across both tables; the account is created with the tutor's username
+    taken = {name.lower() for name in db.session.execute(db.select(User.username)).scalars()}
+    taken |= {name.lower() for name in db.session.execute(db.select(Tutor.username)).scalars()}
+
+    tutors, seen = [], set()
+    for number, cells in rows:
+        problems = [f"{column} is required" for column, required in ROSTER_COLUMNS['tutors'].items()
+                    if required and not cells.get(column)]
+        mobile = _phone(cells.get('mobile', ''))
+        date_of_birth = None
+        if cells.get('date_of_birth'):
+            try:
+                date_of_birth = _parse_date(cells['date_of_birth'])
+            except ValueError as e:
+                problems.append(f"date_of_birth: {e}")
+        if mobile and mobile in existing_mobiles:
+            problems.append(f"a tutor with mobile {mobile} already exists")
+        elif mobile and mobile in seen:
+            problems.append(f"mobile {mobile} appears more than once")
+        seen.add(mobile)
+        if len(mobile) > 20:
+            problems.append("mobile is longer than 20 characters")
+        if problems:
+            for problem in problems:
+                error('tutors', number, problem)
+            continue
+
+        tutor = Tutor(full_name=' '.join(cells['full_name'].split()), date_of_birth=date_of_birth, mobile=mobile)
+        base = tutor.generate_username()
+        username, suffix = base, 1
+        while username.lower() in taken:
+            suffix += 1
+            username = f"{base}{suffix}"
+        taken.add(username.lower())
+        tutors.append({'row': number, 'full_name': tutor.full_name, 'date_of_birth': date_of_birth,
+                       'mobile': mobile, 'upi_id': cells.get('upi_id', ''), 'username': username})
+    return tutors
+
+
+def _validate_students(rows, error):
+    whatsapps = [_phone(cells.get('parent_whatsapp', '')) for _, cells in rows]
+    existing = {_student_key(name, whatsapp) for name, whatsapp in db.session.execute(
+        db.select(Student.full_name, Student.parent_whatsapp).where(Student.parent_whatsapp.in_(whatsapps))
+    )} if whatsapps else set()
+
+    students, seen = [], set()
+    for number, cells in rows:
+        problems = [f"{column} is required" for column, required in ROSTER_COLUMNS['students'].items()
+                    if required and cells.get(column) in (None, '')]
+        values = {}
+        for column, parse in (('per_class_fee', _parse_amount), ('billing_start_date', _parse_date)):
+            if cells.get(column) not in (None, ''):
+                try:
+                    values[column] = parse(cells[column])
+                except ValueError as e:
+                    problems.append(f"{column}: {e}")
+        subjects = Subject.parse_names(str(cells.get('subjects', '')))
+        if cells.get('subjects') and not subjects:
+            problems.append("subjects has no subject names")
+        key = _student_key(str(cells.get('full_name', '')), cells.get('parent_whatsapp', ''))
+        if len(key[1]) > 20:
+            problems.append("parent_whatsapp is longer than 20 characters")
+        if key in existing:
+            problems.append(f"{cells['full_name']} ({key[1]}) already exists")
+        elif key in seen:
+            problems.append(f"{cells['full_name']} ({key[1]}) appears more than once")
+        seen.add(key)
+        if problems:
+            for problem in problems:
+                error('students', number, problem)
+            continue
+
+        students.append({'row': number, 'key': key, 'full_name': ' '.join(cells['full_name'].split()),
+                         'parent_name': cells['parent_name'], 'parent_whatsapp': key[1],
+                         'class_level': str(cells['class_level']), 'subjects': subjects,
+                         'per_class_fee': values['per_class_fee'],
+                         'billing_start_date': values.get('billing_start_date', datetime.utcnow().date())})
+    return students
+
+
+def _validate_assignments(rows, new_tutors, new_students, error):
+    if not rows:
+        return []
+    whatsapps = {_phone(cells.get('parent_whatsapp', '')) for _, cells in rows}
+    mobiles = {_phone(cells.get('tutor_mobile', '')) for _, cells in rows}
+    students = {_student_key(name, whatsapp): student_id for student_id, name, whatsapp in db.session.execute(
+        db.select(Student.id, Student.full_name, Student.parent_whatsapp).where(Student.parent_whatsapp.in_(whatsapps))
+    )}
+    tutors = dict(db.session.execute(db.select(Tutor.mobile, Tutor.id).where(Tutor.mobile.in_(mobiles))).all())
+    # Rows created by this import are referenced by key until they have ids
+    students.update({student['key']: student['key'] for student in new_students})
+    tutors.update({tutor['mobile']: tutor['mobile'] for tutor in new_tutors})
+    existing = set(db.session.execute(
+        db.select(student_tutors.c.student_id, student_tutors.c.tutor_id).where(
+            student_tutors.c.tutor_id.in_([i for i in tutors.values() if isinstance(i, int)]))
+    ).all())
+
+    assignments, seen = [], set()
+    for number, cells in rows:
+        problems = [f"{column} is required" for column, required in ROSTER_COLUMNS['assignments'].items()
+                    if required and cells.get(column) in (None, '')]
+        student = students.get(_student_key(str(cells.get('student_name', '')), cells.get('parent_whatsapp', '')))
+        tutor = tutors.get(_phone(cells.get('tutor_mobile', '')))
+        pay = None
+        if cells.get('pay_per_class') not in (None, ''):
+            try:
+                pay = _parse_amount(cells['pay_per_class'])
+            except ValueError as e:
+                problems.append(f"pay_per_class: {e}")
+        if student is None and cells.get('student_name'):
+            problems.append(f"student {cells['student_name']} ({cells.get('parent_whatsapp')}) not found")
+        if tutor is None and cells.get('tutor_mobile'):
+            problems.append(f"no tutor with mobile {cells['tutor_mobile']}")
+        if (student, tutor) in existing or (student, tutor) in seen:
+            problems.append("this student is already assigned to this tutor")
+        seen.add((student, tutor))
+        if problems:
+            for problem in problems:
+                error('assignments', number, problem)
+            continue
+        assignments.append({'row': number, 'student': student, 'tutor': tutor, 'pay_per_class': pay,
+                            'student_name': cells['student_name'], 'tutor_mobile': _phone(cells['tutor_mobile'])})
+    return assignments
+
+
+def _write(tutors, students, assignments, workers):
+    now = datetime.utcnow()
+    tutor_ids = {}
+    if tutors:
+        # The default password is the mobile number, as with tutors added by hand
+        hashes = hash_passwords([tutor['mobile'] for tutor in tutors], workers)
+        user_ids = db.session.scalars(
+            db.insert(User).returning(User.id, sort_by_parameter_order=True),
+            [{'username': t['username'], 'full_name': t['full_name'], 'mobile': t['mobile'],
+              'password_hash': password_hash, 'created_at': now, 'is_active': True, 'remember_me': False}
+             for t, password_hash in zip(tutors, hashes)]
+        ).all()
+        tutor_role = Role.query.filter_by(name='Tutor').first()
+        if tutor_role:
+            db.session.execute(user_roles.insert(), [{'user_id': user_id, 'role_id': tutor_role.id}
+                                                     for user_id in user_ids])
+        ids = db.session.scalars(
+            db.insert(Tutor).returning(Tutor.id, sort_by_parameter_order=True),
+            [{'user_id': user_id, 'full_name': t['full_name'], 'date_of_birth': t['date_of_birth'],
+              'mobile': t['mobile'], 'upi_id': t['upi_id'], 'username': t['username'], 'password': t['mobile'],
+              'billing_start_date': now.date(), 'status': 'Active', 'created_at': now}
+             for t, user_id in zip(tutors, user_ids)]
+        ).all()
+        tutor_ids = {tutor['mobile']: tutor_id for tutor, tutor_id in zip(tutors, ids)}
+
+    student_ids = {}
+    if students:
+        catalog = {subject.name_key: subject for subject in
+                   Subject.intern(sorted({name for s in students for name in s['subjects']}))}
+        db.session.flush()
+        ids = db.session.scalars(
+            db.insert(Student).returning(Student.id, sort_by_parameter_order=True),
+            [{'full_name': s['full_name'], 'parent_name': s['parent_name'], 'parent_whatsapp': s['parent_whatsapp'],
+              'class_level': s['class_level'], 'per_class_fee': s['per_class_fee'],
+              'subjects': ', '.join(catalog[Subject.make_key(name)].name for name in s['subjects']),
+              'billing_start_date': s['billing_start_date'], 'status': 'Active', 'created_at': now}
+             for s in students]
+        ).all()
+        student_ids = {student['key']: student_id for student, student_id in zip(students, ids)}
+        links = {(student_id, catalog[Subject.make_key(name)].id)
+                 for student, student_id in zip(students, ids) for name in student['subjects']}
+        db.session.execute(student_subjects.insert(), [{'student_id': s, 'subject_id': subject}
+                                                       for s, subject in sorted(links)])
+
+    if assignments:
+        db.session.execute(student_tutors.insert(), [
+            {'student_id': student_ids.get(a['student'], a['student']),
+             'tutor_id': tutor_ids.get(a['tutor'], a['tutor']),
+             'pay_per_class': a['pay_per_class']} for a in assignments
+        ])
+
+
+if __name__ == "__main__":
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Import a roster of tutors, students and assignments")
+    for sheet in ROSTER_COLUMNS:
+        parser.add_argument(f'--{sheet}', help=f"CSV/XLSX with columns: {', '.join(ROSTER_COLUMNS[sheet])}")
+    parser.add_argument('--commit', action='store_true', help="write the rows (default is a dry run)")
+    parser.add_argument('--workers', type=int, default=None, help="password hashing threads")
+    args = parser.parse_args()
+
+    with app.app_context():
+        sheets = {}
+        for sheet in ROSTER_COLUMNS:
+            path = getattr(args, sheet)
+            if path:
+                with open(path, 'rb') as f:
+                    sheets[sheet] = read_rows(path, f.read())
+        result = run_import(**sheets, dry_run=not args.commit, workers=args.workers)
+
+    for problem in result['errors']:
+        print(f"{problem['sheet']} row {problem['row']}: {problem['message']}")
+    for tutor in result['tutors']:
+        print(f"tutor {tutor['full_name']}: username {tutor['username']}")
+    print(f"{len(result['tutors'])} tutors, {len(result['students'])} students, "
+          f"{len(result['assignments'])} assignments "
+          + ("imported" if result['committed'] else "not imported" if result['errors'] else "validated (dry run)"))
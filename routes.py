@@ -1,16 +1,41 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, make_response
+from flask import (render_template, request, redirect, url_for, flash, jsonify, make_response, Response,
+                   stream_with_context)
 from flask_login import login_required, current_user
+from sqlalchemy.orm import defaultload, defer, joinedload, selectinload
 from datetime import datetime, timedelta
 import json
+import logging
 import os
 import zipfile
 import tempfile
 
 from app import app, db
 from models import (User, Role, Student, Tutor, Attendance, StudentInvoice, 
-                   TutorReceipt, Permission, student_tutors, Announcement, Settings)
+                   TutorReceipt, Permission, student_tutors, Announcement, Settings,
+                   Subject, student_subjects, AccountBalance, AnnouncementRead, OutboundMessage)
 from utils import permission_required, admin_required
-from pdf_generator import generate_student_invoice_pdf, generate_tutor_receipt_pdf
+from db_routing import read_only, primary_only
+from versioning import conditional
+from loaders import loader_profile
+from subjects import subject_names_for_students
+from tutor_context import current_tutor, assigned_student_ids
+from ledger import STUDENT, TUTOR, record_payment, account_totals, dues_status, refresh_all_latest
+from roster import ROSTER_COLUMNS, read_rows, run_import
+from numbering import validate_prefix, MAX_PREFIX_LENGTH
+from overlaps import validate_class_times, lock_schedules, find_conflicts, describe_conflicts
+from attendance_sync import sync_attendance, find_recorded
+from partitions import drop_attendance_before
+from announcements import active_announcements, read_ids, unread_count, mark_read
+from reminders import (STAGES as REMINDER_STAGES, TEMPLATE_FIELDS, template_for, validate_template,
+                       queue_summary, retry_failed, start_reminder_job)
+from reports import DIMENSIONS, MONEY, refresh_cube, refresh_after_commit, iter_cube, query_cube, iter_csv
+from tenancy import report_shards, cross_branch_report
+from audit import record as record_audit, flush_audit, search_audit
+from query_cache import FromCache, query_cache_stats, clear_query_cache
+from fragment_cache import fragment_cache_stats, invalidate_fragment, clear_fragment_stats
+import profiler
+import slow_queries
+from pdf_generator import generate_student_invoice_pdf, generate_tutor_receipt_pdf, PDF_TEMPLATES, BACKENDS as PDF_BACKENDS
 from auth import auth
 
 # Register blueprints
@@ -27,63 +52,68 @@ def inject_permissions():
 # Main routes
 @app.route('/')
 @login_required
+@loader_profile({User: [selectinload(User.roles)]})
+@read_only
 def dashboard():
     if current_user.is_tutor_user():
         return redirect(url_for('tutor_dashboard'))
     
     # Prepare dashboard data
     if current_user.is_admin():
-        # Admin Dashboard Data
-        total_users = User.query.count()
-        total_roles = Role.query.count()
-        active_users = User.query.filter(User.last_login.isnot(None)).count()
-        total_documents = StudentInvoice.query.count() + TutorReceipt.query.count()
+        # Only run when the cached dashboard fragment renders again (see fragment_cache.py)
+        def dashboard_stats():
+            total_users = User.query.count()
+            total_roles = Role.query.count()
+            active_users = User.query.filter(User.last_login.isnot(None)).count()
+            total_documents = StudentInvoice.query.count() + TutorReceipt.query.count()
         
-        # Financial summary
-        total_revenue = db.session.query(db.func.sum(StudentInvoice.total_amount)).filter_by(status='Paid').scalar() or 0
-        pending_revenue = db.session.query(db.func.sum(StudentInvoice.total_amount)).filter_by(status='Due').scalar() or 0
-        total_expenses = db.session.query(db.func.sum(TutorReceipt.total_earnings)).filter_by(status='Paid').scalar() or 0
-        pending_expenses = db.session.query(db.func.sum(TutorReceipt.total_earnings)).filter_by(status='Due').scalar() or 0
+            # Financial summary from the account balances
+            totals = account_totals()
+            total_revenue, pending_revenue = totals.get(STUDENT, (0, 0))
+            total_expenses, pending_expenses = totals.get(TUTOR, (0, 0))
         
-        # System alerts
-        inactive_users = User.query.filter_by(is_active=False).count()
-        overdue_invoices = StudentInvoice.query.filter_by(status='Due').count()
-        pending_receipts = TutorReceipt.query.filter_by(status='Due').count()
+            # System alerts
+            inactive_users = User.query.filter_by(is_active=False).count()
+            overdue_invoices = StudentInvoice.query.filter_by(status='Due').count()
+            pending_receipts = TutorReceipt.query.filter_by(status='Due').count()
         
-        # User role distribution
-        user_roles = {}
-        for user in User.query.all():
-            for role in user.roles:
-                user_roles[role.name] = user_roles.get(role.name, 0) + 1
+            # User role distribution
+            user_roles = {}
+            for user in User.query.all():
+                for role in user.roles:
+                    user_roles[role.name] = user_roles.get(role.name, 0) + 1
         
-        # Recent activity (last 10 logins)
-        recent_users = User.query.filter(User.last_login.isnot(None)).order_by(User.last_login.desc()).limit(10).all()
+            # Recent activity (last 10 logins)
+            recent_users = User.query.filter(User.last_login.isnot(None)).order_by(User.last_login.desc()).limit(10).all()
         
-        return render_template('admin_dashboard.html',
-                             total_users=total_users,
-                             total_roles=total_roles,
-                             active_users=active_users,
-                             total_documents=total_documents,
-                             total_revenue=total_revenue,
-                             pending_revenue=pending_revenue,
-                             total_expenses=total_expenses,
-                             pending_expenses=pending_expenses,
-                             inactive_users=inactive_users,
-                             overdue_invoices=overdue_invoices,
-                             pending_receipts=pending_receipts,
-                             user_roles=user_roles,
-                             recent_users=recent_users)
+            return dict(total_users=total_users,
+                        total_roles=total_roles,
+                        active_users=active_users,
+                        total_documents=total_documents,
+                        total_revenue=total_revenue,
+                        pending_revenue=pending_revenue,
+                        total_expenses=total_expenses,
+                        pending_expenses=pending_expenses,
+                        inactive_users=inactive_users,
+                        overdue_invoices=overdue_invoices,
+                        pending_receipts=pending_receipts,
+                        user_roles=user_roles,
+                        recent_users=recent_users)
+        
+        return render_template('admin_dashboard.html', dashboard_stats=dashboard_stats)
     else:
         return render_template('dashboard.html')
 
 @app.route('/tutor-dashboard')
 @login_required
+@loader_profile({Tutor: [], Student: [], Attendance: [joinedload(Attendance.student)]})
+@read_only
 def tutor_dashboard():
     if not current_user.is_tutor_user():
         return redirect(url_for('dashboard'))
     
     # Get tutor profile
-    tutor = Tutor.query.filter_by(mobile=current_user.mobile).first()
+    tutor = current_tutor()
     if not tutor:
         flash('Tutor profile not found', 'error')
         return redirect(url_for('dashboard'))
@@ -93,7 +123,8 @@ def tutor_dashboard():
         .order_by(Attendance.created_at.desc()).limit(10).all()
     
     # Get assigned students
-    assigned_students = tutor.students
+    student_ids = assigned_student_ids()
+    assigned_students = Student.query.filter(Student.id.in_(student_ids)).all() if student_ids else []
     
     return render_template('tutor_dashboard.html', 
                          tutor=tutor, 
@@ -104,8 +135,11 @@ def tutor_dashboard():
 @app.route('/students')
 @login_required
 @permission_required(Permission.VIEW_STUDENTS)
+@conditional(Student, User, 'role', 'user_roles')
+@loader_profile({Student: []})
+@read_only
 def students_list():
-    students = Student.query.all()
+    students = Student.query.options(FromCache('students_list')).all()
     return render_template('students_list.html', students=students)
 
 @app.route('/students/add', methods=['GET', 'POST'])
@@ -119,9 +153,9 @@ def add_student():
                 parent_name=request.form['parent_name'],
                 parent_whatsapp=request.form['parent_whatsapp'],
                 class_level=request.form['class_level'],
-                subjects=request.form['subjects'],
                 per_class_fee=float(request.form['per_class_fee'])
             )
+            student.set_subjects(request.form['subjects'])
             
             db.session.add(student)
             db.session.flush()  # Get the student ID
@@ -151,6 +185,34 @@ def add_student():
     tutors = Tutor.query.filter_by(status='Active').all()
     return render_template('add_student.html', tutors=tutors)
 
+@app.route('/roster/import', methods=['GET', 'POST'])
+@login_required
+@permission_required(Permission.ADD_STUDENTS)
+@permission_required(Permission.ADD_TUTORS)
+def import_roster():
+    report = None
+    if request.method == 'POST':
+        try:
+            sheets = {}
+            for sheet in ROSTER_COLUMNS:
+                upload = request.files.get(sheet)
+                if upload and upload.filename:
+                    sheets[sheet] = read_rows(upload.filename, upload.read())
+            if not any(sheets.values()):
+                flash('Choose at least one roster file to import', 'error')
+            else:
+                report = run_import(**sheets, dry_run=bool(request.form.get('dry_run')))
+                if report['committed']:
+                    flash(f"Imported {len(report['tutors'])} tutors, {len(report['students'])} students "
+                          f"and {len(report['assignments'])} assignments", 'success')
+                elif report['errors']:
+                    flash('Nothing was imported - fix the rows listed below and upload again', 'error')
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error importing roster: {str(e)}', 'error')
+
+    return render_template('import_roster.html', report=report, columns=ROSTER_COLUMNS)
+
 @app.route('/students/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 @permission_required(Permission.EDIT_STUDENTS)
@@ -163,9 +225,15 @@ def edit_student(id):
             student.parent_name = request.form['parent_name']
             student.parent_whatsapp = request.form['parent_whatsapp']
             student.class_level = request.form['class_level']
-            student.subjects = request.form['subjects']
+            student.set_subjects(request.form['subjects'])
             student.per_class_fee = float(request.form['per_class_fee'])
             
+            old_rates = dict(db.session.execute(
+                db.select(student_tutors.c.tutor_id, student_tutors.c.pay_per_class)
+                .where(student_tutors.c.student_id == id)
+            ).all())
+            new_rates = {}
+            
             # Clear existing tutor assignments
             db.session.execute(
                 student_tutors.delete().where(student_tutors.c.student_id == id)
@@ -183,6 +251,10 @@ def edit_student(id):
                             pay_per_class=pay_rate
                         )
                     )
+                    new_rates[int(tutor_id)] = pay_rate
+            
+            if new_rates != old_rates:
+                record_audit('set_pay_rates', 'student', id, {'before': old_rates, 'after': new_rates})
             
             db.session.commit()
             flash('Student updated successfully', 'success')
@@ -210,26 +282,27 @@ def edit_student(id):
 @app.route('/students/<int:id>')
 @login_required
 @permission_required(Permission.VIEW_STUDENTS)
+@loader_profile({Student: [], Attendance: [joinedload(Attendance.tutor)], StudentInvoice: []})
+@read_only
 def student_profile(id):
-    student = Student.query.get_or_404(id)
+    student = Student.query.options(FromCache('student_profile')).filter_by(id=id).first_or_404()
     
     # Get attendance records
-    attendance_records = Attendance.query.filter_by(student_id=id)\
+    attendance_records = Attendance.query.options(FromCache('student_attendance', Tutor),
+                                                  defaultload(Attendance.tutor).defer(Tutor.password))\
+        .filter_by(student_id=id)\
         .order_by(Attendance.date_recorded.desc()).limit(50).all()
     
     # Get invoices
-    invoices = StudentInvoice.query.filter_by(student_id=id)\
+    invoices = StudentInvoice.query.options(FromCache('student_invoices')).filter_by(student_id=id)\
         .order_by(StudentInvoice.generated_at.desc()).limit(6).all()
     
     # Get assigned tutors with pay rates
     tutor_assignments = db.session.execute(
-        db.text("""
-            SELECT t.id, t.full_name, st.pay_per_class 
-            FROM tutor t 
-            JOIN student_tutors st ON t.id = st.tutor_id 
-            WHERE st.student_id = :sid
-        """),
-        {"sid": id}
+        db.select(Tutor.id, Tutor.full_name, student_tutors.c.pay_per_class)
+        .join(student_tutors, Tutor.id == student_tutors.c.tutor_id)
+        .where(student_tutors.c.student_id == id)
+        .options(FromCache('student_tutors'))
     ).fetchall()
     
     return render_template('student_profile.html', 
@@ -242,8 +315,11 @@ def student_profile(id):
 @app.route('/tutors')
 @login_required
 @permission_required(Permission.VIEW_TUTORS)
+@conditional(Tutor, TutorReceipt, student_tutors, User, 'role', 'user_roles')
+@loader_profile({Tutor: [selectinload(Tutor.students)]})
+@read_only
 def tutors_list():
-    tutors = Tutor.query.all()
+    tutors = Tutor.query.options(FromCache('tutors_list', student_tutors, Student), defer(Tutor.password)).all()
     return render_template('tutors_list.html', tutors=tutors)
 
 @app.route('/tutors/add', methods=['GET', 'POST'])
@@ -276,6 +352,7 @@ def add_tutor():
             )
             user.set_password(tutor.password)
             user.roles.append(tutor_role)
+            tutor.user = user
             
             db.session.add(user)
             db.session.commit()
@@ -320,15 +397,20 @@ def edit_tutor(id):
 @app.route('/tutors/<int:id>')
 @login_required
 @permission_required(Permission.VIEW_TUTORS)
+@loader_profile({Tutor: [selectinload(Tutor.students)], Attendance: [joinedload(Attendance.student)],
+                 TutorReceipt: []})
+@read_only
 def tutor_profile(id):
-    tutor = Tutor.query.get_or_404(id)
+    # The password shown on the page is loaded on its own, so it stays out of the cache
+    tutor = Tutor.query.options(FromCache('tutor_profile', student_tutors, Student), defer(Tutor.password))\
+        .filter_by(id=id).first_or_404()
     
     # Get attendance records
-    attendance_records = Attendance.query.filter_by(tutor_id=id)\
+    attendance_records = Attendance.query.options(FromCache('tutor_attendance', Student)).filter_by(tutor_id=id)\
         .order_by(Attendance.date_recorded.desc()).limit(50).all()
     
     # Get receipts
-    receipts = TutorReceipt.query.filter_by(tutor_id=id)\
+    receipts = TutorReceipt.query.options(FromCache('tutor_receipts')).filter_by(tutor_id=id)\
         .order_by(TutorReceipt.generated_at.desc()).limit(6).all()
     
     # Get assigned students
@@ -344,9 +426,16 @@ def tutor_profile(id):
 @app.route('/attendance', methods=['GET', 'POST'])
 @login_required
 @permission_required(Permission.SUBMIT_ATTENDANCE)
+@loader_profile({Tutor: [], Student: []})
 def attendance():
     if request.method == 'POST':
         try:
+            # A resubmitted form carries the same key as the one already stored
+            client_key = request.form.get('client_key') or None
+            if client_key and find_recorded([client_key]):
+                flash('Attendance recorded successfully', 'success')
+                return redirect(url_for('attendance'))
+            
             start_time = datetime.strptime(
                 f"{request.form['date']} {request.form['start_time']}", 
                 '%Y-%m-%d %H:%M'
@@ -356,16 +445,39 @@ def attendance():
                 '%Y-%m-%d %H:%M'
             )
             
+            student_id = int(request.form['student_id'])
+            tutor_id = int(request.form['tutor_id'])
+            if current_user.is_tutor_user():
+                # Tutors can only record their own classes with their assigned students
+                tutor = current_tutor()
+                if not tutor or tutor_id != tutor.id or student_id not in assigned_student_ids():
+                    raise ValueError('You can only record attendance for your assigned students')
+            
+            validate_class_times(start_time, end_time)
+            # Held until the commit below, so a concurrent submission can't take the slot in between
+            lock_schedules([tutor_id], [student_id])
+            conflicts = find_conflicts(tutor_id, student_id, start_time, end_time)
+            if conflicts:
+                raise ValueError(f'This class overlaps another: {describe_conflicts(conflicts)}')
+            
+            subject_name = ' '.join(request.form['subject'].split())
+            if not subject_name:
+                raise ValueError('Subject is required')
+            subject = Subject.intern([subject_name])[0]
+            db.session.flush()
+            
             attendance_record = Attendance(
-                student_id=int(request.form['student_id']),
-                tutor_id=int(request.form['tutor_id']),
-                subject=request.form['subject'],
+                student_id=student_id,
+                tutor_id=tutor_id,
+                subject=subject.name,
+                subject_id=subject.id,
                 start_time=start_time,
                 end_time=end_time,
                 duration_minutes=int((end_time - start_time).total_seconds() / 60),
                 rating=int(request.form['rating']),
                 remarks=request.form.get('remarks', ''),
-                date_recorded=start_time.date()
+                date_recorded=start_time.date(),
+                client_key=client_key
             )
             
             db.session.add(attendance_record)
@@ -380,19 +492,53 @@ def attendance():
     
     # Get students and tutors for form
     if current_user.is_tutor_user():
-        tutor = Tutor.query.filter_by(mobile=current_user.mobile).first()
-        students = tutor.students if tutor else []
+        tutor = current_tutor()
+        student_ids = assigned_student_ids()
+        students = Student.query.filter(Student.id.in_(student_ids)).all() if student_ids else []
         tutors = [tutor] if tutor else []
     else:
         students = Student.query.filter_by(status='Active').all()
         tutors = Tutor.query.filter_by(status='Active').all()
     
-    return render_template('attendance.html', students=students, tutors=tutors)
+    # Subject suggestions per student, served from the cached catalog
+    student_subject_names = subject_names_for_students([student.id for student in students])
+    
+    return render_template('attendance.html', students=students, tutors=tutors,
+                         student_subjects=student_subject_names)
+
+@app.route('/api/attendance/sync', methods=['POST'])
+@login_required
+@permission_required(Permission.SUBMIT_ATTENDANCE)
+def sync_attendance_queue():
+    try:
+        payload = request.get_json(silent=True)
+        records = payload.get('records') if isinstance(payload, dict) else None
+        if not isinstance(records, list):
+            raise ValueError('Expected a list of records')
+        if current_user.is_tutor_user():
+            tutor = current_tutor()
+            if not tutor:
+                raise ValueError('Tutor profile not found')
+            results = sync_attendance(records, tutor_id=tutor.id, student_ids=set(assigned_student_ids()))
+        else:
+            results = sync_attendance(records)
+        return jsonify({'success': True, 'results': results})
+    except ValueError as e:
+        # The batch itself is unusable; resending it would fail the same way
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error syncing attendance: {str(e)}")
+        return jsonify({'success': False, 'message': 'Sync failed, it will be retried'}), 500
 
 # Invoice routes
 @app.route('/invoices')
 @login_required
 @permission_required(Permission.VIEW_INVOICES)
+@conditional(StudentInvoice, TutorReceipt, Student, Tutor, User, 'role', 'user_roles')
+@loader_profile({StudentInvoice: [joinedload(StudentInvoice.student)], TutorReceipt: [joinedload(TutorReceipt.tutor)]})
+@read_only
 def invoices():
     # Get student invoices
     student_invoices = StudentInvoice.query.order_by(StudentInvoice.generated_at.desc()).all()
@@ -407,6 +553,7 @@ def invoices():
 @app.route('/invoices/student/<int:id>/download')
 @login_required
 @permission_required(Permission.DOWNLOAD_INVOICES)
+@read_only
 def download_student_invoice(id):
     invoice = StudentInvoice.query.get_or_404(id)
     
@@ -423,6 +570,7 @@ def download_student_invoice(id):
 @app.route('/invoices/tutor/<int:id>/download')
 @login_required
 @permission_required(Permission.DOWNLOAD_INVOICES)
+@read_only
 def download_tutor_receipt(id):
     receipt = TutorReceipt.query.get_or_404(id)
     
@@ -444,15 +592,16 @@ def mark_student_invoice_paid(id):
     
     amount_paid = float(request.form.get('amount_paid', invoice.total_amount))
     
-    invoice.amount_paid = amount_paid
     if amount_paid >= invoice.total_amount:
-        invoice.status = 'Paid'
+        status = 'Paid'
     elif amount_paid > 0:
-        invoice.status = 'Partial'
+        status = 'Partial'
     else:
-        invoice.status = 'Due'
+        status = 'Due'
+    record_payment(invoice, amount_paid, status)
     
     db.session.commit()
+    refresh_after_commit('a payment')
     flash('Payment status updated successfully', 'success')
     return redirect(url_for('invoices'))
 
@@ -460,9 +609,11 @@ def mark_student_invoice_paid(id):
 @app.route('/admin/users')
 @login_required
 @permission_required(Permission.MANAGE_USERS)
+@loader_profile({User: [selectinload(User.roles)], Role: []})
+@read_only
 def user_management():
-    users = User.query.all()
-    roles = Role.query.all()
+    users = User.query.options(FromCache('users', 'role', 'user_roles'), defer(User.password_hash)).all()
+    roles = Role.query.options(FromCache('roles')).all()
     return render_template('user_management.html', users=users, roles=roles)
 
 @app.route('/admin/users/add', methods=['POST'])
@@ -510,12 +661,16 @@ def edit_user(id):
         user.is_active = bool(request.form.get('is_active'))
         
         # Update roles
+        old_roles = sorted(role.name for role in user.roles)
         user.roles.clear()
         role_ids = request.form.getlist('role_ids')
         for role_id in role_ids:
             role = Role.query.get(int(role_id))
             if role:
                 user.roles.append(role)
+        new_roles = sorted(role.name for role in user.roles)
+        if new_roles != old_roles:
+            record_audit('set_roles', 'user', user.id, {'before': old_roles, 'after': new_roles}, critical=True)
         
         db.session.commit()
         flash('User updated successfully', 'success')
@@ -534,6 +689,7 @@ def reset_user_password(id):
     try:
         new_password = request.form['new_password']
         user.set_password(new_password)
+        record_audit('reset_password', 'user', user.id, {'username': user.username}, critical=True)
         db.session.commit()
         
         flash(f'Password reset successfully for user {user.username}', 'success')
@@ -543,9 +699,45 @@ def reset_user_password(id):
     
     return redirect(url_for('user_management'))
 
+@app.route('/admin/audit')
+@login_required
+@permission_required(Permission.MANAGE_USERS)
+def audit_log():
+    # Show entries still waiting in this process's buffer too
+    try:
+        flush_audit()
+    except Exception as e:
+        flash(f'Some recent entries could not be written yet: {str(e)}', 'error')
+
+    filters = {key: request.args.get(key, '').strip() for key in ('user', 'entity_type', 'entity_id', 'action')}
+    dates = {}
+    for bound in ('start', 'end'):
+        try:
+            dates[bound] = datetime.strptime(request.args.get(bound, ''), '%Y-%m-%d')
+        except ValueError:
+            dates[bound] = None
+    before = None
+    if request.args.get('before'):
+        try:
+            created_at, entry_id = request.args['before'].rsplit('|', 1)
+            before = (datetime.fromisoformat(created_at), int(entry_id))
+        except ValueError:
+            before = None
+
+    page_size = 100
+    entries = search_audit(user=filters['user'], entity_type=filters['entity_type'], entity_id=filters['entity_id'],
+                           action=filters['action'], start=dates['start'],
+                           end=dates['end'] + timedelta(days=1) if dates['end'] else None,
+                           before=before, limit=page_size)
+    older = f"{entries[-1].created_at.isoformat()}|{entries[-1].id}" if len(entries) == page_size else None
+    return render_template('audit_log.html', entries=entries, filters=filters, older=older,
+                           start=request.args.get('start', ''), end=request.args.get('end', ''))
+
 @app.route('/admin/roles')
 @login_required
 @permission_required(Permission.MANAGE_ROLES)
+@loader_profile({Role: [selectinload(Role.users)]})
+@read_only
 def roles_permissions():
     roles = Role.query.all()
     return render_template('roles_permissions.html', roles=roles)
@@ -638,6 +830,7 @@ def delete_role(id):
 # AJAX routes
 @app.route('/api/tutors/search')
 @login_required
+@read_only
 def search_tutors():
     query = request.args.get('q', '')
     tutors = Tutor.query.filter(
@@ -653,9 +846,12 @@ def search_tutors():
 
 @app.route('/api/students/subjects/<int:student_id>')
 @login_required
+@conditional(Subject, student_subjects)
+@read_only
 def get_student_subjects(student_id):
-    student = Student.query.get_or_404(student_id)
-    subjects = [s.strip() for s in student.subjects.split(',')]
+    subjects = subject_names_for_students([student_id])[student_id]
+    if not subjects:
+        Student.query.get_or_404(student_id)
     return jsonify({'subjects': subjects})
 
 # Error handlers
@@ -684,13 +880,20 @@ def settings():
     return render_template('settings.html', 
                          theme_settings=theme_settings,
                          dues_colors=dues_colors,
-                         general_settings=general_settings)
+                         general_settings=general_settings,
+                         pdf_documents=PDF_TEMPLATES,
+                         pdf_backends=PDF_BACKENDS,
+                         max_prefix_length=MAX_PREFIX_LENGTH)
 
 @app.route('/settings/update', methods=['POST'])
 @login_required
 @permission_required(Permission.ACCESS_SETTINGS)
 def update_settings():
     try:
+        # Checked before anything is saved, so a bad prefix changes nothing
+        prefixes = {key: validate_prefix(request.form[key])
+                    for key in ('invoice_prefix', 'receipt_prefix') if key in request.form}
+
         # Update theme settings
         theme_keys = ['primary_color', 'secondary_color', 'background_color', 'text_color', 'title_font', 'body_font']
         for key in theme_keys:
@@ -704,10 +907,19 @@ def update_settings():
                 Settings.set_setting(f'dues_colors_{key}', request.form[key], 'dues_colors')
         
         # Update general settings
-        if 'invoice_prefix' in request.form:
-            Settings.set_setting('general_invoice_prefix', request.form['invoice_prefix'], 'general')
-        if 'receipt_prefix' in request.form:
-            Settings.set_setting('general_receipt_prefix', request.form['receipt_prefix'], 'general')
+        for key, prefix in prefixes.items():
+            Settings.set_setting(f'general_{key}', prefix, 'general')
+        
+        # Update payment details printed on invoices and receipts
+        for key in ['gpay_number', 'upi_id', 'contact_mobile']:
+            if key in request.form:
+                Settings.set_setting(f'payment_{key}', request.form[key], 'payment')
+        
+        # Update the PDF backend per document type
+        for kind in PDF_TEMPLATES:
+            backend = request.form.get(f'pdf_backend_{kind}')
+            if backend in PDF_BACKENDS:
+                Settings.set_setting(f'pdf_backend_{kind}', backend, 'pdf')
         
         flash('Settings updated successfully', 'success')
     except Exception as e:
@@ -733,107 +945,178 @@ def reset_settings():
     
     return redirect(url_for('settings'))
 
+# Reminder routes
+@app.route('/reminders')
+@login_required
+@permission_required(Permission.MARK_PAYMENTS)
+def reminders():
+    messages = OutboundMessage.query.order_by(OutboundMessage.id.desc()).limit(50).all()
+    templates = {stage: template_for(stage) for stage in REMINDER_STAGES}
+    return render_template('reminders.html', summary=queue_summary(), messages=messages,
+                           templates=templates, fields=TEMPLATE_FIELDS)
+
+@app.route('/reminders/send', methods=['POST'])
+@login_required
+@permission_required(Permission.MARK_PAYMENTS)
+def send_reminders():
+    stages = [stage for stage in request.form.getlist('stages') if stage in REMINDER_STAGES]
+    if not stages:
+        flash('Choose at least one dues stage to remind', 'error')
+    elif start_reminder_job(tuple(stages)):
+        flash('Reminders are being queued and sent in the background', 'success')
+    else:
+        flash('A reminder job is already running', 'info')
+    return redirect(url_for('reminders'))
+
+@app.route('/reminders/retry', methods=['POST'])
+@login_required
+@permission_required(Permission.MARK_PAYMENTS)
+def retry_reminders():
+    try:
+        count = retry_failed()
+        start_reminder_job(stages=())
+        flash(f'{count} failed message(s) queued again', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error retrying messages: {str(e)}', 'error')
+    return redirect(url_for('reminders'))
+
+@app.route('/reminders/templates', methods=['POST'])
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def update_reminder_templates():
+    try:
+        # Every template must render before any is saved, so the job never meets a broken one
+        templates = {stage: validate_template(request.form[stage].strip())
+                     for stage in REMINDER_STAGES if request.form.get(stage, '').strip()}
+        for stage, template in templates.items():
+            Settings.set_setting(f'reminders_{stage}', template, 'reminders')
+        flash('Reminder templates updated', 'success')
+    except Exception as e:
+        flash(f'Error updating templates: {str(e)}', 'error')
+    return redirect(url_for('reminders'))
+
+# Report routes
+def _report_filters():
+    """Report slice from the query string: dimension, month range and whether to split by month"""
+    dimension = request.args.get('dimension', 'all')
+    filters = {'dimension': dimension if dimension in DIMENSIONS else 'all',
+               'by_period': request.args.get('rollup') != '1'}
+    for bound in ('start', 'end'):
+        try:
+            filters[bound] = datetime.strptime(request.args.get(bound, ''), '%Y-%m').strftime('%Y-%m')
+        except ValueError:
+            filters[bound] = None
+    return filters
+
+@app.route('/reports')
+@login_required
+@permission_required(Permission.VIEW_INVOICES)
+@primary_only  # refreshes the cube, so it can't run on a replica
+def financial_reports():
+    filters = _report_filters()
+    try:
+        refresh_cube()
+    except Exception as e:
+        flash(f'Error refreshing reports, showing the last refreshed figures: {str(e)}', 'error')
+    rows = query_cube(**filters)
+    totals = {measure: round(sum(row[measure] for row in rows), 2) for measure in MONEY + ('margin', 'classes')}
+    return render_template('reports.html', rows=rows, totals=totals, filters=filters, dimensions=DIMENSIONS)
+
+@app.route('/reports/export.csv')
+@login_required
+@permission_required(Permission.VIEW_INVOICES)
+@primary_only
+def export_report():
+    filters = _report_filters()
+    try:
+        refresh_cube()
+    except Exception as e:
+        logging.error(f"Error refreshing reports before export: {str(e)}")
+    filename = f"mentorscue-{filters['dimension']}-{filters['start'] or 'start'}-to-{filters['end'] or 'latest'}.csv"
+    response = Response(stream_with_context(iter_csv(iter_cube(**filters))), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+@app.route('/reports/branches')
+@login_required
+@permission_required(Permission.VIEW_INVOICES)
+def branch_reports():
+    filters = _report_filters()
+    shards = report_shards(current_user)
+    rows, totals, failed = cross_branch_report(shards, filters['dimension'], filters['start'], filters['end'])
+    if failed:
+        flash(f"Could not read figures for: {', '.join(failed)}", 'error')
+    return render_template('branch_reports.html', rows=rows, totals=totals, filters=filters,
+                           dimensions=DIMENSIONS, shards=shards)
+
 # Dues routes
 @app.route('/dues')
 @login_required
 @permission_required(Permission.VIEW_STUDENTS)
+@read_only
 def dues():
     return render_template('dues.html')
 
 @app.route('/dues/students')
 @login_required
 @permission_required(Permission.VIEW_STUDENTS)
+@conditional(Student, AccountBalance, Attendance)
+@read_only
 def dues_students():
-    students = Student.query.filter_by(status='Active').all()
-    student_dues = []
-    
-    for student in students:
-        # Calculate dues status
-        latest_invoice = StudentInvoice.query.filter_by(student_id=student.id).order_by(StudentInvoice.generated_at.desc()).first()
-        
-        if not latest_invoice:
-            status = 'just_joined'
-        elif latest_invoice.status == 'Paid':
-            # Check if attended after payment
-            last_attendance = Attendance.query.filter_by(student_id=student.id).order_by(Attendance.date_recorded.desc()).first()
-            if last_attendance and last_attendance.date_recorded > latest_invoice.generated_at.date():
-                status = 'paid_attended'
-            else:
-                status = 'paid_no_class'
-        elif latest_invoice.status == 'Partial':
-            status = 'partial_payment'
-        else:
-            # Calculate days overdue
-            days_overdue = (datetime.utcnow().date() - latest_invoice.generated_at.date()).days
-            if days_overdue <= 5:
-                status = 'first_5_days'
-            elif days_overdue <= 10:
-                status = 'next_5_days'
-            else:
-                status = 'after_10_days'
-        
-        student_dues.append({
-            'student': student,
-            'status': status,
-            'latest_invoice': latest_invoice
-        })
+    # One row per student: balance, latest invoice and whether a class followed it
+    attended_since_latest = db.exists().where(
+        Attendance.student_id == Student.id,
+        Attendance.date_recorded > db.func.date(AccountBalance.latest_document_at)
+    )
+    rows = db.session.execute(
+        db.select(Student, AccountBalance, attended_since_latest)
+        .outerjoin(AccountBalance, db.and_(AccountBalance.entity_type == STUDENT,
+                                           AccountBalance.entity_id == Student.id))
+        .where(Student.status == 'Active')
+    ).all()
+    today = datetime.utcnow().date()
     
     return jsonify({'students': [
         {
-            'id': item['student'].id,
-            'name': item['student'].full_name,
-            'parent_name': item['student'].parent_name,
-            'parent_whatsapp': item['student'].parent_whatsapp,
-            'status': item['status'],
-            'total_amount': item['latest_invoice'].total_amount if item['latest_invoice'] else 0,
-            'amount_paid': item['latest_invoice'].amount_paid if item['latest_invoice'] else 0
-        } for item in student_dues
+            'id': student.id,
+            'name': student.full_name,
+            'parent_name': student.parent_name,
+            'parent_whatsapp': student.parent_whatsapp,
+            'status': dues_status(account, attended, today),
+            'total_amount': account.latest_amount if account and account.latest_amount is not None else 0,
+            'amount_paid': account.latest_paid if account and account.latest_paid is not None else 0,
+            'outstanding': account.outstanding if account else 0
+        } for student, account, attended in rows
     ]})
 
 @app.route('/dues/tutors')
 @login_required
 @permission_required(Permission.VIEW_TUTORS)
+@conditional(Tutor, AccountBalance, Attendance)
+@read_only
 def dues_tutors():
-    tutors = Tutor.query.filter_by(status='Active').all()
-    tutor_dues = []
-    
-    for tutor in tutors:
-        # Calculate dues status
-        latest_receipt = TutorReceipt.query.filter_by(tutor_id=tutor.id).order_by(TutorReceipt.generated_at.desc()).first()
-        
-        if not latest_receipt:
-            status = 'just_joined'
-        elif latest_receipt.status == 'Paid':
-            # Check if attended after payment
-            last_attendance = Attendance.query.filter_by(tutor_id=tutor.id).order_by(Attendance.date_recorded.desc()).first()
-            if last_attendance and last_attendance.date_recorded > latest_receipt.generated_at.date():
-                status = 'paid_attended'
-            else:
-                status = 'paid_no_class'
-        else:
-            # Calculate days overdue
-            days_overdue = (datetime.utcnow().date() - latest_receipt.generated_at.date()).days
-            if days_overdue <= 5:
-                status = 'first_5_days'
-            elif days_overdue <= 10:
-                status = 'next_5_days'
-            else:
-                status = 'after_10_days'
-        
-        tutor_dues.append({
-            'tutor': tutor,
-            'status': status,
-            'latest_receipt': latest_receipt
-        })
+    attended_since_latest = db.exists().where(
+        Attendance.tutor_id == Tutor.id,
+        Attendance.date_recorded > db.func.date(AccountBalance.latest_document_at)
+    )
+    rows = db.session.execute(
+        db.select(Tutor, AccountBalance, attended_since_latest)
+        .outerjoin(AccountBalance, db.and_(AccountBalance.entity_type == TUTOR,
+                                           AccountBalance.entity_id == Tutor.id))
+        .where(Tutor.status == 'Active')
+    ).all()
+    today = datetime.utcnow().date()
     
     return jsonify({'tutors': [
         {
-            'id': item['tutor'].id,
-            'name': item['tutor'].full_name,
-            'mobile': item['tutor'].mobile,
-            'status': item['status'],
-            'total_earnings': item['latest_receipt'].total_earnings if item['latest_receipt'] else 0
-        } for item in tutor_dues
+            'id': tutor.id,
+            'name': tutor.full_name,
+            'mobile': tutor.mobile,
+            'status': dues_status(account, attended, today),
+            'total_earnings': account.latest_amount if account and account.latest_amount is not None else 0,
+            'outstanding': account.outstanding if account else 0
+        } for tutor, account, attended in rows
     ]})
 
 @app.route('/dues/update-status', methods=['POST'])
@@ -849,23 +1132,21 @@ def update_dues_status():
             invoice = StudentInvoice.query.filter_by(student_id=entity_id).order_by(StudentInvoice.generated_at.desc()).first()
             if invoice:
                 if new_status == 'paid':
-                    invoice.status = 'Paid'
-                    invoice.amount_paid = invoice.total_amount
+                    record_payment(invoice, invoice.total_amount, 'Paid')
                 elif new_status == 'partial':
-                    invoice.status = 'Partial'
-                    invoice.amount_paid = float(request.form.get('amount_paid', 0))
+                    record_payment(invoice, float(request.form.get('amount_paid', 0)), 'Partial')
                 else:
-                    invoice.status = 'Due'
-                    invoice.amount_paid = 0
+                    record_payment(invoice, 0, 'Due')
         else:
             receipt = TutorReceipt.query.filter_by(tutor_id=entity_id).order_by(TutorReceipt.generated_at.desc()).first()
             if receipt:
                 if new_status == 'paid':
-                    receipt.status = 'Paid'
+                    record_payment(receipt, receipt.total_earnings, 'Paid')
                 else:
-                    receipt.status = 'Due'
+                    record_payment(receipt, 0, 'Due')
         
         db.session.commit()
+        refresh_after_commit('a payment')
         flash('Status updated successfully', 'success')
     except Exception as e:
         db.session.rollback()
@@ -873,6 +1154,146 @@ def update_dues_status():
     
     return redirect(url_for('dues'))
 
+# Cache routes
+@app.route('/admin/cache')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def cache_stats():
+    return render_template('cache_stats.html', queries=query_cache_stats(), fragments=fragment_cache_stats())
+
+@app.route('/admin/cache/clear', methods=['POST'])
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def clear_caches():
+    try:
+        clear_query_cache()
+        invalidate_fragment()
+        clear_fragment_stats()
+        flash('Caches cleared', 'success')
+    except Exception as e:
+        flash(f'Error clearing caches: {str(e)}', 'error')
+    return redirect(url_for('cache_stats'))
+
+# Profiler routes
+@app.route('/admin/profiler')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def profiler_page():
+    endpoints = sorted(rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != 'static')
+    usernames = db.session.execute(db.select(User.username).order_by(User.username)).scalars().all()
+    return render_template('profiler.html', rules=profiler.live_rules(), profiles=profiler.list_profiles(),
+                           endpoints=endpoints, usernames=usernames, modes=profiler.MODES,
+                           max_minutes=profiler.MAX_RULE_MINUTES, now=datetime.utcnow().timestamp())
+
+@app.route('/admin/profiler/rules', methods=['POST'])
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def add_profiler_rule():
+    try:
+        rule = profiler.add_rule(
+            endpoint=request.form.get('endpoint'),
+            username=request.form.get('username'),
+            percent=float(request.form.get('percent') or 100),
+            mode=request.form.get('mode') or profiler.SAMPLE,
+            minutes=int(request.form.get('minutes') or 15),
+            created_by=current_user.username
+        )
+        flash(f"Profiling {rule['endpoint'] or 'all routes'} for the next {request.form.get('minutes') or 15} minutes",
+              'success')
+    except Exception as e:
+        flash(f'Error adding profiling rule: {str(e)}', 'error')
+    return redirect(url_for('profiler_page'))
+
+@app.route('/admin/profiler/rules/<rule_id>/delete', methods=['POST'])
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def delete_profiler_rule(rule_id):
+    profiler.remove_rule(rule_id)
+    flash('Profiling rule stopped', 'success')
+    return redirect(url_for('profiler_page'))
+
+@app.route('/admin/profiler/clear', methods=['POST'])
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def clear_profiles():
+    flash(f'{profiler.clear_profiles()} profiles deleted', 'success')
+    return redirect(url_for('profiler_page'))
+
+@app.route('/admin/profiler/<profile_id>')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def view_profile(profile_id):
+    profile = profiler.load_profile(profile_id)
+    if profile is None:
+        flash('Profile not found; it may have been rotated away', 'error')
+        return redirect(url_for('profiler_page'))
+    return render_template('profile_detail.html', profile=profile, has_prof=bool(profiler.profile_file(profile_id)))
+
+@app.route('/admin/profiler/<profile_id>/collapsed')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def download_profile_stacks(profile_id):
+    profile = profiler.load_profile(profile_id)
+    if profile is None or not profile.get('stacks'):
+        flash('This profile has no sampled stacks', 'error')
+        return redirect(url_for('profiler_page'))
+    response = Response(profiler.collapsed_stacks(profile), mimetype='text/plain')
+    response.headers['Content-Disposition'] = f'attachment; filename={profile_id}.collapsed.txt'
+    return response
+
+@app.route('/admin/profiler/<profile_id>/prof')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def download_profile_stats(profile_id):
+    path = profiler.profile_file(profile_id)
+    if path is None:
+        flash('This profile has no cProfile stats', 'error')
+        return redirect(url_for('profiler_page'))
+    with open(path, 'rb') as f:
+        response = make_response(f.read())
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers['Content-Disposition'] = f'attachment; filename={profile_id}.prof'
+    return response
+
+# Slow query routes
+@app.route('/admin/slow-queries')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def slow_query_log():
+    return render_template('slow_queries.html', queries=slow_queries.summarize(),
+                           threshold_ms=slow_queries.SLOW_QUERY_MS)
+
+@app.route('/admin/slow-queries/<key>')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def slow_query_detail(key):
+    entries = slow_queries.entries_for(key)
+    if not entries:
+        flash('No slow runs of this query are logged', 'error')
+        return redirect(url_for('slow_query_log'))
+    return render_template('slow_query_detail.html', key=key, entries=entries, plan=slow_queries.load_plan(key))
+
+@app.route('/admin/slow-queries/export')
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def export_slow_queries():
+    if request.args.get('format') == 'jsonl':
+        response = Response(stream_with_context(
+            json.dumps(entry, default=str) + '\n' for entry in slow_queries.iter_entries()
+        ), mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = 'attachment; filename=slow-queries.jsonl'
+        return response
+    response = Response(slow_queries.export_csv(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=slow-queries.csv'
+    return response
+
+@app.route('/admin/slow-queries/clear', methods=['POST'])
+@login_required
+@permission_required(Permission.ACCESS_SETTINGS)
+def clear_slow_queries():
+    flash(f'{slow_queries.clear_slow_queries()} slow query entries deleted', 'success')
+    return redirect(url_for('slow_query_log'))
+
 # Data Flush routes
 @app.route('/data-flush')
 @login_required
@@ -883,6 +1304,7 @@ def data_flush():
 @app.route('/data-flush/backup', methods=['POST'])
 @login_required
 @permission_required(Permission.ACCESS_SETTINGS)
+@read_only
 def create_backup():
     try:
         # Create temporary directory for backup
@@ -976,15 +1398,23 @@ def execute_data_flush():
             flash('Invalid flush type', 'error')
             return redirect(url_for('data_flush'))
         
-        # Delete old attendance records
-        deleted_attendance = Attendance.query.filter(Attendance.created_at < cutoff_date).delete()
-        
         # Delete old invoices (keep core structure)
         deleted_invoices = StudentInvoice.query.filter(StudentInvoice.generated_at < cutoff_date).delete()
         
         # Delete old receipts (keep core structure)
         deleted_receipts = TutorReceipt.query.filter(TutorReceipt.generated_at < cutoff_date).delete()
         
+        # The ledger keeps the history; balances just need their latest document re-read
+        refresh_all_latest()
+        
+        record_audit('data_flush', details={'cutoff': cutoff_date.isoformat(), 'invoices': deleted_invoices,
+                                            'receipts': deleted_receipts}, critical=True)
+        db.session.commit()
+        
+        # Old attendance goes a month partition at a time; last, as the SQLite archives commit on their own
+        deleted_attendance = drop_attendance_before(cutoff_date)
+        record_audit('data_flush', details={'cutoff': cutoff_date.isoformat(), 'attendance': deleted_attendance},
+                     critical=True)
         db.session.commit()
         
         flash(f'Data flush completed: {deleted_attendance} attendance records, {deleted_invoices} invoices, {deleted_receipts} receipts deleted', 'success')
@@ -1069,22 +1499,35 @@ def delete_announcement(id):
 
 @app.route('/api/announcements/active')
 @login_required
+@conditional(Announcement, AnnouncementRead)
+@read_only
 def get_active_announcements():
-    """Get active announcements for tutors"""
+    """Get active announcements for tutors, flagged with whether they have been read"""
     if not current_user.is_tutor_user():
-        return jsonify({'announcements': []})
-    
-    announcements = Announcement.query.filter_by(is_active=True).all()
-    active_announcements = []
-    
-    for announcement in announcements:
-        if not announcement.is_expired():
-            active_announcements.append({
-                'id': announcement.id,
-                'title': announcement.title,
-                'content': announcement.content,
-                'created_at': announcement.created_at.isoformat(),
-                'expiry_date': announcement.expiry_date.isoformat() if announcement.expiry_date else None
-            })
+        return jsonify({'announcements': [], 'unread': 0})
     
-    return jsonify({'announcements': active_announcements})
+    feed = active_announcements()
+    read = read_ids(current_user.id, [announcement['id'] for announcement in feed])
+    feed = [dict(announcement, read=announcement['id'] in read) for announcement in feed]
+    return jsonify({'announcements': feed, 'unread': len(feed) - len(read)})
+
+@app.route('/api/announcements/unread-count')
+@login_required
+@conditional(Announcement, AnnouncementRead)
+@read_only
+def get_unread_announcement_count():
+    if not current_user.is_tutor_user():
+        return jsonify({'unread': 0})
+    return jsonify({'unread': unread_count(current_user.id)})
+
+@app.route('/api/announcements/read', methods=['POST'])
+@login_required
+def mark_announcements_read():
+    try:
+        ids = [int(i) for i in (request.get_json(silent=True) or {}).get('ids', [])]
+        marked = mark_read(current_user.id, ids)
+        db.session.commit()
+        return jsonify({'success': True, 'marked': marked})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 400
@@ -0,0 +1,366 @@
+"""Slow-query log: every statement is timed and the slow ones are kept with their query plan.
+
+Statements taking at least SLOW_QUERY_MS (default 200; 0 turns the log off)
+are appended to slow_queries.jsonl in SLOW_QUERY_DIR (default
+instance/slow_queries) with their bound parameters, the request (or thread)
+that ran them and the first app frame on the stack. Parameters are logged as
+SLOW_QUERY_PARAMETERS says: "types" (default) keeps numbers, dates and NULLs
+and logs text only as its length, "values" keeps text too. Either way a value
+bound to a sensitive column (SENSITIVE_COLUMNS: passwords, tokens, secrets,
+UPI ids) is logged as <redacted>, and PostgreSQL statements binding one are
+not explained, as EXPLAIN prints their values. Past SLOW_QUERY_MAX_KB
+(default 5120) the file is rotated to slow_queries.jsonl.1.
+
+Statements are grouped by a fingerprint of their SQL with literals and
+IN-lists collapsed, so the same query with different values is counted
+together. The first time a fingerprint is slow its plan is captured on the
+same connection (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on PostgreSQL inside a
+savepoint) and stored in plans/<fingerprint>.json. Both are shown and exported
+at /admin/slow-queries.
+"""
+import io
+import os
+import re
+import csv
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import date, datetime
+from flask import has_request_context, request
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+MAX_LOG_BYTES = int(os.environ.get('SLOW_QUERY_MAX_KB', 5120)) * 1024
+LOG_FILE = 'slow_queries.jsonl'
+PLAN_DIR = 'plans'
+MAX_PARAMETERS = 20
+MAX_VALUE_LENGTH = 200
+PARAMETER_MODE = os.environ.get('SLOW_QUERY_PARAMETERS', 'types')
+SENSITIVE_COLUMNS = re.compile(r'password|token|secret|upi_id|api_key', re.IGNORECASE)
+REDACTED = '<redacted>'
+
+SLOW_QUERY_DIR = None  # set by init_slow_query_log
+
+_START_KEY = 'slow_query_started'
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\$\d+|(?<!:):\w+|\?')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_VALUES_ROWS = re.compile(r'(\(\?(?:\.\.\.)?\))(?:, \1)+')
+_SPACE = re.compile(r'\s+')
+# The column list and VALUES of an INSERT, and the column a WHERE/SET placeholder is compared with
+_INSERT_COLUMNS = re.compile(r'^\s*(?:INSERT|REPLACE)\b[^(]*\(([^)]*)\)\s*VALUES\b', re.IGNORECASE)
+_COMPARED_COLUMN = re.compile(r'([\w."]+)\s*(?:[=<>!]+|\bLIKE|\bIN)\s*\(?[?,\s]*$', re.IGNORECASE)
+
+_write_lock = threading.Lock()
+_explained = set()
+_root = os.path.dirname(os.path.abspath(__file__))
+_this_file = os.path.abspath(__file__)
+
+
+def init_slow_query_log(app, engine):
+    """Time the statements run on an engine and log the slow ones"""
+    global SLOW_QUERY_DIR
+    if SLOW_QUERY_MS <= 0:
+        return engine
+    SLOW_QUERY_DIR = os.environ.get('SLOW_QUERY_DIR', os.path.join(app.instance_path, 'slow_queries'))
+    # Appended to the hooks that run before a statement (and first among those
+    # after it), so waiting for the SQLite write lock and bumping table
+    # versions are not counted as query time
+    event.listen(engine, 'before_cursor_execute', _start_timer)
+    event.listen(engine, 'after_cursor_execute', _stop_timer, insert=True)
+    event.listen(engine, 'handle_error', _drop_timer)
+    return engine
+
+
+def normalize(statement):
+    """SQL with literals, placeholders, IN-lists and multi-row VALUES collapsed"""
+    sql = _STRING.sub('?', statement)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    sql = _IN_LIST.sub('(?...)', sql)
+    return _VALUES_ROWS.sub(r'\1, ...', sql)
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_START_KEY, []).append(time.perf_counter())
+
+
+def _drop_timer(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get(_START_KEY):
+        conn.info[_START_KEY].pop()
+
+
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get(_START_KEY)
+    if not started:
+        return
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+    try:
+        _record(conn, statement, parameters, executemany, elapsed_ms)
+    except Exception as e:
+        logging.error(f"Error logging slow query: {str(e)}")
+
+
+# Recording
+
+def _record(conn, statement, parameters, executemany, elapsed_ms):
+    normalized = normalize(statement)
+    key = fingerprint(normalized)
+    entry = {
+        'fingerprint': key,
+        'at': datetime.utcnow().isoformat(timespec='seconds'),
+        'ms': round(elapsed_ms, 1),
+        'database': conn.engine.url.database and os.path.basename(conn.engine.url.database),
+        'sql': normalized,
+        'statement': statement if len(statement) <= 4000 else statement[:4000] + '...',
+        'parameters': _describe_parameters(statement, parameters, executemany),
+        'rows': len(parameters) if executemany else None,
+        'source': _source(),
+        'frame': _app_frame(),
+    }
+    logging.warning(f"Slow query ({entry['ms']} ms, {entry['source']}, {entry['frame']}): {normalized[:200]}")
+    _append(entry)
+    if key not in _explained:
+        _explained.add(key)
+        if not os.path.exists(_plan_path(key)):
+            if conn.dialect.name == 'postgresql' and REDACTED in _parameter_values(entry['parameters']):
+                plan = ['Not explained: the statement binds a sensitive value']
+            else:
+                plan = _explain(conn, statement, parameters[0] if executemany else parameters)
+            _save_plan(key, normalized, plan)
+
+
+def _describe_parameters(statement, parameters, executemany):
+    if executemany:
+        # The first row stands for the batch
+        parameters = parameters[0] if parameters else ()
+
+    def short(value):
+        if isinstance(value, (bytes, bytearray)):
+            return f'<{len(value)} bytes>'
+        if isinstance(value, (int, float, bool, date)) or value is None:
+            return value
+        text = str(value)
+        if PARAMETER_MODE != 'values':
+            return f'<{type(value).__name__}, {len(text)} chars>'
+        return text if len(text) <= MAX_VALUE_LENGTH else text[:MAX_VALUE_LENGTH] + '...'
+
+    def describe(column, value):
+        return REDACTED if column and SENSITIVE_COLUMNS.search(column) else short(value)
+
+    if isinstance(parameters, dict):
+        return {name: describe(name, value) for name, value in list(parameters.items())[:MAX_PARAMETERS]}
+    columns = _placeholder_columns(statement)
+    return [describe(columns[i] if i < len(columns) else None, value)
+            for i, value in enumerate(list(parameters or ())[:MAX_PARAMETERS])]
+
+
+def _placeholder_columns(statement):
+    """The column each positional placeholder binds to, in order (None where it can't be told)"""
+    sql = _STRING.sub(lambda match: ' ' * len(match.group()), statement)
+    insert = _INSERT_COLUMNS.match(sql)
+    if insert:
+        # Every VALUES row repeats the column list
+        names = [name.strip().strip('"') for name in insert.group(1).split(',')]
+        count = sql.count('?', insert.end()) + sql.count('%s', insert.end())
+        return [names[i % len(names)] for i in range(count)]
+    columns = []
+    for placeholder in re.finditer(r'\?|%s', sql):
+        compared = _COMPARED_COLUMN.search(sql, 0, placeholder.start())
+        columns.append(compared.group(1).strip('"') if compared else None)
+    return columns
+
+
+def _parameter_values(parameters):
+    return parameters.values() if isinstance(parameters, dict) else parameters
+
+
+def _source():
+    if has_request_context():
+        return f'{request.method} {request.path} ({request.endpoint})'
+    return f'thread {threading.current_thread().name}'
+
+
+def _app_frame():
+    """The innermost frame in the app's own code, outside this module"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_root) and filename != _this_file and 'site-packages' not in filename:
+            return f'{os.path.relpath(filename, _root)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def _log_path():
+    return os.path.join(SLOW_QUERY_DIR, LOG_FILE)
+
+
+def _plan_path(key):
+    return os.path.join(SLOW_QUERY_DIR, PLAN_DIR, f'{key}.json')
+
+
+def _append(entry):
+    line = json.dumps(entry, default=str) + '\n'
+    with _write_lock:
+        os.makedirs(SLOW_QUERY_DIR, exist_ok=True)
+        path = _log_path()
+        try:
+            if os.path.getsize(path) >= MAX_LOG_BYTES:
+                os.replace(path, path + '.1')
+        except FileNotFoundError:
+            pass
+        with open(path, 'a') as f:
+            f.write(line)
+
+
+def _explain(conn, statement, parameters):
+    """Query plan rows for a statement, run on the connection that was slow"""
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return None
+    dialect = conn.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        return None
+    # A raw DBAPI cursor, so the EXPLAIN passes none of the engine hooks
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if dialect == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters or ())
+            rows = cursor.fetchall()
+            # Rows are (id, parent, notused, detail); indent children under their parent
+            parents = {row[0]: row[1] for row in rows}
+            return ['  ' * _depth(parents, row[1]) + row[3] for row in rows]
+        # A failed EXPLAIN must not abort the transaction the query ran in
+        cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(f'EXPLAIN {statement}', parameters or None)
+            plan = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return plan
+    except Exception as e:
+        return [f'Could not explain: {str(e)}']
+    finally:
+        cursor.close()
+
+
+def _depth(parents, parent):
+    depth = 0
+    while parent in parents:
+        depth, parent = depth + 1, parents[parent]
+    return depth
+
+
+def _save_plan(key, normalized, plan):
+    os.makedirs(os.path.join(SLOW_QUERY_DIR, PLAN_DIR), exist_ok=True)
+    with open(_plan_path(key), 'w') as f:
+        json.dump({'fingerprint': key, 'sql': normalized, 'plan': plan,
+                   'captured_at': datetime.utcnow().isoformat(timespec='seconds')}, f)
+
+
+# Reading
+
+def iter_entries():
+    """Logged slow statements, oldest first"""
+    if SLOW_QUERY_DIR is None:
+        return
+    for path in (_log_path() + '.1', _log_path()):
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+        except FileNotFoundError:
+            continue
+
+
+def load_plan(key):
+    """The captured plan for a fingerprint, or None"""
+    if SLOW_QUERY_DIR is None or not re.fullmatch(r'[0-9a-f]+', key or ''):
+        return None
+    try:
+        with open(_plan_path(key)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def summarize():
+    """One row per fingerprint with its count and timings, the most total time first"""
+    groups = {}
+    for entry in iter_entries():
+        group = groups.get(entry['fingerprint'])
+        if group is None:
+            group = groups[entry['fingerprint']] = {
+                'fingerprint': entry['fingerprint'], 'sql': entry['sql'], 'count': 0, 'total_ms': 0.0,
+                'max_ms': 0.0, 'first_seen': entry['at'], 'sources': set(), 'frames': set(),
+            }
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        group['max_ms'] = max(group['max_ms'], entry['ms'])
+        group['last_seen'] = entry['at']
+        group['sources'].add(entry['source'])
+        if entry.get('frame'):
+            group['frames'].add(entry['frame'])
+    rows = sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
+    for group in rows:
+        group['average_ms'] = group['total_ms'] / group['count']
+        group['sources'] = sorted(group['sources'])
+        group['frames'] = sorted(group['frames'])
+    return rows
+
+
+def entries_for(key, limit=50):
+    """The latest logged runs of one fingerprint, newest first"""
+    return [entry for entry in iter_entries() if entry['fingerprint'] == key][-limit:][::-1]
+
+
+def export_csv():
+    """The summary, with each fingerprint's plan, as CSV text"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['fingerprint', 'count', 'total_ms', 'average_ms', 'max_ms', 'first_seen', 'last_seen',
+                     'sources', 'frames', 'sql', 'plan'])
+    for group in summarize():
+        plan = load_plan(group['fingerprint'])
+        writer.writerow([group['fingerprint'], group['count'], round(group['total_ms'], 1),
+                         round(group['average_ms'], 1), group['max_ms'], group['first_seen'], group['last_seen'],
+                         '; '.join(group['sources']), '; '.join(group['frames']), group['sql'],
+                         '\n'.join((plan or {}).get('plan') or [])])
+    return buffer.getvalue()
+
+
+def clear_slow_queries():
+    """Delete the log and captured plans; returns how many entries were dropped"""
+    if SLOW_QUERY_DIR is None:
+        return 0
+    count = sum(1 for _ in iter_entries())
+    with _write_lock:
+        for path in (_log_path(), _log_path() + '.1'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        plan_dir = os.path.join(SLOW_QUERY_DIR, PLAN_DIR)
+        if os.path.isdir(plan_dir):
+            for name in os.listdir(plan_dir):
+                os.remove(os.path.join(plan_dir, name))
+        _explained.clear()
+    return count
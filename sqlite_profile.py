@@ -0,0 +1,113 @@
+import os
+import logging
+import sqlite3
+import threading
+from sqlalchemy import event
+
+# Pragmas applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),     # negative = KiB, so 64 MB
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 268435456)),    # 256 MB
+    'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+}
+
+# How long a writer waits for the database lock before giving up
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 30000))
+
+_DML_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+
+# Process-wide writer lock per database file, held from the first write statement of a transaction until it ends
+_write_locks = {}
+_write_locks_guard = threading.Lock()
+_LOCK_KEY = 'sqlite_write_lock'
+
+
+def is_sqlite_url(url):
+    """Check whether a database URL points at SQLite"""
+    return str(url).startswith('sqlite')
+
+
+def sqlite_engine_options():
+    """Engine options for the SQLite deployment profile"""
+    return {
+        'connect_args': {
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+            'check_same_thread': False,
+            # Reads stay in autocommit; the implicit BEGIN before the first write
+            # takes the write lock up front, so writers queue on busy_timeout
+            # instead of failing when they try to upgrade a read transaction.
+            'isolation_level': 'IMMEDIATE',
+        },
+    }
+
+
+def apply_sqlite_profile(engine):
+    """Attach pragma and write-serialization hooks to a SQLite engine"""
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    event.listen(engine, 'connect', _set_pragmas)
+    event.listen(engine, 'before_cursor_execute', _acquire_write_lock)
+    event.listen(engine, 'commit', _release_write_lock)
+    event.listen(engine, 'rollback', _release_write_lock)
+    event.listen(engine.pool, 'reset', _release_on_reset)
+    event.listen(engine.pool, 'checkin', _release_on_checkin)
+    return engine
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        for name, value in SQLITE_PRAGMAS.items():
+            if name == 'journal_mode':
+                # Switching journal mode needs an exclusive lock; it is persistent,
+                # so only the first connection to a fresh database has to do it.
+                cursor.execute("PRAGMA journal_mode")
+                if cursor.fetchone()[0].upper() == str(value).upper():
+                    continue
+                try:
+                    cursor.execute(f"PRAGMA journal_mode = {value}")
+                except sqlite3.OperationalError as e:
+                    logging.warning(f"Could not set SQLite journal_mode={value}: {e}")
+                continue
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+def _acquire_write_lock(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get(_LOCK_KEY):
+        return
+    if not statement.lstrip()[:6].upper().startswith(_DML_PREFIXES):
+        return
+    with _write_locks_guard:
+        lock = _write_locks.setdefault(conn.engine.url.database, threading.Lock())
+    if lock.acquire(timeout=SQLITE_BUSY_TIMEOUT_MS / 1000):
+        conn.info[_LOCK_KEY] = lock
+    else:
+        # Fall back to SQLite's own busy handler rather than failing the request here
+        logging.warning("Timed out waiting for the SQLite write lock")
+
+
+def _release_lock(info):
+    lock = info.pop(_LOCK_KEY, None)
+    if lock is not None:
+        lock.release()
+
+
+def _release_write_lock(conn):
+    _release_lock(conn.info)
+
+
+def _release_on_reset(dbapi_connection, connection_record, reset_state=None):
+    _release_lock(connection_record.info)
+
+
+def _release_on_checkin(dbapi_connection, connection_record):
+    if connection_record is not None:
+        _release_lock(connection_record.info)
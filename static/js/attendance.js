@@ -0,0 +1,135 @@
+// MENTORSCUE Attendance
+
+// Calculate duration when start/end times change
+function calculateDuration() {
+    const startTime = document.getElementById('start_time').value;
+    const endTime = document.getElementById('end_time').value;
+    
+    if (startTime && endTime) {
+        const start = new Date(`1970-01-01T${startTime}:00`);
+        const end = new Date(`1970-01-01T${endTime}:00`);
+        
+        if (end > start) {
+            const diff = end - start;
+            const minutes = Math.floor(diff / 60000);
+            const hours = Math.floor(minutes / 60);
+            const remainingMinutes = minutes % 60;
+            
+            let durationText = '';
+            if (hours > 0) {
+                durationText = `${hours}h ${remainingMinutes}m`;
+            } else {
+                durationText = `${remainingMinutes}m`;
+            }
+            
+            document.getElementById('duration').value = durationText;
+        } else {
+            document.getElementById('duration').value = '';
+        }
+    }
+}
+
+// Suggest the selected student's subjects
+const studentSubjects = JSON.parse(document.getElementById('student-subjects').textContent);
+
+function updateSubjectOptions() {
+    const studentId = document.getElementById('student_id').value;
+    const options = document.getElementById('subject-options');
+    const subjects = studentSubjects[studentId] || [];
+    
+    options.innerHTML = '';
+    subjects.forEach(subject => {
+        const option = document.createElement('option');
+        option.value = subject;
+        options.appendChild(option);
+    });
+    
+    const subjectInput = document.getElementById('subject');
+    if (subjects.length === 1 && !subjectInput.value) {
+        subjectInput.value = subjects[0];
+    }
+}
+
+document.getElementById('student_id').addEventListener('change', updateSubjectOptions);
+
+// Event listeners for time inputs
+document.getElementById('start_time').addEventListener('change', calculateDuration);
+document.getElementById('end_time').addEventListener('change', calculateDuration);
+
+// Form validation
+document.getElementById('attendanceForm').addEventListener('submit', function(e) {
+    const startTime = document.getElementById('start_time').value;
+    const endTime = document.getElementById('end_time').value;
+    
+    if (startTime && endTime) {
+        const start = new Date(`1970-01-01T${startTime}:00`);
+        const end = new Date(`1970-01-01T${endTime}:00`);
+        
+        if (end <= start) {
+            e.preventDefault();
+            alert('End time must be after start time');
+            return false;
+        }
+    }
+    
+    // Queue on this device and sync in the background, so a weak connection loses nothing
+    if (window.fetch && this.dataset.syncUrl) {
+        e.preventDefault();
+        queueAttendance(this);
+        resetForm();
+    }
+});
+
+function resetForm() {
+    document.getElementById('attendanceForm').reset();
+    document.getElementById('duration').value = '';
+    // Every class gets its own key; a resent one keeps the key it was queued with
+    document.getElementById('client_key').value = newClientKey();
+}
+
+function showView(view) {
+    const recordView = document.getElementById('recordView');
+    const historyView = document.getElementById('historyView');
+    const buttons = document.querySelectorAll('.btn-group .btn');
+    
+    // Update active button
+    buttons.forEach(btn => btn.classList.remove('active'));
+    event.target.classList.add('active');
+    
+    if (view === 'record') {
+        recordView.style.display = 'block';
+        historyView.style.display = 'none';
+    } else {
+        recordView.style.display = 'none';
+        historyView.style.display = 'block';
+        loadAttendanceHistory();
+    }
+}
+
+function filterHistory(period) {
+    const buttons = document.querySelectorAll('#historyView .btn-group .btn');
+    buttons.forEach(btn => btn.classList.remove('active'));
+    event.target.classList.add('active');
+    
+    // Filter logic would go here
+    console.log('Filtering history for period:', period);
+}
+
+function loadAttendanceHistory() {
+    // This would typically load data via AJAX
+    console.log('Loading attendance history...');
+}
+
+// Auto-fill current time when page loads
+document.addEventListener('DOMContentLoaded', function() {
+    const now = new Date();
+    const currentTime = now.getHours().toString().padStart(2, '0') + ':' + 
+                       now.getMinutes().toString().padStart(2, '0');
+    
+    // Only set if fields are empty
+    if (!document.getElementById('start_time').value) {
+        document.getElementById('start_time').value = currentTime;
+    }
+    
+    document.getElementById('client_key').value = newClientKey();
+});
@@ -0,0 +1,165 @@
+// MENTORSCUE Dues Management
+
+document.addEventListener('DOMContentLoaded', function() {
+    // Colors come from Settings, rendered into the page as JSON
+    const statusColors = JSON.parse(document.getElementById('dues-status-colors').textContent);
+    
+    let studentsData = [];
+    let tutorsData = [];
+    
+    // Load students data
+    function loadStudents() {
+        conditionalFetch('/dues/students')
+            .then(data => {
+                studentsData = data.students;
+                renderStudents(studentsData);
+            })
+            .catch(error => {
+                console.error('Error loading students:', error);
+            });
+    }
+    
+    // Load tutors data
+    function loadTutors() {
+        conditionalFetch('/dues/tutors')
+            .then(data => {
+                tutorsData = data.tutors;
+                renderTutors(tutorsData);
+            })
+            .catch(error => {
+                console.error('Error loading tutors:', error);
+            });
+    }
+    
+    // Render students table
+    function renderStudents(students) {
+        const tbody = document.getElementById('students-tbody');
+        tbody.innerHTML = '';
+        
+        students.forEach(student => {
+            const row = document.createElement('tr');
+            const statusColor = statusColors[student.status] || '#ffffff';
+            const textColor = ['after_10_days', 'partial_payment', 'paid_attended', 'paid_no_class'].includes(student.status) ? 'white' : 'black';
+            
+            row.innerHTML = `
+                <td>${student.name}</td>
+                <td>${student.parent_name}</td>
+                <td>${student.parent_whatsapp}</td>
+                <td>
+                    <span class="badge" style="background-color: ${statusColor}; color: ${textColor};">
+                        ${student.status.replace('_', ' ').toUpperCase()}
+                    </span>
+                </td>
+                <td>₹${student.total_amount.toFixed(2)} (Paid: ₹${student.amount_paid.toFixed(2)})</td>
+                <td>
+                    <button class="btn btn-sm btn-outline-primary" onclick="openStatusModal('student', ${student.id})">
+                        <i class="fas fa-edit"></i> Update
+                    </button>
+                </td>
+            `;
+            tbody.appendChild(row);
+        });
+    }
+    
+    // Render tutors table
+    function renderTutors(tutors) {
+        const tbody = document.getElementById('tutors-tbody');
+        tbody.innerHTML = '';
+        
+        tutors.forEach(tutor => {
+            const row = document.createElement('tr');
+            const statusColor = statusColors[tutor.status] || '#ffffff';
+            const textColor = ['after_10_days', 'partial_payment', 'paid_attended', 'paid_no_class'].includes(tutor.status) ? 'white' : 'black';
+            
+            row.innerHTML = `
+                <td>${tutor.name}</td>
+                <td>${tutor.mobile}</td>
+                <td>
+                    <span class="badge" style="background-color: ${statusColor}; color: ${textColor};">
+                        ${tutor.status.replace('_', ' ').toUpperCase()}
+                    </span>
+                </td>
+                <td>₹${tutor.total_earnings.toFixed(2)}</td>
+                <td>
+                    <button class="btn btn-sm btn-outline-primary" onclick="openStatusModal('tutor', ${tutor.id})">
+                        <i class="fas fa-edit"></i> Update
+                    </button>
+                </td>
+            `;
+            tbody.appendChild(row);
+        });
+    }
+    
+    // Search functionality
+    document.getElementById('student-search').addEventListener('input', function() {
+        const searchTerm = this.value.toLowerCase();
+        const filteredStudents = studentsData.filter(student => 
+            student.name.toLowerCase().includes(searchTerm) ||
+            student.parent_name.toLowerCase().includes(searchTerm)
+        );
+        renderStudents(filteredStudents);
+    });
+    
+    document.getElementById('tutor-search').addEventListener('input', function() {
+        const searchTerm = this.value.toLowerCase();
+        const filteredTutors = tutorsData.filter(tutor => 
+            tutor.name.toLowerCase().includes(searchTerm) ||
+            tutor.mobile.includes(searchTerm)
+        );
+        renderTutors(filteredTutors);
+    });
+    
+    // Filter functionality
+    document.getElementById('student-filter').addEventListener('change', function() {
+        const filterValue = this.value;
+        const filteredStudents = filterValue ? 
+            studentsData.filter(student => student.status === filterValue) : 
+            studentsData;
+        renderStudents(filteredStudents);
+    });
+    
+    document.getElementById('tutor-filter').addEventListener('change', function() {
+        const filterValue = this.value;
+        const filteredTutors = filterValue ? 
+            tutorsData.filter(tutor => tutor.status === filterValue) : 
+            tutorsData;
+        renderTutors(filteredTutors);
+    });
+    
+    // Status update modal
+    document.getElementById('new-status').addEventListener('change', function() {
+        const amountSection = document.getElementById('amount-section');
+        if (this.value === 'partial') {
+            amountSection.style.display = 'block';
+            document.getElementById('amount-paid').required = true;
+        } else {
+            amountSection.style.display = 'none';
+            document.getElementById('amount-paid').required = false;
+        }
+    });
+    
+    // Load data on page load
+    loadStudents();
+    loadTutors();
+    
+    // Refresh data when tab is switched
+    document.getElementById('tutors-tab').addEventListener('shown.bs.tab', function() {
+        loadTutors();
+    });
+    
+    document.getElementById('students-tab').addEventListener('shown.bs.tab', function() {
+        loadStudents();
+    });
+});
+
+// Open status update modal
+function openStatusModal(entityType, entityId) {
+    document.getElementById('entity-type').value = entityType;
+    document.getElementById('entity-id').value = entityId;
+    document.getElementById('new-status').value = '';
+    document.getElementById('amount-section').style.display = 'none';
+    document.getElementById('amount-paid').value = '';
+    
+    const modal = new bootstrap.Modal(document.getElementById('statusUpdateModal'));
+    modal.show();
+}
@@ -0,0 +1,97 @@
+// MENTORSCUE Invoices & Receipts
+
+function showTab(tab) {
+    const studentTab = document.getElementById('studentTab');
+    const tutorTab = document.getElementById('tutorTab');
+    const buttons = document.querySelectorAll('.btn-group .btn');
+    
+    // Update active button
+    buttons.forEach(btn => btn.classList.remove('active'));
+    event.target.classList.add('active');
+    
+    if (tab === 'student') {
+        studentTab.style.display = 'block';
+        tutorTab.style.display = 'none';
+    } else {
+        studentTab.style.display = 'none';
+        tutorTab.style.display = 'block';
+    }
+}
+
+function filterInvoices() {
+    const statusFilter = document.getElementById('statusFilter').value;
+    const dateFrom = document.getElementById('dateFrom').value;
+    const dateTo = document.getElementById('dateTo').value;
+    
+    // Filter student invoices
+    const studentRows = document.querySelectorAll('#studentInvoicesTable tbody tr');
+    studentRows.forEach(row => {
+        let show = true;
+        
+        if (statusFilter && row.getAttribute('data-status') !== statusFilter) {
+            show = false;
+        }
+        
+        if (dateFrom || dateTo) {
+            const rowDate = row.getAttribute('data-date');
+            if (dateFrom && rowDate < dateFrom) show = false;
+            if (dateTo && rowDate > dateTo) show = false;
+        }
+        
+        row.style.display = show ? '' : 'none';
+    });
+    
+    // Filter tutor receipts
+    const tutorRows = document.querySelectorAll('#tutorReceiptsTable tbody tr');
+    tutorRows.forEach(row => {
+        let show = true;
+        
+        if (statusFilter && row.getAttribute('data-status') !== statusFilter) {
+            show = false;
+        }
+        
+        if (dateFrom || dateTo) {
+            const rowDate = row.getAttribute('data-date');
+            if (dateFrom && rowDate < dateFrom) show = false;
+            if (dateTo && rowDate > dateTo) show = false;
+        }
+        
+        row.style.display = show ? '' : 'none';
+    });
+}
+
+function clearFilters() {
+    document.getElementById('statusFilter').value = '';
+    document.getElementById('dateFrom').value = '';
+    document.getElementById('dateTo').value = '';
+    filterInvoices();
+}
+
+function markInvoicePaid(invoiceId, totalAmount, invoiceNumber) {
+    document.getElementById('invoiceNumber').textContent = invoiceNumber;
+    document.getElementById('invoice_amount_paid').value = totalAmount;
+    document.getElementById('markInvoicePaidForm').action = `/invoices/student/${invoiceId}/mark-paid`;
+    new bootstrap.Modal(document.getElementById('markInvoicePaidModal')).show();
+}
+
+function markReceiptPaid(receiptId, receiptNumber) {
+    document.getElementById('receiptNumber').textContent = receiptNumber;
+    document.getElementById('confirmReceiptPaid').onclick = function() {
+        // This would make an AJAX call to mark the receipt as paid
+        alert('Receipt payment status update feature coming soon!');
+        bootstrap.Modal.getInstance(document.getElementById('markReceiptPaidModal')).hide();
+    };
+    new bootstrap.Modal(document.getElementById('markReceiptPaidModal')).show();
+}
+
+function generateBulkInvoices() {
+    if (confirm('Generate invoices for all students with due billing cycles?')) {
+        alert('Bulk invoice generation feature coming soon!');
+    }
+}
+
+function generateBulkReceipts() {
+    if (confirm('Generate salary receipts for all tutors with due payment cycles?')) {
+        alert('Bulk receipt generation feature coming soon!');
+    }
+}
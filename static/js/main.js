@@ -3,6 +3,7 @@
 // Global variables
 let currentUser = null;
 let searchTimeout = null;
+const conditionalCache = {};
 
 // Initialize when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
@@ -25,6 +26,9 @@ function initializeApp() {
     
     // Initialize keyboard shortcuts
     initializeKeyboardShortcuts();
+    
+    // Send attendance queued while offline
+    initializeAttendanceQueue();
 }
 
 // Initialize Bootstrap tooltips
@@ -102,6 +106,41 @@ function initializeAutoRefresh() {
     if (window.location.pathname === '/attendance') {
         setInterval(refreshAttendanceData, 120000); // 2 minutes
     }
+    
+    // Tutors: unread announcement count, without fetching the announcements themselves
+    if (document.getElementById('nav-announcements-unread')) {
+        refreshUnreadAnnouncements();
+        setInterval(refreshUnreadAnnouncements, 300000); // 5 minutes
+    }
+}
+
+// Announcement read tracking
+function refreshUnreadAnnouncements() {
+    conditionalFetch('/api/announcements/unread-count')
+        .then(data => showUnreadAnnouncements(data.unread))
+        .catch(error => console.error('Error loading unread announcements:', error));
+}
+
+function showUnreadAnnouncements(count) {
+    ['nav-announcements-unread', 'announcements-unread'].forEach(id => {
+        const badge = document.getElementById(id);
+        if (badge) {
+            badge.textContent = count;
+            badge.classList.toggle('d-none', !count);
+        }
+    });
+}
+
+function markAnnouncementsRead(ids) {
+    if (!ids || ids.length === 0) {
+        return;
+    }
+    fetch('/api/announcements/read', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'same-origin',
+        body: JSON.stringify({ ids: ids })
+    }).catch(error => console.error('Error marking announcements read:', error));
 }
 
 // Keyboard shortcuts
@@ -239,6 +278,53 @@ function showSearchError() {
     showNotification('Error searching tutors. Please try again.', 'error');
 }
 
+// Conditional GET: send the last ETag/Last-Modified and reuse the cached body on 304
+function conditionalFetch(url) {
+    const storageKey = `conditional:${url}`;
+    let cached = conditionalCache[url];
+    if (!cached) {
+        try {
+            const stored = sessionStorage.getItem(storageKey);
+            cached = stored ? JSON.parse(stored) : null;
+        } catch (error) {
+            cached = null;
+        }
+    }
+    
+    const headers = { 'Accept': 'application/json' };
+    if (cached && cached.etag) {
+        headers['If-None-Match'] = cached.etag;
+    }
+    if (cached && cached.lastModified) {
+        headers['If-Modified-Since'] = cached.lastModified;
+    }
+    
+    // no-store keeps the browser cache out of the way so a 304 reaches us as-is
+    return fetch(url, { headers: headers, cache: 'no-store', credentials: 'same-origin' })
+        .then(response => {
+            if (response.status === 304 && cached) {
+                return cached.data;
+            }
+            if (!response.ok) {
+                throw new Error('Network response was not ok');
+            }
+            return response.json().then(data => {
+                const entry = {
+                    etag: response.headers.get('ETag'),
+                    lastModified: response.headers.get('Last-Modified'),
+                    data: data
+                };
+                conditionalCache[url] = entry;
+                try {
+                    sessionStorage.setItem(storageKey, JSON.stringify(entry));
+                } catch (error) {
+                    // Storage full or disabled: the in-memory copy still works
+                }
+                return data;
+            });
+        });
+}
+
 // Dashboard functions
 function refreshDashboardStats() {
     // Check if we're on the admin dashboard
@@ -247,13 +333,7 @@ function refreshDashboardStats() {
     }
     
     // Refresh statistics cards
-    fetch('/api/admin/stats')
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('Network response was not ok');
-            }
-            return response.json();
-        })
+    conditionalFetch('/api/admin/stats')
         .then(data => {
             updateDashboardStats(data);
         })
@@ -284,8 +364,7 @@ function refreshAttendanceData() {
     const attendanceTable = document.getElementById('attendanceTable');
     if (attendanceTable) {
         // Refresh attendance table data
-        fetch('/api/attendance/recent')
-            .then(response => response.json())
+        conditionalFetch('/api/attendance/recent')
             .then(data => {
                 updateAttendanceTable(data);
             })
@@ -295,6 +374,139 @@ function refreshAttendanceData() {
     }
 }
 
+// Offline attendance queue: classes wait in localStorage until the sync endpoint confirms them.
+// Each carries a client_key, so a batch resent after a lost response is stored once.
+const ATTENDANCE_SYNC_BATCH = 100;
+const ATTENDANCE_SYNC_INTERVAL = 60000; // 1 minute
+const ATTENDANCE_SYNC_RETRYABLE = [408, 429]; // other 4xx answers refuse the batch for good
+let attendanceSyncing = false;
+
+function newClientKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+function attendanceQueueKey(form) {
+    // Per user and per branch, since the sync URL carries the branch prefix
+    return `attendanceQueue:${form.dataset.syncUrl}:${form.dataset.queueOwner}`;
+}
+
+function loadAttendanceQueue(form) {
+    return loadFromLocalStorage(attendanceQueueKey(form)) || [];
+}
+
+function saveAttendanceQueue(form, queue) {
+    saveToLocalStorage(attendanceQueueKey(form), queue);
+    showAttendanceQueue(queue);
+}
+
+function showAttendanceQueue(queue) {
+    const status = document.getElementById('attendance-queue-status');
+    if (status) {
+        status.textContent = `${queue.length} class(es) saved on this device, waiting to sync`;
+        status.classList.toggle('d-none', queue.length === 0);
+    }
+}
+
+function queueAttendance(form) {
+    const record = serializeForm(form);
+    delete record.duration;
+    if (!record.client_key) {
+        record.client_key = newClientKey();
+    }
+    const queue = loadAttendanceQueue(form);
+    queue.push(record);
+    saveAttendanceQueue(form, queue);
+    return syncAttendanceQueue(form);
+}
+
+function syncAttendanceQueue(form) {
+    const queue = loadAttendanceQueue(form);
+    if (attendanceSyncing || queue.length === 0 || navigator.onLine === false) {
+        showAttendanceQueue(queue);
+        return Promise.resolve();
+    }
+    
+    attendanceSyncing = true;
+    const batch = queue.slice(0, ATTENDANCE_SYNC_BATCH);
+    return fetch(form.dataset.syncUrl, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'Accept': 'application/json' },
+        credentials: 'same-origin',
+        body: JSON.stringify({ records: batch })
+    })
+        .then(response => {
+            if (response.redirected) {
+                throw new Error('Log in again to sync the queued attendance');
+            }
+            return response.json().catch(() => ({})).then(data => {
+                if (!response.ok || !data.success) {
+                    const error = new Error(data.message || 'Sync failed');
+                    error.refused = response.status >= 400 && response.status < 500 &&
+                        !ATTENDANCE_SYNC_RETRYABLE.includes(response.status);
+                    throw error;
+                }
+                return data;
+            });
+        })
+        .then(data => {
+            const settled = new Set();
+            let created = 0;
+            data.results.forEach((result, i) => {
+                // Results come back in batch order, so even a record without a key is settled
+                settled.add(batch[i]);
+                if (result.status === 'created') {
+                    created++;
+                } else if (result.status === 'rejected') {
+                    showNotification(`Attendance not recorded: ${result.message}`, 'danger', 10000);
+                }
+            });
+            const remaining = dropSyncedRecords(form, batch, settled);
+            if (created) {
+                showNotification(`${created} attendance record(s) saved`, 'success', 3000);
+            }
+            return remaining.length > 0;
+        })
+        .catch(error => {
+            if (error.refused) {
+                // Resending the same batch would be refused again, so it leaves the queue
+                console.error('Attendance batch refused:', error, batch);
+                showNotification(`${batch.length} class(es) not recorded: ${error.message}`, 'danger', 10000);
+                return dropSyncedRecords(form, batch, new Set(batch)).length > 0;
+            }
+            // Kept in the queue for the next attempt
+            console.error('Error syncing attendance:', error);
+            showAttendanceQueue(loadAttendanceQueue(form));
+            return false;
+        })
+        .then(more => {
+            attendanceSyncing = false;
+            if (more) {
+                return syncAttendanceQueue(form);
+            }
+        });
+}
+
+function dropSyncedRecords(form, batch, settled) {
+    // Re-read: more classes may have been queued while the request was in flight
+    const keys = new Set(batch.filter(record => settled.has(record)).map(record => JSON.stringify(record)));
+    const remaining = loadAttendanceQueue(form).filter(record => !keys.has(JSON.stringify(record)));
+    saveAttendanceQueue(form, remaining);
+    return remaining;
+}
+
+function initializeAttendanceQueue() {
+    const form = document.querySelector('form[data-sync-url]');
+    if (!form || !window.fetch) {
+        return;
+    }
+    syncAttendanceQueue(form);
+    window.addEventListener('online', () => syncAttendanceQueue(form));
+    setInterval(() => syncAttendanceQueue(form), ATTENDANCE_SYNC_INTERVAL);
+}
+
 // Animation functions
 function animateCountUp(element, targetValue) {
     const currentValue = parseInt(element.textContent) || 0;
@@ -546,6 +758,9 @@ measurePageLoadTime();
 
 // Export functions for use in other scripts
 window.MentorscueApp = {
+    conditionalFetch,
+    queueAttendance,
+    syncAttendanceQueue,
     copyToClipboard,
     showNotification,
     formatDate,
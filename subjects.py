@@ -0,0 +1,43 @@
+import threading
+from app import db
+from models import Subject, student_subjects
+from versioning import get_versions
+from db_routing import current_branch
+
+# student_id -> list of subject names, valid while the catalog tables are unchanged
+_cache = {}
+_cache_version = None
+_lock = threading.Lock()
+
+
+def _catalog_version():
+    versions = get_versions([Subject, student_subjects])
+    return (current_branch(),) + tuple(version for _, (version, _) in sorted(versions.items()))
+
+
+def subject_names_for_students(student_ids):
+    """Get {student_id: [subject names]} from the per-process cache, loading any misses"""
+    global _cache, _cache_version
+    version = _catalog_version()
+    with _lock:
+        if version != _cache_version:
+            _cache, _cache_version = {}, version
+        missing = [sid for sid in student_ids if sid not in _cache]
+
+    loaded = {}
+    if missing:
+        rows = db.session.execute(
+            db.select(student_subjects.c.student_id, Subject.name)
+            .join(Subject, Subject.id == student_subjects.c.subject_id)
+            .where(student_subjects.c.student_id.in_(missing))
+            .order_by(Subject.name)
+        ).all()
+        loaded = {sid: [] for sid in missing}
+        for student_id, name in rows:
+            loaded[student_id].append(name)
+        with _lock:
+            if version == _cache_version:
+                _cache.update(loaded)
+
+    with _lock:
+        return {sid: list(loaded[sid] if sid in loaded else _cache.get(sid, [])) for sid in student_ids}
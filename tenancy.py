@@ -0,0 +1,271 @@
+"""Multi-branch tenancy: a database per branch around one shared user directory.
+
+Each name=url entry in BRANCH_DATABASE_URLS is a branch with its own database;
+a PostgreSQL URL may instead select a schema of a shared database with
+?options=-csearch_path%3D<schema>. Users, roles and branch access stay in the
+default database, so one login works in every branch a user may open, while
+all other tables are read and written in the branch's database (see
+db_routing.RoutingSession). Requests without a branch, and scripts run without
+MENTORSCUE_BRANCH, use the default database as before. Admins may open every
+branch; anyone else only the branches granted to them, or just the default
+database while they have no grants.
+
+A request's branch comes from a /b/<branch>/ path prefix, else from its host:
+BRANCH_HOSTS (comma-separated host=branch pairs) or a first host label naming a
+branch, as in north.mentorscue.example. Cross-branch reports query every
+branch's database at once from a thread pool and combine the figures.
+
+Run `python tenancy.py [--grant USERNAME BRANCH] [--revoke USERNAME BRANCH]` to
+list the branches or change who may open them.
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, request, abort, redirect
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateTable
+from app import app, db
+from models import UserBranch
+from db_routing import BRANCH_BIND_PREFIX, SHARED_TABLES, branch_context
+from reports import MONEY, refresh_cube, query_cube
+
+PATH_PREFIX = '/b/'
+_ENVIRON_KEY = 'mentorscue.branch'
+
+# Name shown for the default database next to the branches in cross-branch reports
+DEFAULT_BRANCH_LABEL = os.environ.get('DEFAULT_BRANCH_LABEL', 'Main')
+
+# Branch databases queried at once by a cross-branch report
+MAX_PARALLEL_BRANCHES = int(os.environ.get('BRANCH_REPORT_THREADS', 8))
+
+
+def branches():
+    """Configured branch names, in BRANCH_DATABASE_URLS order"""
+    return [key[len(BRANCH_BIND_PREFIX):] for key in app.config.get('SQLALCHEMY_BINDS', {})
+            if key and key.startswith(BRANCH_BIND_PREFIX)]
+
+
+def _hosts_from_env():
+    hosts = {}
+    for pair in os.environ.get('BRANCH_HOSTS', '').split(','):
+        host, _, branch = pair.partition('=')
+        if host.strip() and branch.strip():
+            hosts[host.strip().lower()] = branch.strip().lower()
+    return hosts
+
+
+class BranchPathMiddleware:
+    """Moves a /b/<branch> path prefix into SCRIPT_NAME, so routes match as usual and url_for keeps the prefix"""
+
+    def __init__(self, wsgi_app, names):
+        self.wsgi_app = wsgi_app
+        self.names = set(names)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(PATH_PREFIX):
+            name, _, rest = path[len(PATH_PREFIX):].partition('/')
+            if name.lower() in self.names:
+                environ[_ENVIRON_KEY] = name.lower()
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + PATH_PREFIX + name
+                environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
+
+
+def branch_for_request(hosts, names):
+    """The branch named by the request's path prefix or host, or None for the default database"""
+    branch = request.environ.get(_ENVIRON_KEY)
+    if branch:
+        return branch
+    host = request.host.split(':')[0].lower()
+    if host in hosts:
+        return hosts[host]
+    label = host.split('.')[0]
+    return label if '.' in host and label in names else None
+
+
+def branch_url(branch, path='/'):
+    """Absolute URL of `path` in a branch (None for the default database) on this host"""
+    return request.host_url.rstrip('/') + (PATH_PREFIX + branch if branch else '') + path
+
+
+def granted_branches(user):
+    """Branches the user was given, or None for admins, who may open every branch and the default database.
+
+    An empty list means the user has no grants and stays in the default database.
+    """
+    if user.is_admin():
+        return None
+    granted = set(db.session.execute(
+        db.select(UserBranch.branch).where(UserBranch.user_id == user.id)
+    ).scalars())
+    return [name for name in branches() if name in granted]
+
+
+def init_tenancy(app):
+    """Register the request hooks that pick each request's branch and check the user may open it"""
+    names = branches()
+    if not names:
+        return
+    hosts = _hosts_from_env()
+    unknown = set(hosts.values()) - set(names)
+    if unknown:
+        raise ValueError(f"BRANCH_HOSTS names unknown branch(es): {', '.join(sorted(unknown))}")
+
+    from flask_login import current_user
+
+    app.wsgi_app = BranchPathMiddleware(app.wsgi_app, names)
+
+    @app.before_request
+    def choose_branch():
+        g.branch = branch_for_request(hosts, names)
+        if request.endpoint == 'static' or not current_user.is_authenticated:
+            return
+        granted = g.granted_branches = granted_branches(current_user)
+        if granted is None or g.branch in granted or (g.branch is None and not granted):
+            return
+        if g.branch is None:
+            # Users limited to some branches have no business in the default database
+            return redirect(branch_url(granted[0], request.full_path.rstrip('?')))
+        abort(403)
+
+    @app.context_processor
+    def inject_branches():
+        # The branch menu offers what the user may open; None is the default database
+        granted = g.get('granted_branches')
+        return dict(current_branch=g.get('branch'), branch_names=names, branch_url=branch_url,
+                    branch_choices=[None] + names if granted is None else granted or [None],
+                    default_branch_label=DEFAULT_BRANCH_LABEL)
+
+    logging.info(f"Branches enabled: {', '.join(names)}")
+
+
+def create_branch_tables(engine):
+    """create_all for a branch database: every table but the user directory, without foreign keys into it"""
+    existing = set(inspect(engine).get_table_names())
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name in SHARED_TABLES or table.name in existing:
+                continue
+            local = [fk for fk in table.foreign_key_constraints if fk.referred_table.name not in SHARED_TABLES]
+            conn.execute(CreateTable(table, include_foreign_key_constraints=local))
+            for index in table.indexes:
+                index.create(conn)
+
+
+def init_branch_databases():
+    """Create, migrate and seed each branch database (run inside an app context)"""
+    from migrations import run_migrations
+    from models import create_table_versions, create_default_settings
+
+    for name in branches():
+        with branch_context(name):
+            try:
+                create_branch_tables(db.engines[f'{BRANCH_BIND_PREFIX}{name}'])
+                run_migrations()
+                create_table_versions()
+                create_default_settings()
+                logging.info(f"Branch {name}: database ready")
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error initializing branch {name}: {e}")
+
+
+def report_shards(user=None):
+    """(branch, label) for each database the user may report on: the default one, then each branch"""
+    granted = granted_branches(user) if user is not None else None
+    shards = [(None, DEFAULT_BRANCH_LABEL)] if not granted else []
+    return shards + [(name, name.title()) for name in (branches() if granted is None else granted)]
+
+
+def run_on_branches(fn, names, *args, **kwargs):
+    """Call fn(*args, **kwargs) in each named branch (None is the default database) in parallel.
+
+    Returns {branch: result}; a branch that fails gets its exception instead,
+    so one unreachable database does not sink the whole report.
+    """
+    def run(branch):
+        with app.app_context(), branch_context(branch):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error in branch {branch or DEFAULT_BRANCH_LABEL}: {str(e)}")
+                return e
+            finally:
+                db.session.remove()
+
+    names = list(names)
+    if not names:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_BRANCHES, len(names))) as pool:
+        return dict(zip(names, pool.map(run, names)))
+
+
+def _branch_figures(dimension, start, end):
+    try:
+        refresh_cube()
+    except Exception as e:
+        # The changed months stay marked; report the last refreshed figures
+        db.session.rollback()
+        logging.error(f"Error refreshing the report cube: {str(e)}")
+    return query_cube(dimension, start, end, by_period=False)
+
+
+def cross_branch_report(shards, dimension='all', start=None, end=None):
+    """Report cube figures for a month range from every shard, each row tagged with its branch.
+
+    Returns (rows, totals, failed) where failed lists the labels of branches
+    whose database could not be read.
+    """
+    results = run_on_branches(_branch_figures, [branch for branch, _ in shards], dimension, start, end)
+    rows, failed = [], []
+    for branch, label in shards:
+        result = results[branch]
+        if isinstance(result, Exception):
+            failed.append(label)
+            continue
+        rows.extend(dict(row, branch=branch, branch_label=label) for row in result)
+    totals = {measure: round(sum(row[measure] for row in rows), 2) for measure in MONEY + ('margin', 'classes')}
+    return rows, totals, failed
+
+
+def _counts():
+    from models import Student, Tutor
+    return Student.query.count(), Tutor.query.count()
+
+
+if __name__ == "__main__":
+    import argparse
+    from models import User
+
+    parser = argparse.ArgumentParser(description="List branches and manage which users may open them")
+    parser.add_argument('--grant', nargs=2, metavar=('USERNAME', 'BRANCH'), help="let a user open a branch")
+    parser.add_argument('--revoke', nargs=2, metavar=('USERNAME', 'BRANCH'), help="take a branch away from a user")
+    args = parser.parse_args()
+
+    with app.app_context():
+        for action, pair in (('grant', args.grant), ('revoke', args.revoke)):
+            if not pair:
+                continue
+            username, branch = pair[0], pair[1].lower()
+            if branch not in branches():
+                parser.error(f"unknown branch '{branch}' (configured: {', '.join(branches()) or 'none'})")
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                parser.error(f"unknown user '{username}'")
+            if action == 'grant':
+                db.session.merge(UserBranch(user_id=user.id, branch=branch))
+            else:
+                UserBranch.query.filter_by(user_id=user.id, branch=branch).delete()
+            db.session.commit()
+            print(f"{'Granted' if action == 'grant' else 'Revoked'} {branch} for {username}")
+
+        shards = report_shards()
+        counts = run_on_branches(_counts, [branch for branch, _ in shards])
+    for branch, label in shards:
+        result = counts[branch]
+        if isinstance(result, Exception):
+            print(f"{label}: unavailable ({result})")
+        else:
+            print(f"{label}: {result[0]} student(s), {result[1]} tutor(s)")
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The app connects and migrates on import, so point it at a throwaway database first
+_database_dir = tempfile.mkdtemp(prefix='mentorscue-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_database_dir, 'test.db')}"
+os.environ.setdefault('SESSION_SECRET', 'tests')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,44 @@
+import uuid
+from datetime import date, timedelta
+
+from app import app, db
+from models import Attendance, Student, Tutor
+from attendance_sync import CREATED, DUPLICATE, REJECTED, sync_attendance
+
+
+def test_malformed_records_are_rejected_one_by_one():
+    with app.app_context():
+        student = Student(full_name='Sync Student', parent_name='Parent', parent_whatsapp='9000000001',
+                          class_level='Class 8', subjects='Science', per_class_fee=300.0)
+        tutor = Tutor(full_name='Sync Tutor', mobile='9000000002', username='synctutor', password='9000000002')
+        db.session.add_all([student, tutor])
+        db.session.commit()
+        record = {'client_key': uuid.uuid4().hex, 'student_id': student.id, 'tutor_id': tutor.id,
+                  'subject': 'Science', 'date': (date.today() - timedelta(days=1)).isoformat(),
+                  'start_time': '10:00', 'end_time': '11:00', 'rating': 8}
+
+        results = sync_attendance([None, 'record', [record], 7, record])
+
+        assert [result['status'] for result in results] == [REJECTED] * 4 + [CREATED]
+        assert Attendance.query.filter_by(client_key=record['client_key']).count() == 1
+
+
+def test_resent_batch_comes_back_as_duplicates():
+    with app.app_context():
+        student = Student(full_name='Resend Student', parent_name='Parent', parent_whatsapp='9000000003',
+                          class_level='Class 9', subjects='Maths', per_class_fee=300.0)
+        tutor = Tutor(full_name='Resend Tutor', mobile='9000000004', username='resendtutor', password='9000000004')
+        db.session.add_all([student, tutor])
+        db.session.commit()
+        batch = [{'client_key': uuid.uuid4().hex, 'student_id': student.id, 'tutor_id': tutor.id,
+                  'subject': 'Maths', 'date': (date.today() - timedelta(days=days)).isoformat(),
+                  'start_time': '16:00', 'end_time': '17:00', 'rating': 7} for days in (1, 2, 3)]
+
+        first = sync_attendance(batch)
+        resent = sync_attendance(batch)
+
+        assert [result['status'] for result in first] == [CREATED] * 3
+        assert [result['status'] for result in resent] == [DUPLICATE] * 3
+        assert [result['id'] for result in resent] == [result['id'] for result in first]
+        for record in batch:
+            assert Attendance.query.filter_by(client_key=record['client_key']).count() == 1
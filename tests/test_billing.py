@@ -0,0 +1,60 @@
+from datetime import date, timedelta
+from sqlalchemy import inspect, text
+
+from app import app, db
+from models import AuditLog, Student, StudentInvoice
+from migrations import migrate_billing_periods
+from billing import run_billing
+from audit import flush_audit
+
+
+def _student(name, billing_start_date):
+    student = Student(full_name=name, parent_name='Parent', parent_whatsapp='9000000000', class_level='Class 9',
+                      subjects='Mathematics', per_class_fee=400.0, billing_start_date=billing_start_date)
+    db.session.add(student)
+    db.session.flush()
+    return student
+
+
+def test_billing_runs_when_duplicate_periods_block_the_period_index():
+    with app.app_context():
+        # A database from before the index, with one period billed twice
+        db.session.execute(text('DROP INDEX IF EXISTS uq_student_invoice_period'))
+        start = date.today() - timedelta(days=45)
+        doubled = _student('Double Billed', start + timedelta(days=30))
+        for number in ('OLD-1', 'OLD-2'):
+            db.session.add(StudentInvoice(student_id=doubled.id, invoice_number=number, start_date=start,
+                                          end_date=start + timedelta(days=29), total_amount=0.0))
+        due = _student('Due Student', start)
+        db.session.commit()
+
+        migrate_billing_periods()
+        indexes = {index['name'] for index in inspect(db.engine).get_indexes('student_invoice')}
+        assert 'uq_student_invoice_period' not in indexes
+
+        summary = run_billing(processes=1)
+        assert summary['student']['failed_shards'] == 0
+        invoices = StudentInvoice.query.filter_by(student_id=due.id).all()
+        assert [(invoice.start_date, invoice.end_date) for invoice in invoices] == \
+            [(start, start + timedelta(days=29))]
+
+        # A second run finds the period billed and creates nothing
+        assert run_billing(processes=1)['student']['failed_shards'] == 0
+        assert StudentInvoice.query.filter_by(student_id=due.id).count() == 1
+
+
+def test_audit_entries_from_billing_workers_are_written_once():
+    with app.app_context():
+        start = date.today() - timedelta(days=45)
+        students = [_student(f'Pooled {i}', start) for i in range(4)]
+        db.session.commit()
+        flush_audit()
+        before = AuditLog.query.filter_by(entity_type='ledger_entry').count()
+
+        summary = run_billing(processes=2, shard_size=2)
+        assert summary['student']['failed_shards'] == 0
+        assert summary['student']['created'] == len(students)
+
+        flush_audit()
+        entries = AuditLog.query.filter_by(entity_type='ledger_entry').count() - before
+        assert entries == len(students)
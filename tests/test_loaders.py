@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import selectinload
+
+from app import app, db
+from loaders import loader_profile
+from models import Student, Tutor
+
+
+@loader_profile({Tutor: [selectinload(Tutor.students)]})
+def tutor_students(username):
+    tutor = db.session.scalars(db.select(Tutor).filter_by(username=username)).one()
+    return tutor, [student.full_name for student in tutor.students]
+
+
+def test_strict_loading_raises_on_unplanned_lazy_loads():
+    with app.app_context():
+        tutor = Tutor(full_name='Strict Tutor', mobile='9000000005', username='stricttutor', password='9000000005')
+        tutor.students.append(Student(full_name='Strict Student', parent_name='Parent', parent_whatsapp='9000000006',
+                                      class_level='Class 7', subjects='English', per_class_fee=250.0))
+        db.session.add(tutor)
+        db.session.commit()
+
+    strict = app.config['STRICT_LOADING']
+    app.config['STRICT_LOADING'] = True
+    try:
+        with app.test_request_context():
+            tutor, names = tutor_students('stricttutor')
+
+            # Planned in the profile: loaded eagerly, no lazy load needed
+            assert names == ['Strict Student']
+            # Not planned: raises instead of issuing a lazy SELECT
+            with pytest.raises(InvalidRequestError):
+                tutor.user
+    finally:
+        app.config['STRICT_LOADING'] = strict
@@ -0,0 +1,24 @@
+import pickle
+
+from sqlalchemy.orm import loading
+
+from app import app, db
+from models import User
+from query_cache import _dumps
+
+
+def test_cached_results_leave_credentials_out():
+    with app.app_context():
+        user = User.query.filter_by(username='admin').first()
+        assert 'password_hash' in user.__dict__
+        statement = db.select(User).where(User.id == user.id)
+        frozen = db.session.execute(statement).freeze()
+
+        data = _dumps(frozen)
+        assert user.password_hash.encode() not in data
+        assert 'password_hash' in user.__dict__  # the session's own object keeps it
+
+        db.session.expunge_all()
+        cached = loading.merge_frozen_result(db.session(), statement, pickle.loads(data), load=False)().scalar_one()
+        assert 'password_hash' not in cached.__dict__
+        assert cached.check_password('admin123')  # loaded on access, like a deferred column
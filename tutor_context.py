@@ -0,0 +1,55 @@
+from flask import g, session
+from flask_login import current_user
+from app import db
+from models import Tutor, TableVersion, student_tutors
+
+SESSION_KEY = '_tutor_context'
+
+
+def current_tutor():
+    """The logged-in user's Tutor record, or None; resolved once per request"""
+    if 'tutor_context' not in g:
+        g.tutor_context = _resolve()
+    return g.tutor_context[0]
+
+
+def assigned_student_ids():
+    """Ids of the students assigned to the logged-in tutor"""
+    current_tutor()
+    return g.tutor_context[1]
+
+
+def _resolve():
+    if not current_user.is_authenticated or not current_user.is_tutor_user():
+        return None, frozenset()
+
+    cached = session.get(SESSION_KEY)
+    if cached and cached.get('user_id') == current_user.id:
+        criterion = Tutor.id == cached['tutor_id']
+    else:
+        cached = None
+        criterion = Tutor.user_id == current_user.id
+
+    # The tutor and the assignment table's version come back in one indexed lookup.
+    # edit_student and add_student bump that version, which invalidates the cached ids.
+    assignments_version = db.select(TableVersion.version)\
+        .where(TableVersion.table_name == student_tutors.name).scalar_subquery()
+    row = db.session.execute(db.select(Tutor, assignments_version).where(criterion)).first()
+    if row is None or row[0].user_id != current_user.id:
+        session.pop(SESSION_KEY, None)
+        return None, frozenset()
+
+    tutor, version = row[0], row[1] or 0
+    if cached and cached.get('version') == version:
+        return tutor, frozenset(cached['student_ids'])
+
+    student_ids = db.session.execute(
+        db.select(student_tutors.c.student_id).where(student_tutors.c.tutor_id == tutor.id)
+    ).scalars().all()
+    session[SESSION_KEY] = {
+        'user_id': current_user.id,
+        'tutor_id': tutor.id,
+        'version': version,
+        'student_ids': sorted(student_ids),
+    }
+    return tutor, frozenset(student_ids)
@@ -0,0 +1,177 @@
+import re
+import hashlib
+import logging
+from datetime import datetime
+from functools import wraps
+from flask import request, make_response, session
+from sqlalchemy import event
+
+VERSION_TABLE = 'table_version'
+
+# Matches the target table of INSERT / UPDATE / DELETE statements, quoted or not, after any schema
+_DML_TABLE = re.compile(
+    r'^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+'
+    r'(?:["`\[]?\w+["`\]]?\.)?["`\[]?(\w+)',
+    re.IGNORECASE
+)
+_TOUCHED_KEY = 'versioned_tables'
+_COMMITTED_KEY = 'versioned_tables_committed'
+
+# Callbacks run with the set of table names changed by each committed transaction
+_change_listeners = []
+
+
+def track_table_versions(engine):
+    """Bump table_version rows for the tables each committed transaction wrote to.
+
+    Writes only note their table on the connection. The bumps run in the
+    writer's own transaction, right before its DBAPI commit, so a version
+    moves exactly when the data does (a failed bump fails the commit), and
+    concurrent writers to a table only queue on its version row for the
+    commit itself, not their whole business transaction. This process's
+    change listeners run once the connection goes back to the pool.
+    """
+    mark = '?' if engine.dialect.paramstyle == 'qmark' else '%s'
+    event.listen(engine, 'after_cursor_execute', _record_write)
+    event.listen(engine, 'rollback', _on_rollback)
+    event.listen(engine.pool, 'checkin', _publish)
+
+    # Ahead of the SQLite profile's commit hook, so the bump still holds the process write lock
+    @event.listens_for(engine, 'commit', insert=True)
+    def bump_on_commit(conn):
+        _on_commit(conn, mark)
+    return engine
+
+
+def on_tables_changed(callback):
+    """Register a callback for committed table changes in this process"""
+    _change_listeners.append(callback)
+    return callback
+
+
+def _record_write(conn, cursor, statement, parameters, context, executemany):
+    match = _DML_TABLE.match(statement)
+    if not match:
+        return
+    table = match.group(1).lower()
+    if table != VERSION_TABLE:
+        conn.info.setdefault(_TOUCHED_KEY, set()).add(table)
+
+
+def _on_commit(conn, mark):
+    # Fires just before the DBAPI commit, inside the transaction being committed
+    tables = conn.info.pop(_TOUCHED_KEY, None)
+    if tables:
+        _bump(conn.connection.dbapi_connection, sorted(tables), mark)
+        conn.info.setdefault(_COMMITTED_KEY, set()).update(tables)
+
+
+def _on_rollback(conn):
+    conn.info.pop(_TOUCHED_KEY, None)
+
+
+def _publish(dbapi_connection, connection_record):
+    tables = connection_record.info.pop(_COMMITTED_KEY, None) if connection_record is not None else None
+    if not tables:
+        return
+    for callback in _change_listeners:
+        try:
+            callback(tables)
+        except Exception as e:
+            logging.error(f"Error in table change listener: {str(e)}")
+
+
+def _bump(dbapi_connection, tables, mark):
+    # Raw DBAPI statements pass none of the engine hooks; tables are bumped
+    # in name order so two committing writers never wait on each other's rows
+    now = datetime.utcnow()
+    cursor = dbapi_connection.cursor()
+    try:
+        for table in tables:
+            cursor.execute(
+                f"UPDATE {VERSION_TABLE} SET version = version + 1, updated_at = {mark} WHERE table_name = {mark}",
+                (now, table)
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    f"INSERT INTO {VERSION_TABLE} (table_name, version, updated_at) VALUES ({mark}, 1, {mark}) "
+                    f"ON CONFLICT (table_name) DO NOTHING",
+                    (table, now)
+                )
+    finally:
+        cursor.close()
+
+
+def _table_name(table):
+    if isinstance(table, str):
+        return table
+    return getattr(table, '__table__', table).name
+
+
+def get_versions(tables):
+    """Get {table_name: (version, updated_at)} for the given models or table names"""
+    from models import TableVersion, db
+    from db_routing import SHARED_TABLES, current_branch
+    names = sorted({_table_name(t) for t in tables})
+    versions = {name: (0, None) for name in names}
+    # A branch database counts writes to its own tables; the user directory's are counted in the default one
+    shared = [name for name in names if name in SHARED_TABLES] if current_branch() else []
+    for group, bind in ((shared, db.engines[None]), ([name for name in names if name not in shared], None)):
+        if not group:
+            continue
+        rows = db.session.execute(
+            db.select(TableVersion.table_name, TableVersion.version, TableVersion.updated_at)
+            .where(TableVersion.table_name.in_(group)),
+            bind_arguments={'bind': bind} if bind is not None else None
+        ).all()
+        versions.update({row.table_name: (row.version, row.updated_at) for row in rows})
+    return versions
+
+
+def compute_etag(versions, *parts):
+    """Cheap ETag from table versions plus any extra key parts"""
+    raw = '|'.join(f"{name}:{version}" for name, (version, _) in sorted(versions.items()))
+    raw += '|' + '|'.join(str(part) for part in parts)
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+def conditional(*tables):
+    """Answer GET requests with 304 Not Modified while the given tables are unchanged"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            from flask_login import current_user
+            from db_routing import current_branch
+
+            # Pending flash messages are part of the page, so render it fresh
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return f(*args, **kwargs)
+
+            versions = get_versions(tables)
+            user_id = current_user.get_id() if current_user.is_authenticated else None
+            # Dues ageing and announcement expiry move with the calendar, so the date is part of the key
+            today = datetime.utcnow().date()
+            etag = compute_etag(versions, request.full_path, user_id, today, current_branch())
+            stamps = [updated_at for _, updated_at in versions.values() if updated_at]
+            last_modified = max(stamps).replace(microsecond=0) if stamps else None
+
+            since = request.if_modified_since
+            if since is not None:
+                since = since.replace(tzinfo=None)
+            if etag in request.if_none_match or (
+                not request.if_none_match and last_modified and since
+                and since >= last_modified and since.date() == today
+            ):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator